@@ -0,0 +1,168 @@
+"""
+Text analysis: the pipeline that turns the words of documents and queries into index terms.
+
+    normalize (lowercase) -> tokenize -> stopword removal -> stemming
+
+The pipeline runs once per distinct word: an Analyzer remembers the term ID of every
+word it has seen, so analyzing a document costs one dictionary lookup per word. Terms
+are interned in a Vocabulary, which gives every term an integer ID; indexes key their
+posting lists on these IDs, and every occurrence of a term shares one string object.
+Removed words (stopwords) keep their positions free, so distance and phrase queries
+measure distances in the original text.
+"""
+
+import re
+import threading
+from termindex import KGramIndex
+
+# Words of documents and search queries
+WORD_PATTERN = re.compile(r'[a-zA-Z0-9_]+')
+
+# Term ID of words removed by the analyzer
+REMOVED = -1
+
+# Number of remembered words after which the memo is cleared, to bound its memory
+MEMO_SIZE = 2**20
+
+ENGLISH_STOPWORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 'in', 'into', 'is', 'it',
+    'no', 'not', 'of', 'on', 'or', 'such', 'that', 'the', 'their', 'then', 'there', 'these',
+    'they', 'this', 'to', 'was', 'will', 'with',
+])
+
+
+def tokenize(text):
+
+    """Splits text into words"""
+
+    return WORD_PATTERN.findall(text)
+
+
+def s_stemmer(word):
+
+    """Harman's S stemmer: conflates English plurals with their singulars ("cats" -> "cat").
+    Words of three letters or fewer are left alone."""
+
+    if len(word) <= 3:
+        return word
+    if word.endswith('ies') and not word.endswith(('eies', 'aies')):
+        return word[:-3] + 'y'
+    if word.endswith('es') and not word.endswith(('aes', 'ees', 'oes')):
+        return word[:-1]
+    if word.endswith('s') and not word.endswith(('us', 'ss')):
+        return word[:-1]
+    return word
+
+
+class Vocabulary:
+
+    """Term dictionary: interns terms and numbers them in order of appearance"""
+
+    def __init__(self):
+
+        # Dictionary: {term: term ID}
+        self.ids = {}
+        # List of terms by term ID
+        self.terms = []
+        # K-gram index of the terms, for wildcard queries; it catches up with `terms` when used
+        self.grams = KGramIndex()
+
+    def add(self, term):
+
+        """Returns the ID of a term, adding it if it is new"""
+
+        term_id = self.ids.get(term)
+        if term_id is None:
+            term_id = self.ids[term] = len(self.terms)
+            self.terms.append(term)
+        return term_id
+
+    def __len__(self):
+        return len(self.terms)
+
+
+class Analyzer:
+
+    """
+    Analysis pipeline of a collection.
+    stopwords: words (after normalization) that are not indexed
+    stemmer: function mapping a normalized word to its stem, e.g. `s_stemmer`
+    """
+
+    def __init__(self, stopwords=(), stemmer=None):
+
+        self.stopwords = frozenset(stopwords)
+        self.stemmer = stemmer
+        self.vocabulary = Vocabulary()
+        # Dictionary: {word as found in the text: term ID or REMOVED}
+        self.memo = {}
+        # Taken for words that are not in the memo, which may be added by several writers at once
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+
+        """Only the configuration is pickled; a copy sent to another process builds its own vocabulary"""
+
+        return {'stopwords': self.stopwords, 'stemmer': self.stemmer}
+
+    def __setstate__(self, state):
+        self.__init__(state['stopwords'], state['stemmer'])
+
+    def normalize(self, word):
+        return word.lower()
+
+    def tokenize(self, text):
+        return tokenize(text)
+
+    def analyze_word(self, word):
+
+        """Runs the pipeline on one word; returns its term or None if the word is removed"""
+
+        word = self.normalize(word)
+        if word in self.stopwords:
+            return None
+        return self.stemmer(word) if self.stemmer is not None else word
+
+    def _term_id(self, word):
+        with self.lock:
+            term_id = self.memo.get(word)
+            if term_id is not None:
+                return term_id
+            if len(self.memo) >= MEMO_SIZE:
+                self.memo.clear()
+            term = self.analyze_word(word)
+            term_id = self.memo[word] = REMOVED if term is None else self.vocabulary.add(term)
+            return term_id
+
+    def term_ids(self, words):
+
+        """Returns the term ID of every word, REMOVED for words that are not indexed"""
+
+        get = self.memo.get
+        term_ids = []
+        for word in words:
+            term_id = get(word)
+            if term_id is None:
+                term_id = self._term_id(word)
+            term_ids.append(term_id)
+        return term_ids
+
+    def analyze(self, words):
+
+        """Returns the term of every word, None for words that are not indexed"""
+
+        terms = self.vocabulary.terms
+        return [terms[term_id] if term_id != REMOVED else None for term_id in self.term_ids(words)]
+
+    def analyze_text(self, text):
+        return self.analyze(self.tokenize(text))
+
+    def term(self, word):
+
+        """Returns the term of a single query word, or None if the word is not indexed.
+        Unlike `analyze`, this does not add the term to the vocabulary."""
+
+        term_id = self.memo.get(word)
+        if term_id is None:
+            return self.analyze_word(word)
+        return None if term_id == REMOVED else self.vocabulary.terms[term_id]
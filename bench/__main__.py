@@ -0,0 +1,310 @@
+"""
+Benchmark suite: reproducible timings of the main operations, comparable between runs.
+
+For every combination of --documents and --words (average words per document) a corpus
+is generated with a seeded random generator: words are drawn from a vocabulary with
+Zipf distributed frequencies (the word of rank r has weight 1 / r^--zipf), and document
+lengths vary uniformly between half and one and a half times the average. Measured are
+
+    ingest           DB.insert_many of the corpus into an in-memory collection
+    search_word      a common, a medium and a rare word
+    search_range     a narrow and a wide range of the sorted vocabulary
+    search_wildcard  an infix and a suffix pattern (k-gram index)
+    search_fuzzy     a medium word with one and with two edits (Levenshtein automaton)
+    search_distance  two pairs of common words
+    search_query     boolean queries: AND of two common words, OR of ten medium words, NOT,
+                     NEAR/5 of two and of three common words
+    delete           DB.delete_document of every tenth document, per document, followed by
+                     search_word and search_query/and with the tombstones, and one compact
+    memory           bytes allocated by the index and the document store (tracemalloc)
+    lexer            lexing throughput of INSERT and SEARCH commands in MB/s
+    parser           SEARCH commands lexed and parsed per second (without running them)
+
+Every timing runs --warmup times untimed and then --repetitions times with
+time.perf_counter, and reports the 50th, 90th and 99th percentile and the mean.
+
+--output writes the results as JSON. --baseline compares them with an earlier JSON file:
+every metric that is worse than in the baseline by more than --tolerance is reported as a
+regression, and the exit status is 1. Timings are only comparable on the same machine.
+
+Usage: python -m bench [--documents 1000 10000] [--words 20 200] [--output results.json]
+                       [--baseline baseline.json] [--tolerance 0.25]
+"""
+
+import argparse
+import gc
+import json
+import math
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from bisect import bisect_left
+from contextlib import redirect_stdout
+from io import StringIO
+
+from invertedIndex import DB
+from lexer import Lexer
+from parser import Parser
+from query import And, Near, Not, Or, Term
+
+# Percentiles reported for every timing
+PERCENTILES = (50, 90, 99)
+
+
+def zipf_vocabulary(size, rng):
+
+    """Returns `size` distinct random lowercase words; their order is their frequency rank"""
+
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.randint(3, 10))))
+    return sorted(words, key=lambda word: rng.random())
+
+
+def generate_corpus(num_documents, words_per_document, vocabulary, zipf, rng):
+
+    """Returns `num_documents` documents (lists of words) with Zipf distributed words"""
+
+    weights = [1 / rank ** zipf for rank in range(1, len(vocabulary) + 1)]
+    cumulative = [0.0]
+    for weight in weights:
+        cumulative.append(cumulative[-1] + weight)
+    cumulative.pop(0)
+    low, high = max(words_per_document // 2, 1), max(words_per_document * 3 // 2, 1)
+    return [rng.choices(vocabulary, cum_weights=cumulative, k=rng.randint(low, high))
+            for _ in range(num_documents)]
+
+
+def percentile(sorted_values, p):
+
+    """Nearest-rank percentile of sorted values"""
+
+    return sorted_values[max(math.ceil(p / 100 * len(sorted_values)) - 1, 0)]
+
+
+def measure(function, warmup, repetitions):
+
+    """Calls `function` `warmup` times untimed and `repetitions` times timed;
+    returns the percentiles and mean of the timed calls in seconds"""
+
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    result = {f"p{p}": percentile(times, p) for p in PERCENTILES}
+    result['mean'] = sum(times) / len(times)
+    return result
+
+
+def timing(summary):
+    return dict(summary, unit='s', better='lower')
+
+
+def ingest(documents):
+
+    """Builds an in-memory collection of the documents; returns the DB"""
+
+    db = DB()
+    with redirect_stdout(StringIO()):
+        db.create_collection('bench')
+        db.insert_many('bench', documents)
+    return db
+
+
+def allocated_bytes(build):
+
+    """Returns the number of bytes that the result of `build()` keeps allocated"""
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del result
+    return after - before
+
+
+def bench_corpus(num_documents, words_per_document, args):
+
+    """Returns {metric name: result} for one corpus"""
+
+    rng = random.Random(f"{args.seed}/{num_documents}/{words_per_document}")
+    vocabulary = zipf_vocabulary(args.vocabulary, rng)
+    documents = generate_corpus(num_documents, words_per_document, vocabulary, args.zipf, rng)
+    prefix = f"{num_documents}x{words_per_document}"
+    results = {}
+
+    build_runs = max(args.repetitions // 10, 3)
+    build = measure(lambda: ingest(documents), 1, build_runs)
+    results[f"ingest/{prefix}"] = timing(build)
+    results[f"ingest/{prefix}/throughput"] = {'value': num_documents / build['p50'], 'unit': 'docs/s', 'better': 'higher'}
+    results[f"memory/{prefix}"] = {'value': allocated_bytes(lambda: ingest(documents)), 'unit': 'bytes', 'better': 'lower'}
+
+    index, _ = ingest(documents).collections['bench']
+    sorted_vocabulary = sorted(vocabulary)
+
+    def run(name, function, *function_args):
+        results[f"{name}/{prefix}"] = timing(measure(lambda: function(*function_args), args.warmup, args.repetitions))
+
+    common, medium, rare = vocabulary[0], vocabulary[len(vocabulary) // 100], vocabulary[len(vocabulary) // 2]
+    run('search_word/common', index.search_word, common)
+    run('search_word/medium', index.search_word, medium)
+    run('search_word/rare', index.search_word, rare)
+
+    start = bisect_left(sorted_vocabulary, common)
+    narrow_end = sorted_vocabulary[min(start + 10, len(sorted_vocabulary) - 1)]
+    wide_end = sorted_vocabulary[min(start + len(sorted_vocabulary) // 10, len(sorted_vocabulary) - 1)]
+    run('search_range/narrow', index.search_range, common, narrow_end)
+    run('search_range/wide', index.search_range, common, wide_end)
+
+    run('search_wildcard/infix', index.search_wildcard, f'*{medium[1:4]}*')
+    run('search_wildcard/suffix', index.search_wildcard, f'*{medium[-3:]}')
+    run('search_fuzzy/one', index.search_fuzzy, medium, 1)
+    run('search_fuzzy/two', index.search_fuzzy, medium, 2)
+
+    run('search_distance/adjacent', index.search_distance, vocabulary[0], vocabulary[1], 1)
+    run('search_distance/near', index.search_distance, vocabulary[0], vocabulary[10], 3)
+
+    run('search_query/and', index.search_query, And([Term(vocabulary[1]), Term(vocabulary[2])]))
+    run('search_query/or', index.search_query, Or([Term(word) for word in vocabulary[100:110]]))
+    run('search_query/not', index.search_query, Not(Term(vocabulary[3])))
+    run('search_query/near', index.search_query, Near(vocabulary[:2], 5))
+    run('search_query/near3', index.search_query, Near(vocabulary[:3], 5))
+
+    # Deletes only add tombstones, which searches filter out until the collection is compacted
+    db = ingest(documents)
+    index, _ = db.collections['bench']
+    deleted = iter(range(1, num_documents + 1, 10))
+    with redirect_stdout(StringIO()):
+        results[f"delete/{prefix}"] = timing(measure(lambda: db.delete_document('bench', next(deleted)), 0,
+                                                     len(range(1, num_documents + 1, 10))))
+        run('delete/search_word', index.search_word, common)
+        run('delete/search_query', index.search_query, And([Term(vocabulary[1]), Term(vocabulary[2])]))
+        results[f"delete/compact/{prefix}"] = timing(measure(lambda: db.compact('bench'), 0, 1))
+    return results
+
+
+def bench_language(args):
+
+    """Returns {metric name: result} for lexing and parsing"""
+
+    rng = random.Random(f"{args.seed}/language")
+    vocabulary = zipf_vocabulary(2000, rng)
+    insert_script = ''.join(f'INSERT docs "{" ".join(document)}";\n'
+                            for document in generate_corpus(200, 50, vocabulary, args.zipf, rng))
+    search_commands = [f'SEARCH docs WHERE "{rng.choice(vocabulary)}" AND NOT ("{rng.choice(vocabulary)}" OR '
+                       f'"{rng.choice(vocabulary)}" <3> "{rng.choice(vocabulary)}") TOP 10 LIMIT 5;'
+                       for _ in range(200)]
+    search_script = '\n'.join(search_commands)
+
+    def lex(text):
+        lexer = Lexer(text)
+        while lexer.get_next_token().type != 'EOF':
+            pass
+
+    def parse_all():
+        with redirect_stdout(StringIO()):
+            for command in search_commands:
+                Parser(Lexer(command), None).parse_search()
+
+    results = {}
+    for name, text in [('lexer/insert', insert_script), ('lexer/search', search_script)]:
+        summary = measure(lambda text=text: lex(text), args.warmup, args.repetitions)
+        results[name] = timing(summary)
+        results[f"{name}/throughput"] = {'value': len(text.encode('utf-8')) / summary['p50'] / 1e6,
+                                         'unit': 'MB/s', 'better': 'higher'}
+    summary = measure(parse_all, args.warmup, args.repetitions)
+    results['parser/search'] = timing(summary)
+    results['parser/search/throughput'] = {'value': len(search_commands) / summary['p50'],
+                                           'unit': 'commands/s', 'better': 'higher'}
+    return results
+
+
+def headline(result):
+
+    """The number a result is compared by: the median of timings, otherwise its value"""
+
+    return result['p50'] if 'p50' in result else result['value']
+
+
+def compare(results, baseline, tolerance):
+
+    """Returns [(metric name, baseline, current, relative change)] of the metrics that got
+    worse than the baseline by more than `tolerance`"""
+
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old, new = headline(baseline[name]), headline(result)
+        if old <= 0 or new <= 0:
+            continue
+        # Positive changes are always slowdowns, for times as well as for rates
+        change = new / old - 1 if result['better'] == 'lower' else old / new - 1
+        if change > tolerance:
+            regressions.append((name, old, new, change))
+    return regressions
+
+
+def format_value(result):
+    if result['unit'] == 's':
+        return '   '.join(f"{key}: {result[key] * 1e3:9.3f} ms" for key in [f"p{p}" for p in PERCENTILES] + ['mean'])
+    if result['unit'] == 'bytes':
+        return f"{result['value'] / 2**20:9.2f} MiB"
+    return f"{result['value']:12.1f} {result['unit']}"
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--documents', type=int, nargs='+', default=[1000, 10000])
+    arg_parser.add_argument('--words', type=int, nargs='+', default=[20, 200])
+    arg_parser.add_argument('--vocabulary', type=int, default=20000)
+    arg_parser.add_argument('--zipf', type=float, default=1.0, help="exponent of the Zipf distribution of words")
+    arg_parser.add_argument('--warmup', type=int, default=5)
+    arg_parser.add_argument('--repetitions', type=int, default=50)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--output', help="write the results to this JSON file")
+    arg_parser.add_argument('--baseline', help="JSON file of an earlier run to compare with")
+    arg_parser.add_argument('--tolerance', type=float, default=0.25,
+                            help="relative slowdown of a metric that counts as a regression")
+    args = arg_parser.parse_args()
+
+    results = {}
+    for num_documents in args.documents:
+        for words_per_document in args.words:
+            print(f"Corpus of {num_documents} documents with {words_per_document} words on average", file=sys.stderr)
+            results.update(bench_corpus(num_documents, words_per_document, args))
+    results.update(bench_language(args))
+
+    width = max(map(len, results))
+    for name, result in results.items():
+        print(f"{name:{width}}   {format_value(result)}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'python': platform.python_version(), 'platform': platform.platform(),
+                       'config': vars(args), 'results': results}, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        print(f"\nCompared with {args.baseline}: {len(regressions)} regressions beyond {args.tolerance:.0%}")
+        for name, old, new, change in regressions:
+            print(f"{name:{width}}   {old:.6g} -> {new:.6g}   ({change:+.0%})")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Benchmark for `analyzer.Analyzer`: memoized pipeline vs. analyzing every word occurrence.
+
+Indexes a corpus of Zipf distributed words with the default analyzer (lowercasing only)
+and with English stopwords and the S stemmer, and reports the indexing throughput in
+words per second, the number of distinct words and the number of terms.
+
+Usage: python -m bench.analyzer [--documents 20000] [--words-per-doc 60]
+"""
+
+import argparse
+import random
+import time
+
+from analyzer import ENGLISH_STOPWORDS, REMOVED, Analyzer, s_stemmer
+from invertedIndex import InvertedIndex
+
+
+class UnmemoizedAnalyzer(Analyzer):
+
+    """Runs the whole pipeline for every word occurrence, like indexing did before the analyzer"""
+
+    def term_ids(self, words):
+        add = self.vocabulary.add
+        term_ids = []
+        for word in words:
+            term = self.analyze_word(word)
+            term_ids.append(REMOVED if term is None else add(term))
+        return term_ids
+
+
+def make_documents(num_docs, words_per_doc, vocabulary_size=50000):
+
+    """Returns documents of Zipf distributed, capitalized and plural words"""
+
+    stems = [''.join(random.choices('abcdefghijklmnopqrstuvwxyz', k=random.randint(3, 9))) for _ in range(vocabulary_size)]
+    words = sorted(ENGLISH_STOPWORDS) + [variant for stem in stems for variant in (stem, stem + 's', stem.capitalize())]
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    return [random.choices(words, weights, k=words_per_doc) for _ in range(num_docs)]
+
+
+def measure(analyzer, documents):
+
+    """Returns (words per second, index) of indexing the documents"""
+
+    index = InvertedIndex(analyzer)
+    start = time.perf_counter()
+    index.insert_many(documents)
+    elapsed = time.perf_counter() - start
+    return sum(map(len, documents)) / elapsed, index
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--documents', type=int, default=20000)
+    arg_parser.add_argument('--words-per-doc', type=int, default=60)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    random.seed(args.seed)
+    documents = make_documents(args.documents, args.words_per_doc)
+    distinct = len({word for tokens in documents for word in tokens})
+    print(f"Documents: {args.documents}   word occurrences: {args.documents * args.words_per_doc}"
+          f"   distinct words: {distinct}")
+
+    for name, options in [('lowercase', ()), ('stopwords + S stemmer', (ENGLISH_STOPWORDS, s_stemmer))]:
+        memo_rate, index = measure(Analyzer(*options), documents)
+        plain_rate, plain_index = measure(UnmemoizedAnalyzer(*options), documents)
+        assert sorted(index.index) == sorted(plain_index.index)
+        print(f"{name:24} memoized: {memo_rate / 1e6:5.2f} M words/s   unmemoized: {plain_rate / 1e6:5.2f} M words/s"
+              f"   speedup: {memo_rate / plain_rate:.2f}x   terms: {len(index.index)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Benchmark for `FullDocuments`: compressed block store vs. the old dict of strings.
+
+Reports the memory held by the stored documents and the average latency of
+fetching random documents and pages of consecutive documents.
+
+Usage: python -m bench.document_store [--sizes 10000 100000] [--block-sizes 4096 16384 65536]
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+
+from invertedIndex import FullDocuments
+
+
+class DictDocuments:
+
+    """The previous FullDocuments: {document_id: document(str)}"""
+
+    def __init__(self):
+        self.full_text = {}
+
+    def add_document(self, doc_id, document):
+        self.full_text[doc_id] = ' '.join(document)
+
+    def get_document(self, doc_id):
+        return self.full_text.get(doc_id)
+
+
+def make_documents(num_docs, vocabulary_size=20000, words_per_doc=60):
+
+    """Returns documents of Zipf distributed words"""
+
+    words = [f"word{i}" for i in range(vocabulary_size)]
+    weights = [1 / (rank + 1) for rank in range(vocabulary_size)]
+    return [random.choices(words, weights, k=random.randint(words_per_doc // 2, words_per_doc * 2))
+            for _ in range(num_docs)]
+
+
+def measure_store(make_store, documents):
+
+    """Returns (store, bytes allocated while filling it)"""
+
+    tracemalloc.start()
+    store = make_store()
+    for doc_id, tokens in enumerate(documents, 1):
+        store.add_document(doc_id, tokens)
+    if hasattr(store, 'store'):
+        store.store.close_block()
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return store, memory
+
+
+def measure_fetch(store, doc_ids):
+
+    """Returns the average time of fetching one of `doc_ids`"""
+
+    start = time.perf_counter()
+    for doc_id in doc_ids:
+        store.get_document(doc_id)
+    return (time.perf_counter() - start) / len(doc_ids)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--sizes', type=int, nargs='+', default=[10**4, 10**5])
+    arg_parser.add_argument('--block-sizes', type=int, nargs='+', default=[4096, 16384, 65536])
+    arg_parser.add_argument('--fetches', type=int, default=10000)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    random.seed(args.seed)
+    for size in args.sizes:
+        print(f"\nDocuments: {size}")
+        documents = make_documents(size)
+        random_ids = [random.randint(1, size) for _ in range(args.fetches)]
+        page_start = random.randint(1, max(size - args.fetches, 1))
+        page_ids = list(range(page_start, min(page_start + args.fetches, size + 1)))
+
+        stores = [('dict', DictDocuments)]
+        stores += [(f"zlib {block_size // 1024} KiB blocks", lambda block_size=block_size: FullDocuments(block_size))
+                   for block_size in args.block_sizes]
+        stores.append((f"lzma {args.block_sizes[-1] // 1024} KiB blocks", lambda: FullDocuments(args.block_sizes[-1], 'lzma')))
+        for name, make_store in stores:
+            store, memory = measure_store(make_store, documents)
+            assert all(store.get_document(doc_id) == ' '.join(documents[doc_id - 1]) for doc_id in random_ids[:100])
+            random_time = measure_fetch(store, random_ids)
+            page_time = measure_fetch(store, page_ids)
+            print(f"{name:24} memory: {memory / 2**20:8.2f} MiB   random fetch: {random_time * 1e6:8.2f} us"
+                  f"   sequential fetch: {page_time * 1e6:6.2f} us")
+
+
+if __name__ == '__main__':
+    main()
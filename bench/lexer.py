@@ -0,0 +1,143 @@
+"""
+Benchmark for `lexer.Lexer`: master regex lexer vs. the old character-by-character lexer.
+
+Reports lexing throughput in MB/s for INSERT commands with documents of several lengths
+and for short SEARCH commands, after checking that both lexers produce the same tokens.
+
+Usage: python -m bench.lexer [--document-words 10 1000 100000] [--repetitions 5]
+"""
+
+import argparse
+import random
+import re
+import time
+
+from lexer import Lexer, Token, WORD_PATTERN
+
+
+class CharLexer:
+
+    """The previous lexer, which advances one character at a time"""
+
+    token_patterns = {
+        r'CREATE': 'CREATE', r'INSERT': 'INSERT', r'PRINT_INDEX': 'PRINT_INDEX', r'SEARCH': 'SEARCH',
+        r'WHERE': 'WHERE', r'^BULK$': 'BULK', r'^FROM$': 'FROM', r'^SHARDS$': 'SHARDS', r'^AND$': 'AND',
+        r'^OR$': 'OR', r'^NOT$': 'NOT', r'^TOP$': 'TOP', r'^LIMIT$': 'LIMIT', r'^OFFSET$': 'OFFSET',
+        r'^[a-zA-Z][a-zA-Z0-9_]*$': 'COLLECTION', r'^"[a-zA-Z][a-zA-Z0-9_]*"$': 'WORD', r'^".*"$': 'DOCUMENT',
+        r'^-': 'MIN', r'^<\d+>$': 'DIST', r'^\d+$': 'NUMBER', r'^;$': 'EOI', r'.+': 'JUNK'
+    }
+    keywords = ['CREATE', 'INSERT', 'PRINT_INDEX', 'SEARCH', 'WHERE', 'BULK', 'FROM', 'SHARDS',
+                'AND', 'OR', 'NOT', 'TOP', 'LIMIT', 'OFFSET']
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+        self.current_char = self.text[self.pos] if self.text else None
+
+    def error(self):
+        raise Exception('Error in lexer')
+
+    def advance(self):
+        self.pos += 1
+        self.current_char = None if self.pos >= len(self.text) else self.text[self.pos]
+
+    def get_token_type(self, token):
+        for pattern, token_type in self.token_patterns.items():
+            if re.match(pattern, token, re.IGNORECASE if token_type in self.keywords else 0):
+                return token_type
+        self.error()
+
+    def get_next_token(self):
+        while self.current_char is not None:
+            if self.current_char.isspace():
+                while self.current_char is not None and self.current_char.isspace():
+                    self.advance()
+                continue
+            if self.current_char == ';':
+                self.advance()
+                return Token('EOI', ';')
+            if self.current_char == '-':
+                self.advance()
+                return Token('MIN', '-')
+            if self.current_char in '()':
+                char = self.current_char
+                self.advance()
+                return Token('LPAREN' if char == '(' else 'RPAREN', char)
+            result = ''
+            if self.current_char == '"':
+                self.advance()
+                contains_space = False
+                while self.current_char is not None and self.current_char != '"':
+                    contains_space = contains_space or self.current_char.isspace()
+                    result += self.current_char
+                    self.advance()
+                if self.current_char is None:
+                    self.error()
+                self.advance()
+                return Token('DOCUMENT' if contains_space else 'WORD', WORD_PATTERN.findall(result), result)
+            if self.current_char == '<':
+                self.advance()
+                while self.current_char is not None and self.current_char != '>':
+                    result += self.current_char
+                    self.advance()
+                if self.current_char is None:
+                    self.error()
+                self.advance()
+                if result.isdigit():
+                    return Token('DIST', int(result))
+                self.error()
+            while self.current_char is not None and not self.current_char.isspace() and self.current_char not in [';', '"', '(', ')']:
+                result += self.current_char
+                self.advance()
+            if result:
+                return Token(self.get_token_type(result), result)
+        return Token('EOF', None)
+
+
+def tokens(lexer_class, text):
+    lexer = lexer_class(text)
+    result = []
+    token = lexer.get_next_token()
+    while token.type != 'EOF':
+        result.append((token.type, token.value, token.text))
+        token = lexer.get_next_token()
+    return result
+
+
+def measure_throughput(lexer_class, text, repetitions):
+
+    """Returns the lexing throughput in MB/s"""
+
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        tokens(lexer_class, text)
+    elapsed = (time.perf_counter() - start) / repetitions
+    return len(text.encode('utf-8')) / elapsed / 1e6
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--document-words', type=int, nargs='+', default=[10, 1000, 100000])
+    arg_parser.add_argument('--repetitions', type=int, default=5)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    random.seed(args.seed)
+    words = [''.join(random.choices('abcdefghijklmnopqrstuvwxyz', k=random.randint(2, 10))) for _ in range(5000)]
+    commands = [(f"INSERT, {n} words", f'INSERT docs "{" ".join(random.choices(words, k=n))}";')
+                for n in args.document_words]
+    commands.append(("1000 SEARCH commands",
+                     ' '.join(f'SEARCH docs WHERE "{random.choice(words)}" AND NOT ("{random.choice(words)}" OR '
+                              f'"{random.choice(words)}" <3> "{random.choice(words)}") TOP 10 LIMIT 5;'
+                              for _ in range(1000))))
+
+    for name, text in commands:
+        assert tokens(Lexer, text) == tokens(CharLexer, text)
+        regex_rate = measure_throughput(Lexer, text, args.repetitions)
+        char_rate = measure_throughput(CharLexer, text, args.repetitions)
+        print(f"{name:24} master regex: {regex_rate:8.2f} MB/s   char by char: {char_rate:6.2f} MB/s"
+              f"   speedup: {regex_rate / char_rate:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
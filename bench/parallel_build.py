@@ -0,0 +1,57 @@
+"""
+Benchmark for building an index on a process pool vs. serial insertion.
+
+Usage: python -m bench.parallel_build [--num-docs 200000] [--workers 1 2 4 8 16]
+"""
+
+import argparse
+import os
+import random
+import string
+import time
+
+from invertedIndex import InvertedIndex, build_index_parallel
+
+
+def generate_documents(num_documents, doc_length, vocabulary_size):
+    words = [''.join(random.choices(string.ascii_lowercase, k=5)) for _ in range(vocabulary_size)]
+    return [random.choices(words, k=doc_length) for _ in range(num_documents)]
+
+
+def build_serial(documents):
+    index = InvertedIndex()
+    for tokens in documents:
+        index.insert(tokens)
+    return index
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--num-docs', type=int, default=200000)
+    arg_parser.add_argument('--doc-length', type=int, default=50)
+    arg_parser.add_argument('--vocabulary', type=int, default=50000)
+    arg_parser.add_argument('--chunk-size', type=int, default=10000)
+    arg_parser.add_argument('--workers', type=int, nargs='+',
+                            default=sorted({1, 2, 4, 8, 16, os.cpu_count()}))
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    random.seed(args.seed)
+    documents = generate_documents(args.num_docs, args.doc_length, args.vocabulary)
+    print(f"Documents: {args.num_docs}, words: {args.num_docs * args.doc_length}, CPUs: {os.cpu_count()}")
+
+    start = time.perf_counter()
+    serial_index = build_serial(documents)
+    serial_time = time.perf_counter() - start
+    print(f"Serial insert: {serial_time:.2f} seconds.")
+
+    for workers in args.workers:
+        start = time.perf_counter()
+        index = build_index_parallel(documents, workers=workers, chunk_size=args.chunk_size)
+        elapsed = time.perf_counter() - start
+        assert index.index == serial_index.index
+        print(f"{workers:>3} workers: {elapsed:.2f} seconds, speedup {serial_time / elapsed:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
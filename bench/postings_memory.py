@@ -0,0 +1,91 @@
+"""
+Memory benchmark for posting lists: the old dict-of-dict-of-list layout vs. `PostingList`
+arrays vs. delta + varint encoded bytes.
+
+Usage: python -m bench.postings_memory [--sizes 1000000 10000000] [--num-docs 1000]
+"""
+
+import argparse
+import gc
+import random
+import string
+import tracemalloc
+
+from invertedIndex import InvertedIndex
+
+
+def generate_documents(num_words, num_documents, vocabulary_size):
+
+    """Generates `num_documents` random documents with `num_words` words in total"""
+
+    words = [''.join(random.choices(string.ascii_lowercase, k=5)) for _ in range(vocabulary_size)]
+    doc_length = max(num_words // num_documents, 1)
+    return [random.choices(words, k=doc_length) for _ in range(num_documents)]
+
+
+def build_dict_index(documents):
+
+    """Builds the old {word: {document_id: [positions]}} layout"""
+
+    index = {}
+    for doc_id, tokens in enumerate(documents, start=1):
+        for pos, token in enumerate(tokens):
+            index.setdefault(token, {}).setdefault(doc_id, []).append(pos)
+    return index
+
+
+def build_posting_index(documents):
+    index = InvertedIndex()
+    for tokens in documents:
+        index.insert(tokens)
+    return index
+
+
+def encode_index(index):
+    return {word: postings.encode() for word, postings in index.index.items()}
+
+
+def measure_memory(build, *args):
+
+    """Returns the result of `build(*args)` and the number of bytes it keeps allocated"""
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build(*args)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--sizes', type=int, nargs='+', default=[10**6, 10**7])
+    arg_parser.add_argument('--num-docs', type=int, default=1000)
+    arg_parser.add_argument('--vocabulary', type=int, default=10000)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    random.seed(args.seed)
+    for size in args.sizes:
+        print(f"\nTesting with total words: {size}, documents: {args.num_docs}")
+        documents = generate_documents(size, args.num_docs, args.vocabulary)
+
+        dict_index, dict_bytes = measure_memory(build_dict_index, documents)
+        pairs = sum(len(doc_positions) for doc_positions in dict_index.values())
+        del dict_index
+
+        posting_index, posting_bytes = measure_memory(build_posting_index, documents)
+        _, encoded_bytes = measure_memory(encode_index, posting_index)
+        del posting_index
+
+        print(f"(word, document) pairs: {pairs}")
+        for name, num_bytes in [("dict of dict of list", dict_bytes),
+                                ("PostingList arrays", posting_bytes),
+                                ("delta + varint bytes", encoded_bytes)]:
+            print(f"{name:>22}: {num_bytes / 2**20:9.1f} MiB, {num_bytes / pairs:7.1f} bytes per pair")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Benchmark for `InvertedIndex.search_range`: sorted term dictionary vs. the old linear scan.
+
+Usage: python -m bench.range_query [--sizes 100000 1000000 10000000] [--repetitions 20]
+"""
+
+import argparse
+import random
+import time
+
+from invertedIndex import InvertedIndex
+
+
+def linear_scan_range(index, keyword1, keyword2):
+
+    """The previous implementation of `search_range`, which checks every word in the index"""
+
+    keyword1, keyword2 = keyword1.lower(), keyword2.lower()
+    result_docs = set()
+    for word in index.index:
+        if keyword1 <= word <= keyword2:
+            result_docs.update(index.index[word].keys())
+    return list(result_docs)
+
+
+def build_index(vocabulary_size, words_per_doc=1000):
+
+    """Builds an index where every word of a vocabulary of the given size occurs once"""
+
+    index = InvertedIndex()
+    words = [f"w{i:08d}" for i in range(vocabulary_size)]
+    random.shuffle(words)
+    for start in range(0, vocabulary_size, words_per_doc):
+        index.insert(words[start:start + words_per_doc])
+    index.sorted_terms()
+    return index
+
+
+def measure_average_time(func, repetitions, *args):
+    times = []
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return sum(times) / repetitions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--sizes', type=int, nargs='+', default=[10**5, 10**6, 10**7])
+    arg_parser.add_argument('--repetitions', type=int, default=20)
+    arg_parser.add_argument('--matched', type=int, default=100, help='number of words the range covers')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    random.seed(args.seed)
+    for size in args.sizes:
+        print(f"\nVocabulary size: {size}")
+        index = build_index(size)
+        first = random.randrange(max(size - args.matched, 1))
+        keyword1 = f"w{first:08d}"
+        keyword2 = f"w{min(first + args.matched, size) - 1:08d}"
+
+        assert sorted(index.search_range(keyword1, keyword2)) == sorted(linear_scan_range(index, keyword1, keyword2))
+
+        avg_time_sorted = measure_average_time(index.search_range, args.repetitions, keyword1, keyword2)
+        avg_time_linear = measure_average_time(linear_scan_range, args.repetitions, index, keyword1, keyword2)
+        print(f"Sorted term dictionary average time: {avg_time_sorted:.9f} seconds.")
+        print(f"Linear scan average time:            {avg_time_linear:.9f} seconds.")
+        print(f"Speedup: {avg_time_linear / avg_time_sorted:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
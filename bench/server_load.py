@@ -0,0 +1,102 @@
+"""
+Load generator for `server.py`: search throughput and latency over the line protocol.
+
+Starts a server on a collection of random documents (or targets a running server with
+--port), opens `--connections` connections and keeps up to `--depth` pipelined SEARCH
+commands in flight on each, for every depth given. Reports queries per second and the
+50th/99th percentile latency.
+
+Usage: python -m bench.server_load [--documents 20000] [--connections 16] [--depth 1 8 32]
+"""
+
+import argparse
+import asyncio
+import random
+import threading
+import time
+from contextlib import redirect_stdout
+from io import StringIO
+
+from invertedIndex import DB
+from server import CommandServer
+
+
+def start_server(documents, words, threads):
+
+    """Runs a server with a collection 'docs' in a background thread; returns its port"""
+
+    db = DB()
+    with redirect_stdout(StringIO()):
+        db.create_collection('docs')
+        db.insert_many('docs', [' '.join(random.choices(words, k=30)) for _ in range(documents)])
+    started = threading.Event()
+    ports = []
+
+    async def run():
+        server = CommandServer(db, threads)
+        listeners = await server.start('127.0.0.1', 0)
+        ports.append(listeners[0].sockets[0].getsockname()[1])
+        started.set()
+        await listeners[0].serve_forever()
+
+    threading.Thread(target=asyncio.run, args=(run(),), daemon=True).start()
+    started.wait()
+    return ports[0]
+
+
+async def client(port, queries, depth, latencies):
+
+    """Sends `queries` over one connection with up to `depth` of them in flight"""
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    sent_times = asyncio.Queue(depth)
+
+    async def receive():
+        for _ in queries:
+            status, length = (await reader.readline()).split()
+            await reader.readexactly(int(length))
+            latencies.append(time.perf_counter() - sent_times.get_nowait())
+
+    receiver = asyncio.ensure_future(receive())
+    for query in queries:
+        await sent_times.put(time.perf_counter())
+        writer.write(query.encode() + b'\n')
+        await writer.drain()
+    await receiver
+    writer.close()
+
+
+async def run_load(port, queries, connections, depth):
+    latencies = []
+    per_connection = [queries[i::connections] for i in range(connections)]
+    start = time.perf_counter()
+    await asyncio.gather(*(client(port, part, depth, latencies) for part in per_connection))
+    return len(queries) / (time.perf_counter() - start), sorted(latencies)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--port', type=int, default=None, help="port of a running server with a collection 'docs'")
+    arg_parser.add_argument('--documents', type=int, default=20000)
+    arg_parser.add_argument('--queries', type=int, default=20000)
+    arg_parser.add_argument('--connections', type=int, default=16)
+    arg_parser.add_argument('--depth', type=int, nargs='+', default=[1, 8, 32])
+    arg_parser.add_argument('--threads', type=int, default=4)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    random.seed(args.seed)
+    words = [f"word{i}" for i in range(5000)]
+    port = args.port if args.port is not None else start_server(args.documents, words, args.threads)
+    queries = [f'SEARCH docs WHERE "{random.choice(words)}" AND "{random.choice(words[:50])}" LIMIT 10;'
+               for _ in range(args.queries)]
+
+    for depth in args.depth:
+        rate, latencies = asyncio.run(run_load(port, queries, args.connections, depth))
+        p50, p99 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+        print(f"connections: {args.connections:3}   pipeline depth: {depth:3}   {rate:8.0f} queries/s"
+              f"   p50: {p50 * 1e3:6.2f} ms   p99: {p99 * 1e3:6.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Benchmark for `InvertedIndex.search_top`: BM25 top k with MaxScore pruning vs. scoring every match.
+
+Usage: python -m bench.top_k [--sizes 10000 100000] [--k 10] [--repetitions 5]
+"""
+
+import argparse
+import heapq
+import math
+import random
+import time
+
+from invertedIndex import InvertedIndex
+from query import Or, Term
+from ranking import term_score
+
+
+def score_all(index, words, k):
+
+    """Scores every document that contains one of the words and keeps the best k"""
+
+    stats = index.collection_stats(words)
+    average_length = stats.average_length()
+    scores = {}
+    for word in words:
+        postings = index.index.get(word)
+        if postings:
+            idf = stats.idf(word)
+            for i, doc_id in enumerate(postings.doc_ids):
+                score = term_score(idf, postings.frequency_at(i), index.document_length(doc_id), average_length)
+                scores.setdefault(doc_id, []).append(score)
+    return heapq.nsmallest(k, ((doc_id, math.fsum(word_scores)) for doc_id, word_scores in scores.items()),
+                           key=lambda result: (-result[1], result[0]))
+
+
+def build_index(num_docs, vocabulary_size=5000, words_per_doc=100):
+
+    """Builds an index of documents with Zipf distributed words: w0 is the most common word"""
+
+    words = [f"w{i}" for i in range(vocabulary_size)]
+    weights = [1 / (rank + 1) for rank in range(vocabulary_size)]
+    index = InvertedIndex()
+    index.insert_many([random.choices(words, weights, k=random.randint(words_per_doc // 2, words_per_doc * 2))
+                       for _ in range(num_docs)])
+    return index
+
+
+def measure_average_time(func, repetitions, *args):
+    times = []
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return sum(times) / repetitions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--sizes', type=int, nargs='+', default=[10**4, 10**5])
+    arg_parser.add_argument('--k', type=int, default=10)
+    arg_parser.add_argument('--repetitions', type=int, default=5)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    random.seed(args.seed)
+    # A rare, a medium and a very common word, as in a typical free text query
+    words = ['w2000', 'w100', 'w1']
+    query = Or([Term(word) for word in words])
+    for size in args.sizes:
+        print(f"\nDocuments: {size}")
+        index = build_index(size)
+        assert index.search_top(query, args.k) == score_all(index, words, args.k)
+
+        avg_time_pruned = measure_average_time(index.search_top, args.repetitions, query, args.k)
+        avg_time_all = measure_average_time(score_all, args.repetitions, index, words, args.k)
+        print(f"MaxScore top {args.k} average time: {avg_time_pruned:.6f} seconds.")
+        print(f"Score all matches average time: {avg_time_all:.6f} seconds.")
+        print(f"Speedup: {avg_time_all / avg_time_pruned:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
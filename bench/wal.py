@@ -0,0 +1,57 @@
+"""
+Benchmark for the write-ahead log: insert throughput at every durability level.
+
+Inserts documents one at a time into a persistent collection, as INSERT commands do,
+and reports inserts per second and the number of fsyncs of the log. Then abandons the
+DB without closing it and measures how long reopening takes to replay the log.
+
+Usage: python -m bench.wal [--documents 5000] [--words-per-doc 20]
+"""
+
+import argparse
+import random
+import tempfile
+import time
+from contextlib import redirect_stdout
+from io import StringIO
+
+from invertedIndex import DB
+from wal import DURABILITY_LEVELS
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    arg_parser.add_argument('--documents', type=int, default=5000)
+    arg_parser.add_argument('--words-per-doc', type=int, default=20)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    random.seed(args.seed)
+    words = [f"word{i}" for i in range(5000)]
+    documents = [random.choices(words, k=args.words_per_doc) for _ in range(args.documents)]
+
+    for durability in DURABILITY_LEVELS:
+        with tempfile.TemporaryDirectory() as data_dir, redirect_stdout(StringIO()):
+            db = DB(data_dir, durability=durability, max_buffer_words=10**9, background_merges=False)
+            db.create_collection('c')
+            start = time.perf_counter()
+            for tokens in documents:
+                db.insert_document('c', tokens)
+            db.wal.sync()
+            elapsed = time.perf_counter() - start
+            syncs, log_size = db.wal.syncs, db.wal.size
+
+            # Crash: reopen without closing, which replays the whole log
+            start = time.perf_counter()
+            recovered = DB(data_dir, background_merges=False)
+            recovery = time.perf_counter() - start
+            assert recovered.collections['c'][0].next_doc_id == args.documents + 1
+            recovered.close()
+            db.wal.close()
+
+        print(f"{durability:6}  {args.documents / elapsed:9.0f} inserts/s   fsyncs: {syncs:6}   "
+              f"log: {log_size / 2**20:6.2f} MiB   recovery: {recovery:.2f} s")
+
+
+if __name__ == '__main__':
+    main()
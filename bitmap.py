@@ -0,0 +1,275 @@
+"""
+Roaring-style sets of document IDs.
+
+IDs are split by their high 16 bits into chunks of 65536, and every chunk is handled on
+its own. `DocIdSet` stores the low 16 bits of the IDs of a chunk in a container: a sorted
+array('H') while the chunk holds at most ARRAY_MAX_SIZE IDs, and a bitmap of 65536 bits
+(a Python int) above that, so sparse chunks take 2 bytes per ID and dense chunks at most
+8 KiB. Unions of bitmaps are single int operations, which run word-parallel in C.
+
+`union`, `intersection` and `difference` combine sorted ID sequences, such as posting
+lists, chunk by chunk. Intersections and differences go through a byte mask of the chunk:
+the IDs of one sequence are scattered into the mask and the other sequence is filtered
+by it, all with itertools and operator functions, so no Python code runs per ID.
+"""
+
+from array import array
+from bisect import bisect_left
+from collections import deque
+from itertools import compress, repeat
+from operator import add, getitem, setitem, sub
+
+# Chunks with more IDs than this are stored as bitmaps, smaller ones as sorted arrays
+ARRAY_MAX_SIZE = 4096
+CHUNK_SIZE = 1 << 16
+# Unions of more IDs than this are built chunk by chunk
+UNION_CHUNKED_SIZE = 4 * CHUNK_SIZE
+# All low bits as int objects, so that gathering them from a mask does not create ints
+_LOW_BITS = list(range(CHUNK_SIZE))
+# Byte masks (one byte of 0 or 1 per low bit) from and to binary digits, for packing bitmaps
+_MASK_TO_DIGITS = bytes.maketrans(b'\x00\x01', b'01')
+_DIGITS_TO_MASK = bytes.maketrans(b'01', b'\x00\x01')
+# Number of set bits of an int (int.bit_count is new in Python 3.10)
+_popcount = getattr(int, 'bit_count', None) or (lambda bits: bin(bits).count('1'))
+
+
+def _chunks(doc_ids):
+
+    """Returns {high bits: slice of the IDs} of the chunks of sorted document IDs"""
+
+    n = len(doc_ids)
+    if n and doc_ids[0] >> 16 == doc_ids[-1] >> 16:
+        return {doc_ids[0] >> 16: doc_ids}
+    chunks, start = {}, 0
+    while start < n:
+        high = doc_ids[start] >> 16
+        end = bisect_left(doc_ids, (high + 1) << 16, start, n)
+        chunks[high] = doc_ids[start:end]
+        start = end
+    return chunks
+
+
+def _low_bits(high, doc_ids):
+    return doc_ids if high == 0 else map(sub, doc_ids, repeat(high << 16))
+
+
+def _scatter(mask, low_bits, value=1):
+    deque(map(setitem, repeat(mask), low_bits, repeat(value)), 0)
+
+
+def _gather(mask, base):
+
+    """Returns the sorted IDs of the set bytes of the mask of a chunk"""
+
+    low_bits = compress(_LOW_BITS, mask)
+    return list(low_bits) if base == 0 else list(map(add, low_bits, repeat(base)))
+
+
+def _pack(low_bits):
+
+    """Returns the bitmap (an int with bit i set for every i) of low bits"""
+
+    mask = bytearray(CHUNK_SIZE)
+    _scatter(mask, low_bits)
+    return int(mask.translate(_MASK_TO_DIGITS)[::-1], 2)
+
+
+def _unpack(bits, size=CHUNK_SIZE):
+
+    """Returns the byte mask of the first `size` bits of a bitmap"""
+
+    return format(bits, f'0{CHUNK_SIZE}b')[:-size - 1:-1].encode('ascii').translate(_DIGITS_TO_MASK)
+
+
+def _container(low_bits, count):
+
+    """Returns the container of `count` sorted low bits, or None if there are none"""
+
+    if not count:
+        return None
+    if count > ARRAY_MAX_SIZE:
+        return _pack(low_bits)
+    return low_bits if isinstance(low_bits, array) and low_bits.typecode == 'H' else array('H', low_bits)
+
+
+def _cardinality(container):
+    return _popcount(container) if isinstance(container, int) else len(container)
+
+
+class DocIdSet:
+
+    """
+    Set of document IDs stored in roaring containers, e.g. the live documents of an index.
+    IDs may be added in increasing order while other threads read the set: the last array
+    is appended to in place, which readers that stop at a limit below the new IDs never
+    notice, and every other change replaces a container with a new one.
+    """
+
+    def __init__(self, doc_ids=()):
+
+        """Builds the set of sorted document IDs"""
+
+        # {high 16 bits: array('H') of sorted low bits, or int bitmap of the low bits}
+        self.containers = {}
+        for high, chunk in _chunks(doc_ids).items():
+            self.containers[high] = _container(_low_bits(high, chunk), len(chunk))
+
+    def add(self, doc_id):
+        high, low = doc_id >> 16, doc_id & 0xFFFF
+        container = self.containers.get(high)
+        if container is None:
+            self.containers[high] = array('H', [low])
+        elif isinstance(container, int):
+            self.containers[high] = container | (1 << low)
+        elif container[-1] < low and len(container) < ARRAY_MAX_SIZE:
+            container.append(low)
+        else:
+            i = bisect_left(container, low)
+            if i == len(container) or container[i] != low:
+                self.containers[high] = _container(container[:i] + array('H', [low]) + container[i:],
+                                                   len(container) + 1)
+
+    def discard(self, doc_id):
+        high, low = doc_id >> 16, doc_id & 0xFFFF
+        if doc_id not in self:
+            return
+        container = self.containers[high]
+        if isinstance(container, int):
+            bits = container & ~(1 << low)
+            count = _popcount(bits)
+            container = bits if count > ARRAY_MAX_SIZE else _container(compress(_LOW_BITS, _unpack(bits)), count)
+        else:
+            i = bisect_left(container, low)
+            container = container[:i] + container[i + 1:] or None
+        if container is None:
+            del self.containers[high]
+        else:
+            self.containers[high] = container
+
+    def __contains__(self, doc_id):
+        container = self.containers.get(doc_id >> 16)
+        if container is None:
+            return False
+        low = doc_id & 0xFFFF
+        if isinstance(container, int):
+            return bool(container >> low & 1)
+        i = bisect_left(container, low)
+        return i < len(container) and container[i] == low
+
+    def __len__(self):
+        return sum(map(_cardinality, list(self.containers.values())))
+
+    def __bool__(self):
+        # Empty containers are removed, so this needs no counting
+        return bool(self.containers)
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __eq__(self, other):
+        return isinstance(other, DocIdSet) and self.to_list() == other.to_list()
+
+    def __repr__(self):
+        return f'DocIdSet({self.to_list()})'
+
+    def __or__(self, other):
+        result = DocIdSet()
+        containers1, containers2 = dict(self.containers), dict(other.containers)
+        for high in containers1.keys() | containers2.keys():
+            container1, container2 = containers1.get(high), containers2.get(high)
+            if container1 is None or container2 is None:
+                container = container1 if container2 is None else container2
+                # Arrays are copied, since the set they came from may still append to them
+                container = container if isinstance(container, int) else array('H', container)
+            elif isinstance(container1, int) or isinstance(container2, int):
+                bits1 = container1 if isinstance(container1, int) else _pack(container1)
+                bits2 = container2 if isinstance(container2, int) else _pack(container2)
+                container = bits1 | bits2
+            else:
+                low_bits = sorted(set(container1).union(container2))
+                container = _container(low_bits, len(low_bits))
+            result.containers[high] = container
+        return result
+
+    def to_list(self, limit=None):
+
+        """Returns the sorted document IDs, only those below `limit` if given"""
+
+        result = []
+        for high, container in sorted(self.containers.items()):
+            base = high << 16
+            size = CHUNK_SIZE if limit is None else min(limit - base, CHUNK_SIZE)
+            if size <= 0:
+                break
+            if isinstance(container, int):
+                result += _gather(_unpack(container, size), base)
+            else:
+                low_bits = container[:bisect_left(container, size)]
+                result += low_bits if base == 0 else map(add, low_bits, repeat(base))
+        return result
+
+    def count_below(self, limit):
+
+        """Returns the number of document IDs below `limit`"""
+
+        count = 0
+        for high, container in sorted(self.containers.items()):
+            base = high << 16
+            if base >= limit:
+                break
+            if isinstance(container, int):
+                count += _popcount(container & ((1 << min(limit - base, CHUNK_SIZE)) - 1))
+            else:
+                count += bisect_left(container, limit - base)
+        return count
+
+
+def union(sequences):
+
+    """Returns the sorted union of sorted document ID sequences. Scattering IDs into a mask
+    costs more per ID than hashing them in CPython, so they are united in sets; large
+    unions in one set per chunk, which stays small enough for the CPU caches."""
+
+    sequences = list(sequences)
+    if sum(map(len, sequences)) <= UNION_CHUNKED_SIZE:
+        return sorted(set().union(*sequences))
+    chunks_by_high = {}
+    for doc_ids in sequences:
+        for high, chunk in _chunks(doc_ids).items():
+            chunks_by_high.setdefault(high, []).append(chunk)
+    result = []
+    for high in sorted(chunks_by_high):
+        result += sorted(set().union(*chunks_by_high[high]))
+    return result
+
+
+def intersection(doc_ids1, doc_ids2):
+
+    """Returns the sorted IDs that are in both sorted sequences"""
+
+    chunks2 = _chunks(doc_ids2)
+    result = []
+    for high, chunk1 in _chunks(doc_ids1).items():
+        chunk2 = chunks2.get(high)
+        if chunk2 is not None:
+            mask = bytearray(CHUNK_SIZE)
+            _scatter(mask, _low_bits(high, chunk1))
+            result += compress(chunk2, map(getitem, repeat(mask), _low_bits(high, chunk2)))
+    return result
+
+
+def difference(doc_ids1, doc_ids2):
+
+    """Returns the sorted IDs of `doc_ids1` that are not in `doc_ids2`"""
+
+    chunks2 = _chunks(doc_ids2)
+    result = []
+    for high, chunk1 in _chunks(doc_ids1).items():
+        chunk2 = chunks2.get(high)
+        if chunk2 is None:
+            result += chunk1
+        else:
+            mask = bytearray(b'\x01') * CHUNK_SIZE
+            _scatter(mask, _low_bits(high, chunk2), 0)
+            result += compress(chunk1, map(getitem, repeat(mask), _low_bits(high, chunk1)))
+    return result
@@ -0,0 +1,198 @@
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+import threading
+from analyzer import Analyzer
+from postings import has_distance
+from query import document_positions
+
+
+class QueryCache:
+
+    """
+    LRU cache of search results for one collection.
+
+    Keys are normalized queries: ('all',), ('word', word), ('range', word1, word2),
+    ('distance', word1, word2, distance) with terms of `analyzer`, and ('query', query)
+    for boolean query.Query trees of terms. Results are sorted
+    document ID arrays. The cache is bounded both by number of entries and by the
+    bytes used by the results; the least recently used entries are evicted first.
+
+    Inserted documents always get the largest document ID so far, so instead of
+    invalidating affected entries, `update` appends the new ID to every cached
+    result the document matches, keeping the results sorted. `remove` takes a
+    deleted document out of every result holding it.
+
+    The entries reflect the documents below `next_doc_id`. Searches that run while
+    documents are inserted pass the document ID limit of the snapshot they search:
+    `get` cuts cached results down to that limit, and `put` drops results of a
+    snapshot that is no longer the one the entries reflect, or that started before
+    the last removal.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=16 * 2**20, analyzer=None, next_doc_id=1):
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Analyzer of the collection, which turns inserted documents into terms
+        self.analyzer = analyzer if analyzer is not None else Analyzer()
+        # Guards the entries against concurrent searches and inserts
+        self.lock = threading.Lock()
+        # First document ID that `update` has not been called for
+        self.next_doc_id = next_doc_id
+        # {key: array of document IDs}, least recently used first
+        self.entries = OrderedDict()
+        self.bytes = 0
+        # {word: set of keys of word and distance queries that use the word}
+        self.keys_by_word = {}
+        # Keys of range and boolean queries, which have to be checked against every inserted document
+        self.range_keys = set()
+        self.query_keys = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.updates = 0
+        # Number of `remove` calls, which tells `put` whether a result may include a deleted document
+        self.removals = 0
+
+    @staticmethod
+    def _entry_bytes(doc_ids):
+        return doc_ids.itemsize * len(doc_ids)
+
+    def get(self, key, limit=None):
+
+        """Returns the cached document IDs below `limit` for `key` as a list, or None.
+        Documents up to `limit` that the cache has not been updated with yet make it a miss."""
+
+        with self.lock:
+            doc_ids = self.entries.get(key)
+            if doc_ids is None or (limit is not None and limit > self.next_doc_id):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            if limit is not None and limit < self.next_doc_id:
+                return list(doc_ids[:bisect_left(doc_ids, limit)])
+            return list(doc_ids)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def put(self, key, doc_ids, as_of=None, removals=None):
+
+        """Caches the sorted document IDs of a query, found among the documents below `as_of`
+        by a search that started when `removals` documents had been removed"""
+
+        with self.lock:
+            if self.max_entries <= 0 or (as_of is not None and as_of != self.next_doc_id):
+                return
+            if removals is not None and removals != self.removals:
+                return
+            if key in self.entries:
+                self._remove(key)
+            doc_ids = array('I', doc_ids)
+            if self._entry_bytes(doc_ids) > self.max_bytes:
+                return  # Too large to cache at all
+
+            self.entries[key] = doc_ids
+            self.bytes += self._entry_bytes(doc_ids)
+            if key[0] == 'range':
+                self.range_keys.add(key)
+            elif key[0] == 'query':
+                self.query_keys.add(key)
+            elif key[0] in ('word', 'distance'):
+                for word in key[1:3] if key[0] == 'distance' else key[1:2]:
+                    self.keys_by_word.setdefault(word, set()).add(key)
+            self._evict()
+
+    def _remove(self, key):
+        doc_ids = self.entries.pop(key)
+        self.bytes -= self._entry_bytes(doc_ids)
+        self.range_keys.discard(key)
+        self.query_keys.discard(key)
+        if key[0] in ('word', 'distance'):
+            for word in key[1:3] if key[0] == 'distance' else key[1:2]:
+                keys = self.keys_by_word.get(word)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.keys_by_word[word]
+
+    def _evict(self):
+        while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def update(self, doc_id, tokens):
+
+        """Adds a newly inserted document to every cached result it matches"""
+
+        with self.lock:
+            self.next_doc_id = max(self.next_doc_id, doc_id + 1)
+            if not self.entries:
+                return
+
+            words = self.analyzer.analyze(tokens)
+            terms = set(words)
+            terms.discard(None)
+            matched = set()
+            if ('all',) in self.entries:
+                matched.add(('all',))
+            for word in terms:
+                matched.update(key for key in self.keys_by_word.get(word, ()) if key[0] == 'word')
+
+            distance_keys = {key for word in terms for key in self.keys_by_word.get(word, ()) if key[0] == 'distance'}
+            if distance_keys or self.query_keys:
+                positions = document_positions(words)
+                for key in distance_keys:
+                    _, word1, word2, distance = key
+                    if word1 in positions and word2 in positions and has_distance(positions[word1], positions[word2], distance):
+                        matched.add(key)
+
+            if self.range_keys:
+                sorted_words = sorted(terms)
+                for key in self.range_keys:
+                    _, word1, word2 = key
+                    i = bisect_left(sorted_words, word1)
+                    if i < len(sorted_words) and sorted_words[i] <= word2:
+                        matched.add(key)
+
+            for key in self.query_keys:
+                if key[1].matches(positions):
+                    matched.add(key)
+
+            for key in matched:
+                self.entries[key].append(doc_id)
+                self.bytes += self.entries[key].itemsize
+                self.updates += 1
+            self._evict()
+
+    def remove(self, doc_id):
+
+        """Removes a deleted document from every cached result"""
+
+        with self.lock:
+            self.removals += 1
+            for doc_ids in self.entries.values():
+                i = bisect_left(doc_ids, doc_id)
+                if i < len(doc_ids) and doc_ids[i] == doc_id:
+                    del doc_ids[i]
+                    self.bytes -= doc_ids.itemsize
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys_by_word.clear()
+            self.range_keys.clear()
+            self.query_keys.clear()
+            self.bytes = 0
+
+    def stats(self):
+
+        """Returns the cache counters"""
+
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'updates': self.updates}
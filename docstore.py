@@ -0,0 +1,156 @@
+"""
+Compressed in-memory document store.
+
+Documents are appended to an open block of UTF-8 text. Once the block holds
+`block_size` bytes it is compressed (zlib or lzma from the standard library) and
+closed. An offset table of sorted document IDs, the offset of every document in its
+block and the first document of every block locates a document with two binary
+searches, so fetching a document decompresses only its own block. Recently used
+blocks are kept decompressed in a small LRU cache, which makes fetches of nearby
+documents (e.g. a page of search results) cost one decompression.
+
+Readers may run while one writer adds documents. The writer only appends to the
+arrays, and replaces the open block together with its start in a single assignment
+after the closed block is in place, so a reader that looks at `open` once finds every
+document either in that open block or in a closed block.
+"""
+
+import lzma
+import threading
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+# Compression codecs: {name: (compress, decompress)}
+CODECS = {
+    'zlib': (zlib.compress, zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+
+
+class BlockStore:
+
+    """Maps document IDs, added in increasing order, to strings kept in compressed blocks"""
+
+    def __init__(self, block_size=4096, codec='zlib', cache_blocks=8):
+
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec '{codec}', expected one of {sorted(CODECS)}.")
+        self.block_size = block_size
+        self.codec = codec
+        self.compress, self.decompress = CODECS[codec]
+        self.cache_blocks = cache_blocks
+
+        # Sorted IDs of all documents
+        self.doc_ids = array('I')
+        # offsets[i] is the offset of document i in the uncompressed text of its block
+        self.offsets = array('I')
+        # block_starts[b] is the index of the first document of closed block b
+        self.block_starts = array('I')
+        # Compressed closed blocks
+        self.blocks = []
+        # Open block: (index of its first document, encoded documents)
+        self.open = (0, [])
+        self.open_size = 0
+        # LRU cache of decompressed blocks: {block number: bytes}, shared by concurrent readers
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+
+    def add(self, doc_id, text):
+
+        """Appends a document"""
+
+        if self.doc_ids and doc_id <= self.doc_ids[-1]:
+            raise ValueError("Document IDs must be added in increasing order.")
+        data = text.encode('utf-8')
+        self.offsets.append(self.open_size)
+        self.open[1].append(data)
+        self.doc_ids.append(doc_id)
+        self.open_size += len(data)
+        if self.open_size >= self.block_size:
+            self.close_block()
+
+    def close_block(self):
+
+        """Compresses the open block"""
+
+        open_start, open_documents = self.open
+        if not open_documents:
+            return
+        self.blocks.append(self.compress(b''.join(open_documents)))
+        self.block_starts.append(open_start)
+        self.open = (len(self.doc_ids), [])
+        self.open_size = 0
+
+    def _block(self, b):
+
+        """Returns the uncompressed text of closed block b, through the LRU cache"""
+
+        with self.cache_lock:
+            data = self.cache.get(b)
+            if data is not None:
+                self.cache.move_to_end(b)
+                return data
+        # Decompressing releases the GIL, so other readers go on meanwhile
+        data = self.decompress(self.blocks[b])
+        with self.cache_lock:
+            self.cache[b] = data
+            if len(self.cache) > self.cache_blocks:
+                self.cache.popitem(last=False)
+        return data
+
+    def _block_end(self, b, open_start):
+
+        """Returns the index of the document after the last one of closed block b,
+        given the start of the open block as seen by the caller"""
+
+        return self.block_starts[b + 1] if b + 1 < len(self.block_starts) else open_start
+
+    def get(self, doc_id):
+
+        """Returns the document with the given ID, or None"""
+
+        open_start, open_documents = self.open
+        i = bisect_left(self.doc_ids, doc_id)
+        if i == len(self.doc_ids) or self.doc_ids[i] != doc_id:
+            return None
+        if i >= open_start:
+            return str(open_documents[i - open_start], 'utf-8')
+        b = bisect_right(self.block_starts, i) - 1
+        data = self._block(b)
+        end = self.offsets[i + 1] if i + 1 < self._block_end(b, open_start) else len(data)
+        return str(data[self.offsets[i]:end], 'utf-8')
+
+    def items(self):
+
+        """Yields (doc_id, document) in document ID order; bypasses the cache"""
+
+        open_start, open_documents = self.open
+        for b in range(bisect_left(self.block_starts, open_start)):
+            data = self.decompress(self.blocks[b])
+            start, end = self.block_starts[b], self._block_end(b, open_start)
+            for i in range(start, end):
+                text_end = self.offsets[i + 1] if i + 1 < end else len(data)
+                yield self.doc_ids[i], str(data[self.offsets[i]:text_end], 'utf-8')
+        for i, data in enumerate(open_documents[:len(self.doc_ids) - open_start], start=open_start):
+            yield self.doc_ids[i], str(data, 'utf-8')
+
+    def without(self, doc_ids):
+
+        """Returns a new store with the same settings holding every document except those in the
+        set `doc_ids`. Blocks are compressed as a whole, so this is how deleted documents give
+        their space back."""
+
+        store = BlockStore(self.block_size, self.codec, self.cache_blocks)
+        for doc_id, text in self.items():
+            if doc_id not in doc_ids:
+                store.add(doc_id, text)
+        return store
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __contains__(self, doc_id):
+        i = bisect_left(self.doc_ids, doc_id)
+        return i < len(self.doc_ids) and self.doc_ids[i] == doc_id
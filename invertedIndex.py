@@ -1,114 +1,653 @@
+import heapq
+import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque, namedtuple
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import filterfalse, islice
+from analyzer import REMOVED, Analyzer
+from bitmap import DocIdSet, difference, union
+from cache import QueryCache
+from docstore import BlockStore
+from metrics import MetricsRegistry, active_profile, phase, touch
+from postings import PostingList, has_distance
+from query import Distance, Range, Term, evaluate, explain
+from ranking import CollectionStats, merge_top_k, top_k
+from segment import Segment, merge_segments, read_manifest, write_deletes, write_manifest, write_segment
+from termindex import KGramIndex, fuzzy_terms, literal_prefix, wildcard_regex
+from wal import SharedLock, WriteAheadLog, sync_directory
+
+# File in the directory of a sharded collection holding its number of shards
+SHARDS_FILE = 'shards'
+# Number of documents read from the document store at a time while iterating over search results
+RESULT_PAGE_SIZE = 100
+# Write-ahead log in the data directory of a DB
+WAL_FILE = 'wal.log'
+# Deleted documents are compacted away once they are this share of the documents of an index or segment
+COMPACT_RATIO = 0.2
+
+
+class PostingsByTerm(Mapping):
+
+    """Read-only {term: PostingList} view of posting lists stored by term ID"""
+
+    def __init__(self, postings, vocabulary):
+        self.postings = postings
+        self.vocabulary = vocabulary
+
+    def __getitem__(self, term):
+        return self.postings[self.vocabulary.ids[term]]
+
+    def get(self, term, default=None):
+        term_id = self.vocabulary.ids.get(term)
+        return default if term_id is None else self.postings.get(term_id, default)
+
+    def __contains__(self, term):
+        term_id = self.vocabulary.ids.get(term)
+        return term_id is not None and term_id in self.postings
+
+    def __iter__(self):
+        terms = self.vocabulary.terms
+        # A copy of the keys, so that a concurrent insert of a new term does not break the iteration
+        return (terms[term_id] for term_id in list(self.postings))
+
+    def __len__(self):
+        return len(self.postings)
+
+
+def _visible(doc_ids, limit, deleted=None):
+
+    """Returns the sorted document IDs below `limit`, leaving out those in the DocIdSet `deleted`"""
+
+    doc_ids = doc_ids[:bisect_left(doc_ids, limit)]
+    if not deleted:
+        return list(doc_ids)
+    if len(doc_ids) < len(deleted):
+        return [doc_id for doc_id in doc_ids if doc_id not in deleted]
+    # Tombstones are sparse, so hashing them beats scattering them into a chunk mask
+    return list(filterfalse(set(deleted.to_list(limit)).__contains__, doc_ids))
+
+
 class InvertedIndex:
 
     """
     Class for implementing an inverted index.
     This structure maps words to document IDs and their positions within those documents.
+    Words are turned into terms by the analyzer, and posting lists are stored by term ID.
+
+    One writer and any number of readers may use the index concurrently without locks.
+    Document IDs only grow and posting lists are append-only, so a writer never changes
+    what a reader has already seen; it only appends. A document becomes visible when the
+    writer publishes the end of the inserted documents in `published` with one assignment,
+    after all of their postings are in place. Every search reads `published` once and
+    ignores the documents after it, so it sees a consistent snapshot of the index.
+
+    Deleting a document only adds its ID to the tombstones in `deleted`, which searches
+    filter out of their results, so a delete costs the same however many words the
+    document has. `compact` later rewrites the posting lists that hold deleted documents
+    and empties `deleted`; searches read `deleted` before any posting list, so they never
+    miss a tombstone whose postings are still there.
     """
 
-    def __init__(self):
+    def __init__(self, analyzer=None):
 
-        # Dictionary: {word: {document_id: [positions]}}
-        self.index = {}
+        self.analyzer = analyzer if analyzer is not None else Analyzer()
+        # Dictionary: {term ID: PostingList}, each posting list behaves like {document_id: [positions]}
+        self.postings = {}
+        # The same posting lists by term: {word: PostingList}
+        self.index = PostingsByTerm(self.postings, self.analyzer.vocabulary)
+        # Sorted list of all words in the index, used for range and prefix queries
+        self.terms = []
+        # Words added since `terms` was last sorted
+        self.new_terms = []
+        # Merging `new_terms` into `terms` happens on reads, which may run concurrently
+        self.terms_lock = threading.Lock()
+        # Dictionary: {document_id: number of words}, for ranking
+        self.doc_lengths = {}
+        self.total_length = 0
+        # IDs of all live documents, for listing them while documents are inserted
+        self.live_docs = DocIdSet()
+        # IDs of the deleted documents whose postings are still in the posting lists
+        self.deleted = DocIdSet()
         # Counter to assign unique IDs to each document
         self.next_doc_id = 1  
+        # (first document ID readers must not see yet, total length of the visible documents)
+        self.published = (1, 0)
 
-    def insert(self, tokens):
+    def insert(self, tokens, doc_id=None):
 
         if not tokens or not isinstance(tokens, list):
             raise ValueError("Invalid input: 'tokens' must be a non-empty list of words.")
         
-        # Generate the document ID
-        doc_id = self.next_doc_id
-        self.next_doc_id += 1  
+        # Generate the document ID, unless the caller assigns IDs (e.g. to shards of a collection)
+        if doc_id is None:
+            doc_id = self.next_doc_id
+        elif doc_id < self.next_doc_id:
+            raise ValueError("Document IDs must be inserted in increasing order.")
+        self.next_doc_id = doc_id + 1
+        self.doc_lengths[doc_id] = len(tokens)
+        self.total_length += len(tokens)
+        self.live_docs.add(doc_id)
+
+        for pos, term_id in enumerate(self.analyzer.term_ids(tokens)):
+            if term_id == REMOVED:
+                continue
+            postings = self.postings.get(term_id)
+            if postings is None:
+                postings = self.postings[term_id] = PostingList()  # Initialize entry for the new term
+                with self.terms_lock:
+                    self.new_terms.append(self.analyzer.vocabulary.terms[term_id])
+
+            postings.add(doc_id, pos)
+        self.publish()
+
+    def insert_many(self, documents, doc_ids=None):
+
+        """Inserts a batch of documents (lists of words) and returns their IDs.
+        Postings for the whole batch are built in plain lists first and then
+        merged into the index once per word."""
+
+        if any(not tokens or not isinstance(tokens, list) for tokens in documents):
+            raise ValueError("Invalid input: every document must be a non-empty list of words.")
+        if doc_ids is None:
+            doc_ids = list(range(self.next_doc_id, self.next_doc_id + len(documents)))
+        elif any(a >= b for a, b in zip([self.next_doc_id - 1] + doc_ids, doc_ids)):
+            raise ValueError("Document IDs must be inserted in increasing order.")
+        if not documents:
+            return doc_ids
+        self.next_doc_id = doc_ids[-1] + 1
+
+        # {term ID: [last doc_id, doc_ids, positions, offsets]} as plain lists for the documents of this batch
+        batch = {}
+        get_entry = batch.get
+        term_ids = self.analyzer.term_ids
+
+        for doc_id, tokens in zip(doc_ids, documents):
+            self.doc_lengths[doc_id] = len(tokens)
+            self.total_length += len(tokens)
+            for pos, term_id in enumerate(term_ids(tokens)):
+                entry = get_entry(term_id)
+                if entry is None:
+                    if term_id == REMOVED:
+                        continue
+                    batch[term_id] = [doc_id, [doc_id], [pos], [0]]
+                else:
+                    if entry[0] != doc_id:
+                        entry[0] = doc_id
+                        entry[1].append(doc_id)
+                        entry[3].append(len(entry[2]))
+                    entry[2].append(pos)
+
+        for term_id, (_, term_doc_ids, positions, offsets) in batch.items():
+            self._append_postings(term_id, PostingList.from_lists(term_doc_ids, offsets, positions))
+        self.live_docs = self.live_docs | DocIdSet(doc_ids)
+        self.publish()
+        return doc_ids
+
+    def append_index(self, other):
+
+        """Appends the postings of another index whose document IDs all follow the ones in this index"""
+
+        for word, postings in other.index.items():
+            self._append_postings(self.analyzer.vocabulary.add(word), postings)
+        self.doc_lengths.update(other.doc_lengths)
+        self.total_length += other.total_length
+        self.live_docs = self.live_docs | other.live_docs
+        self.next_doc_id = max(self.next_doc_id, other.next_doc_id)
+        self.publish()
+
+    def delete(self, doc_id):
+
+        """Deletes a visible document; returns False if there is no such document"""
+
+        if doc_id >= self.visible_doc_id or doc_id not in self.live_docs:
+            return False
+        # Tombstone first: from here on searches leave the document out
+        self.deleted.add(doc_id)
+        self.live_docs.discard(doc_id)
+        self.total_length -= self.doc_lengths[doc_id]
+        self.publish()
+        return True
 
-        for pos, token in enumerate(tokens):
-            token = token.lower()  # Case insensitive
-            if token not in self.index:
-                self.index[token] = {}  # Initialize entry for the new token
+    def needs_compaction(self):
+
+        """Checks whether deleted documents make up COMPACT_RATIO of the documents or more"""
+
+        deleted = len(self.deleted)
+        return deleted > 0 and deleted >= COMPACT_RATIO * (len(self.live_docs) + deleted)
+
+    def compact(self):
+
+        """Removes the postings and lengths of the deleted documents and returns their sorted IDs"""
+
+        removed = self.deleted.to_list()
+        if not removed:
+            return removed
+        removed_ids = set(removed)
+        dropped = set()
+        for term_id, postings in list(self.postings.items()):
+            remaining = postings.without(removed_ids)
+            if not remaining:
+                del self.postings[term_id]
+                dropped.add(self.analyzer.vocabulary.terms[term_id])
+            elif remaining is not postings:
+                self.postings[term_id] = remaining
+        if dropped:
+            terms = [word for word in self.sorted_terms() if word not in dropped]
+            with self.terms_lock:
+                self.terms = terms
+        for doc_id in removed:
+            del self.doc_lengths[doc_id]
+        # Last, so that searches keep filtering the documents until their postings are gone
+        self.deleted = DocIdSet()
+        return removed
+
+    def publish(self):
+
+        """Makes the documents inserted so far visible to searches"""
+
+        self.published = (self.next_doc_id, self.total_length)
+
+    @property
+    def visible_doc_id(self):
+
+        """The first document ID that searches do not see yet"""
+
+        return self.published[0]
+
+    def snapshot(self):
+
+        """Returns a read-only view of the index that keeps seeing only the documents visible now"""
+
+        return IndexSnapshot(self)
+
+    def __getstate__(self):
+
+        """Packs all posting lists into a few flat arrays for pickling.
+        This is much faster than pickling one PostingList object per word,
+        which matters when indexes are sent between processes."""
+
+        terms = self.sorted_terms()
+        doc_counts, position_counts = array('I'), array('I')
+        doc_ids, offsets, positions = array('I'), array('I'), array('I')
+        for word in terms:
+            postings = self.index[word]
+            doc_counts.append(len(postings.doc_ids))
+            position_counts.append(len(postings.positions))
+            doc_ids.extend(postings.doc_ids)
+            offsets.extend(postings.offsets)
+            positions.extend(postings.positions)
+        return {'analyzer': self.analyzer, 'terms': terms, 'next_doc_id': self.next_doc_id, 'doc_counts': doc_counts,
+                'position_counts': position_counts, 'doc_ids': doc_ids, 'offsets': offsets, 'positions': positions,
+                'length_doc_ids': array('I', self.doc_lengths), 'lengths': array('I', self.doc_lengths.values()),
+                'deleted': array('I', self.deleted)}
+
+    def __setstate__(self, state):
+        self.analyzer = state['analyzer']
+        self.postings = {}
+        self.index = PostingsByTerm(self.postings, self.analyzer.vocabulary)
+        self.terms = state['terms']
+        self.new_terms = []
+        self.terms_lock = threading.Lock()
+        self.next_doc_id = state['next_doc_id']
+        self.doc_lengths = dict(zip(state['length_doc_ids'], state['lengths']))
+        self.deleted = DocIdSet(state['deleted'])
+        self.total_length = sum(state['lengths']) - sum(self.doc_lengths[doc_id] for doc_id in state['deleted'])
+        self.live_docs = DocIdSet(difference(state['length_doc_ids'], state['deleted']))
+        self.published = (self.next_doc_id, self.total_length)
+        doc_start = position_start = 0
+        for word, doc_count, position_count in zip(self.terms, state['doc_counts'], state['position_counts']):
+            postings = PostingList()
+            postings.doc_ids = state['doc_ids'][doc_start:doc_start + doc_count]
+            postings.offsets = state['offsets'][doc_start:doc_start + doc_count]
+            postings.positions = state['positions'][position_start:position_start + position_count]
+            self.postings[self.analyzer.vocabulary.add(word)] = postings
+            doc_start += doc_count
+            position_start += position_count
+
+    def _append_postings(self, term_id, postings):
+        existing = self.postings.get(term_id)
+        if existing is None:
+            self.postings[term_id] = postings
+            with self.terms_lock:
+                self.new_terms.append(self.analyzer.vocabulary.terms[term_id])
+        else:
+            existing.extend(postings)
+
+    def sorted_terms(self):
+
+        """Returns the sorted term dictionary, merging in words added since the last call"""
+
+        with self.terms_lock:
+            if self.new_terms:
+                # Both runs are already sorted, so timsort merges them in linear time. The
+                # merged list replaces `terms`, which readers may still be scanning
+                self.new_terms.sort()
+                self.terms = sorted(self.terms + self.new_terms)
+                self.new_terms = []
+            return self.terms
+
+    def terms_in_range(self, keyword1, keyword2):
+
+        """Returns the words between `keyword1` and `keyword2` (inclusive) in sorted order"""
+
+        terms = self.sorted_terms()
+        start = bisect_left(terms, keyword1)
+        end = bisect_right(terms, keyword2)
+        return [terms[i] for i in range(start, end)]
+
+    def terms_with_prefix(self, prefix):
+
+        """Returns the words starting with `prefix` in sorted order"""
+
+        terms = self.sorted_terms()
+        result = []
+        i = bisect_left(terms, prefix)
+        while i < len(terms) and terms[i].startswith(prefix):
+            result.append(terms[i])
+            i += 1
+        return result
 
-            if doc_id not in self.index[token]:
-                self.index[token][doc_id] = [] # Initialize the position list for the document
-            self.index[token][doc_id].append(pos)
+    def _gram_index(self):
+
+        """Returns the k-gram index used for wildcard queries and the term sequence it numbers"""
+
+        vocabulary = self.analyzer.vocabulary
+        return vocabulary.grams, vocabulary.terms
+
+    def terms_matching(self, pattern):
+
+        """Returns the words matching a wildcard pattern (* for any characters, ? for one) in sorted order"""
+
+        prefix = literal_prefix(pattern)
+        if pattern == prefix + '*':
+            # A prefix query: the words are next to each other in the sorted dictionary
+            return self.terms_with_prefix(prefix)
+        regex = wildcard_regex(pattern)
+        grams, terms = self._gram_index()
+        numbers = grams.candidates(terms, pattern)
+        if numbers is None:
+            # No k-gram to look up: scan the words with the literal prefix
+            return [word for word in self.terms_with_prefix(prefix) if regex.fullmatch(word)]
+        return sorted(word for word in map(terms.__getitem__, numbers) if regex.fullmatch(word) and word in self.index)
+
+    def terms_fuzzy(self, word, max_edits):
+
+        """Returns the words within `max_edits` edits of `word` in sorted order"""
+
+        return fuzzy_terms(self.sorted_terms(), word, max_edits)
 
     def print_index(self):
 
         """Prints the index to the screen"""
 
+        removed = set(self.deleted)
         for word, doc_positions in self.index.items():
-            print(f"'{word}': {doc_positions}")
+            doc_positions = doc_positions.without(removed)
+            if doc_positions:
+                print(f"'{word}': {doc_positions}")
     
     def search(self):
 
         """Returns all documents stored in the index"""
 
-        all_docs = set()   
-        for word_docs in self.index.values():
-            all_docs.update(word_docs.keys())
-        return list(all_docs)
+        return self.live_docs.to_list(self.visible_doc_id)
 
     def search_word(self, word):
     
         """Search for documents by a specific word"""
 
         word = word.lower()
-        return list(self.index.get(word, {}).keys())
+        limit, deleted = self.visible_doc_id, self.deleted
+        postings = self.index.get(word)
+        return [] if postings is None else _visible(postings.doc_ids, limit, deleted)
 
     def search_range(self, keyword1, keyword2):
         
         """Search for documents that contain words in the specified range"""
 
         keyword1, keyword2 = keyword1.lower(), keyword2.lower()
-        result_docs = set()
+        return self._union(self.terms_in_range(keyword1, keyword2))
+
+    def search_prefix(self, prefix):
+
+        """Search for documents that contain words starting with the given prefix"""
+
+        prefix = prefix.lower()
+        return self._union(self.terms_with_prefix(prefix))
+
+    def search_wildcard(self, pattern):
+
+        """Search for documents that contain words matching a wildcard pattern"""
+
+        return self._union(self.terms_matching(pattern.lower()))
+
+    def search_fuzzy(self, word, max_edits):
+
+        """Search for documents that contain words within `max_edits` edits of the given word"""
 
-        for word in self.index:
-            if keyword1 <= word <= keyword2:
-                result_docs.update(self.index[word].keys())
-        return list(result_docs)
+        return self._union(self.terms_fuzzy(word.lower(), max_edits))
+
+    def _union(self, words):
+
+        """Returns the visible documents containing any of the words"""
+
+        limit, deleted = self.visible_doc_id, self.deleted
+        doc_id_lists = []
+        for word in words:
+            # Compaction may have dropped a word since the words were listed
+            postings = self.index.get(word)
+            if postings is not None:
+                touch(word, len(postings))
+                doc_id_lists.append(postings.doc_ids)
+        return _visible(union(doc_id_lists), limit, deleted)
 
     def search_distance(self, keyword1, keyword2, exact_distance):
 
         """Searches for documents where two words are separated by a specific distance"""
         
         keyword1, keyword2 = keyword1.lower(), keyword2.lower()
+        limit, deleted = self.visible_doc_id, self.deleted
         result_docs = []
 
-        if keyword1 not in self.index or keyword2 not in self.index:
+        postings1, postings2 = self.index.get(keyword1), self.index.get(keyword2)
+        if postings1 is None or postings2 is None:
             return result_docs
-        
-        for doc_id in self.index[keyword1]:
-            if doc_id in self.index[keyword2]:
-                pos_word1 = self.index[keyword1][doc_id]
-                pos_word2 = self.index[keyword2][doc_id]
 
-                if any(abs(p1 - p2) == exact_distance for p1 in pos_word1 for p2 in pos_word2):
+        touch(keyword1, len(postings1))
+        touch(keyword2, len(postings2))
+        # Walk the smaller posting map and probe the larger one
+        shorter, longer = (postings1, postings2) if len(postings1) <= len(postings2) else (postings2, postings1)
+
+        for doc_id in _visible(shorter.doc_ids, limit, deleted):
+            if doc_id in longer:
+                if has_distance(postings1[doc_id], postings2[doc_id], exact_distance):
                     result_docs.append(doc_id)
 
         return result_docs
 
+    def search_query(self, query):
+
+        """Search for documents matching a boolean query (a query.Query tree)"""
+
+        limit, deleted = self.visible_doc_id, self.deleted
+        return _visible(evaluate(query, self), limit, deleted)
+
+    def explain(self, query):
+
+        """Returns the plan `search_query` follows for a query, as lines of text"""
+
+        return explain(query, self.snapshot())
+
+    def document_length(self, doc_id):
+        return self.doc_lengths[doc_id]
+
+    def ranked_postings(self, word):
+
+        """Returns the posting list of a word in the form ranking reads it, or None"""
+
+        return self.index.get(word)
+
+    def collection_stats(self, words):
+
+        """Returns the ranking statistics of the index for the given words"""
+
+        limit, total_length = self.published
+        document_frequencies = {}
+        for word in words:
+            postings = self.index.get(word)
+            # Deleted documents still count until they are compacted away
+            document_frequencies[word] = 0 if postings is None else bisect_left(postings.doc_ids, limit)
+        return CollectionStats(self.live_docs.count_below(limit), total_length, document_frequencies)
+
+    def search_top(self, query, k, stats=None):
+
+        """Returns [(doc_id, score)] of the `k` documents matching `query` with the highest BM25 scores.
+        `stats` are the statistics of the whole collection when the index holds only a part of it."""
+
+        snapshot = self.snapshot()
+        if stats is None:
+            stats = snapshot.collection_stats(query.ranked_words())
+        return top_k(snapshot, query, k, stats, snapshot.visible_doc_id)
+
+
+class IndexSnapshot(InvertedIndex):
+
+    """
+    Read-only view of an InvertedIndex as it was when the snapshot was taken.
+    The view shares all data with the index, but keeps the `published` limit of that
+    moment, so searches that consist of several steps see the same documents in each.
+    """
+
+    def __init__(self, index):
+
+        self.__dict__.update(index.__dict__)
+        self.source = index
+
+    def insert(self, tokens, doc_id=None):
+        raise ValueError("Snapshots are read-only: documents must be inserted into the index.")
+
+    def insert_many(self, documents, doc_ids=None):
+        raise ValueError("Snapshots are read-only: documents must be inserted into the index.")
+
+    def append_index(self, other):
+        raise ValueError("Snapshots are read-only: documents must be inserted into the index.")
+
+    def delete(self, doc_id):
+        raise ValueError("Snapshots are read-only: documents must be deleted from the index.")
+
+    def compact(self):
+        raise ValueError("Snapshots are read-only: documents must be deleted from the index.")
+
+    def publish(self):
+        raise ValueError("Snapshots are read-only: documents must be inserted into the index.")
+
+    def sorted_terms(self):
+        # Merges publish a new term list and never change one a reader holds, so the index's
+        # current list serves the snapshot; words of later documents match no visible postings
+        return self.source.sorted_terms()
+
+    def snapshot(self):
+        return self
+
+
+def build_index(first_doc_id, documents, analyzer=None):
+
+    """Builds an index of the given documents, numbered from `first_doc_id`"""
+
+    index = InvertedIndex(analyzer)
+    index.next_doc_id = first_doc_id
+    index.insert_many(documents)
+    return index
+
+
+def build_index_parallel(documents, workers=None, chunk_size=10000, analyzer=None):
+
+    """Builds an index of the given documents (lists of words) on a pool of `workers` processes.
+    Every worker indexes a chunk of documents with its own range of document IDs, and the
+    partial indexes are appended in document ID order, so the result equals serial insertion."""
+
+    index = InvertedIndex(analyzer)
+    for _, partial_index in _build_partial_indexes(documents, 1, workers, chunk_size, analyzer):
+        index.append_index(partial_index)
+    return index
+
+
+def _chunks(iterable, size):
+
+    """Splits an iterable into lists of `size` items"""
+
+    iterator = iter(iterable)
+    return iter(lambda: list(islice(iterator, size)), [])
+
+
+def _build_partial_indexes(documents, first_doc_id, workers, chunk_size, analyzer=None):
+
+    """Yields (chunk, index of the chunk) for consecutive chunks of `documents` in order,
+    with the indexes built on a process pool. At most two chunks per worker are in flight,
+    so `documents` may be a long stream."""
+
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()
+        for chunk in _chunks(documents, chunk_size):
+            pending.append((chunk, executor.submit(build_index, first_doc_id, chunk, analyzer)))
+            first_doc_id += len(chunk)
+            if len(pending) >= 2 * workers:
+                chunk, future = pending.popleft()
+                yield chunk, future.result()
+        while pending:
+            chunk, future = pending.popleft()
+            yield chunk, future.result()
+
+
 class FullDocuments:
-    """Class for storing and retrieving full documents"""
+    """Class for storing and retrieving full documents, kept in zlib compressed blocks (see docstore.py)"""
 
-    def __init__(self):
-        # Dictionary: {document_id: document(str)}
-        self.full_text = {}
+    def __init__(self, block_size=4096, codec='zlib', cache_blocks=8):
+        # Compressed store: {document_id: document(str)}
+        self.store = BlockStore(block_size, codec, cache_blocks)
 
     def add_document(self, doc_id, document):
         """Adds a document to the storage"""
-        self.full_text[doc_id] = ' '.join(document)
+        self.store.add(doc_id, ' '.join(document))
 
     def get_document(self, doc_id):
         """Retrieves a document by its ID"""
-        return self.full_text.get(doc_id)
+        return self.store.get(doc_id)
+
+    def get_documents(self, doc_ids):
+        """Retrieves the documents with the given IDs, in the same order"""
+        return [self.store.get(doc_id) for doc_id in doc_ids]
 
     def get_all_documents(self):
         """Retrieves all documents in the storage"""
-        return self.full_text
+        return dict(self.store.items())
+
+    def remove_documents(self, doc_ids):
+        """Removes the documents with the given IDs, giving their space back"""
+        if doc_ids:
+            self.store = self.store.without(set(doc_ids))
+
+    def items(self):
+        """Yields (document_id, document) in document ID order"""
+        return self.store.items()
+
+    def __len__(self):
+        return len(self.store)
 
     def search_word(self, word):
         """Search for full documents containing a specific word"""
         word = word.lower()
         result = []
-        for doc_id, document in self.full_text.items():
+        for doc_id, document in self.items():
             if word in document.lower().split():
                 result.append(document)
         return result
@@ -117,7 +656,7 @@ class FullDocuments:
         """Search for full documents containing words in a specific range"""
         keyword1, keyword2 = keyword1.lower(), keyword2.lower()
         result = []
-        for doc_id, document in self.full_text.items():
+        for doc_id, document in self.items():
             words = set(document.lower().split())
             if any(keyword1 <= word <= keyword2 for word in words):
                 result.append(document)
@@ -127,7 +666,7 @@ class FullDocuments:
         """Search for full documents where two words are separated by a specific distance"""
         keyword1, keyword2 = keyword1.lower(), keyword2.lower()
         result = []
-        for doc_id, document in self.full_text.items():
+        for doc_id, document in self.items():
             words = document.lower().split()
             positions1 = [i for i, word in enumerate(words) if word == keyword1]
             positions2 = [i for i, word in enumerate(words) if word == keyword2]
@@ -137,71 +676,1434 @@ class FullDocuments:
 
 
 
+class SegmentIndex(InvertedIndex):
+
+    """
+    Read-only inverted index over an immutable on-disk segment.
+    The word dictionary and posting lists are read from the memory-mapped segment files.
+    Deletes only add tombstones to `deleted`, which are written to the segment's .del file
+    on the next flush; the documents stay in the segment files until it is rewritten.
+    """
+
+    def __init__(self, segment):
+
+        self.segment = segment
+        self.index = segment.term_dictionary
+        self.terms = segment.term_dictionary.terms
+        self.new_terms = []
+        # K-gram index of the segment's words, built on the first wildcard query
+        self.grams = None
+        doc_ids = segment.documents.doc_ids
+        self.next_doc_id = doc_ids[-1] + 1 if len(doc_ids) else 1
+        self.deleted = DocIdSet(segment.deleted)
+        # Total length of the deleted documents, which no longer count for ranking
+        self.deleted_length = sum(map(segment.documents.length, segment.deleted))
+        # Whether `deleted` holds tombstones that are not in the .del file yet
+        self.dirty = False
+
+    def insert(self, tokens, doc_id=None):
+        raise ValueError("Segments are immutable: new documents must be inserted into the buffer.")
+
+    def delete(self, doc_id):
+        if doc_id not in self.segment.documents or doc_id in self.deleted:
+            return False
+        self.deleted.add(doc_id)
+        self.deleted_length += self.segment.documents.length(doc_id)
+        self.dirty = True
+        return True
+
+    def needs_compaction(self):
+        deleted = len(self.deleted)
+        return deleted > 0 and deleted >= COMPACT_RATIO * len(self.segment.documents)
+
+    def compact(self):
+        raise ValueError("Segments are immutable: they are compacted by rewriting them (see SegmentedIndex).")
+
+    @property
+    def published(self):
+        # Segments never change, so all of their documents are visible
+        return self.next_doc_id, self.segment.documents.total_length
+
+    def snapshot(self):
+        return self
+
+    def sorted_terms(self):
+        return self.terms
+
+    def _gram_index(self):
+        if self.grams is None:
+            self.grams = KGramIndex()
+        return self.grams, self.terms
+
+    def search(self):
+
+        """Returns all documents stored in the segment"""
+
+        return _visible(self.segment.documents.doc_ids, self.next_doc_id, self.deleted)
+
+    def document_length(self, doc_id):
+        return self.segment.documents.length(doc_id)
+
+    def ranked_postings(self, word):
+        return self.index.ranked_postings(word)
+
+    def collection_stats(self, words):
+        documents = self.segment.documents
+        return CollectionStats(len(documents) - len(self.deleted), documents.total_length - self.deleted_length,
+                               {word: self.index.document_frequency(word) for word in words})
+
+
+# What readers of a SegmentedIndex see: the on-disk segments, the buffer and the buffer's documents
+SegmentedView = namedtuple('SegmentedView', ['segments', 'buffer', 'buffer_documents'])
+
+
+class SegmentedIndex:
+
+    """
+    Inverted index of a persistent collection.
+    Documents live in immutable on-disk segments and, until the next flush, in an
+    in-memory buffer (an ordinary InvertedIndex). Each document is stored in exactly
+    one of them, so searches run on every segment and concatenate the results.
+
+    The buffer is flushed to a new segment once it holds `max_buffer_words` words.
+    A background thread merges runs of `merge_factor` adjacent segments of the same
+    size level (levels grow by a factor of `merge_factor`), so a collection of N
+    documents has O(log N) segments and every document is rewritten O(log N) times.
+
+    Readers never take `lock`. Flushes and merges publish a new SegmentedView with one
+    assignment, and a reader works on the view it found when it started, searching the
+    buffer through a snapshot. Segments that a merge replaced are only unmapped once every
+    reader that may still use them has finished (epoch-based reclamation): readers register
+    in the current epoch, every merge starts a new epoch, and the segments it retired are
+    closed when no reader of an earlier epoch is left.
+
+    Deleted documents are tombstoned in the segment or buffer holding them. Merges leave
+    them out, and a segment whose deleted documents reach COMPACT_RATIO of it is rewritten
+    on its own by the merge thread, like a merge of one segment.
+    """
+
+    def __init__(self, directory, max_buffer_words=100000, merge_factor=10, background_merges=True, analyzer=None):
+
+        self.directory = directory
+        self.analyzer = analyzer if analyzer is not None else Analyzer()
+        self.max_buffer_words = max_buffer_words
+        self.merge_factor = merge_factor
+        os.makedirs(directory, exist_ok=True)
+        names = read_manifest(directory)
+        self._remove_unused_files(names)
+        segments = [SegmentIndex(Segment(directory, name)) for name in names]
+        self.next_segment_number = max((int(name.split('_')[1]) for name in names), default=0) + 1
+
+        # The segments and the in-memory buffer segment for documents inserted since the last flush
+        self.view = SegmentedView(segments, self._new_buffer(segments[-1].next_doc_id if segments else 1),
+                                  FullDocuments())
+        self.buffer_words = 0
+        self.documents = SegmentedDocuments(self)
+
+        # Epoch-based reclamation of merged segments: the number of active readers of every
+        # epoch, {epoch: count}, and the segments retired at the start of an epoch, [(epoch, segments)]
+        self.epoch = 0
+        self.readers = {}
+        self.retired = []
+        self.epoch_lock = threading.Lock()
+
+        # Serializes writers, flushes and merges; merges only hold it to publish their result
+        self.lock = threading.RLock()
+        # Serializes merges and compactions, which rewrite segments; taken before `lock`
+        self.merge_lock = threading.Lock()
+        self.merge_needed = threading.Condition(self.lock)
+        self.closed = False
+        self.merge_thread = None
+        if background_merges:
+            self.merge_thread = threading.Thread(target=self._merge_loop, daemon=True)
+            self.merge_thread.start()
+
+    def _remove_unused_files(self, names):
+
+        """Deletes segment files left behind by a flush or merge that did not reach the manifest"""
+
+        for file_name in os.listdir(self.directory):
+            match = re.fullmatch(r'(seg_\d+)\.(terms|postings|docs|del)', file_name)
+            if match and match.group(1) not in names:
+                os.remove(os.path.join(self.directory, file_name))
+
+    def _new_segment_name(self):
+        name = f"seg_{self.next_segment_number:06d}"
+        self.next_segment_number += 1
+        return name
+
+    def _new_buffer(self, next_doc_id):
+        buffer = InvertedIndex(self.analyzer)
+        buffer.next_doc_id = next_doc_id
+        buffer.publish()
+        return buffer
+
+    @property
+    def segments(self):
+        return self.view.segments
+
+    @property
+    def buffer(self):
+        return self.view.buffer
+
+    @property
+    def buffer_documents(self):
+        return self.view.buffer_documents
+
+    @property
+    def next_doc_id(self):
+        return self.buffer.next_doc_id
+
+    @property
+    def visible_doc_id(self):
+        return self.buffer.visible_doc_id
+
+    @contextmanager
+    def reading(self):
+
+        """Context manager giving a reader the current view; its segments stay mapped until the reader leaves"""
+
+        with self.epoch_lock:
+            epoch = self.epoch
+            self.readers[epoch] = self.readers.get(epoch, 0) + 1
+            view = self.view
+        try:
+            yield view
+        finally:
+            with self.epoch_lock:
+                self.readers[epoch] -= 1
+                if not self.readers[epoch]:
+                    del self.readers[epoch]
+                reclaimable = self._reclaimable()
+            self._delete_segments(reclaimable)
+
+    def _retire(self, segments):
+
+        """Starts a new epoch after a merge published a view without `segments`"""
+
+        with self.epoch_lock:
+            self.epoch += 1
+            self.retired.append((self.epoch, segments))
+            reclaimable = self._reclaimable()
+        self._delete_segments(reclaimable)
+
+    def _reclaimable(self):
+
+        """Removes and returns the retired segments that no reader can use any more; needs `epoch_lock`"""
+
+        oldest_reader = min(self.readers, default=self.epoch)
+        reclaimable = [segment for epoch, segments in self.retired if epoch <= oldest_reader for segment in segments]
+        self.retired = [(epoch, segments) for epoch, segments in self.retired if epoch > oldest_reader]
+        return reclaimable
+
+    @staticmethod
+    def _delete_segments(segments):
+        for segment in segments:
+            segment.segment.close()
+            segment.segment.delete_files()
+
+    def insert(self, tokens, doc_id=None):
+        with self.lock:
+            self.buffer.insert(tokens, doc_id)
+            self.buffer_words += len(tokens)
+            if self.buffer_words >= self.max_buffer_words:
+                self.flush()
+
+    def insert_many(self, documents, doc_ids=None):
+        with self.lock:
+            doc_ids = self.buffer.insert_many(documents, doc_ids)
+            self.buffer_words += sum(len(tokens) for tokens in documents)
+            if self.buffer_words >= self.max_buffer_words:
+                self.flush()
+            return doc_ids
+
+    def append_index(self, other):
+        with self.lock:
+            self.buffer.append_index(other)
+            self.buffer_words += sum(len(postings.positions) for postings in other.index.values())
+            if self.buffer_words >= self.max_buffer_words:
+                self.flush()
+
+    def delete(self, doc_id):
+
+        """Deletes a visible document; returns False if there is no such document"""
+
+        with self.lock:
+            if self.buffer.delete(doc_id):
+                return True
+            # Segments hold consecutive ranges of document IDs, oldest first
+            segment = next((segment for segment in self.segments if doc_id < segment.next_doc_id), None)
+            if segment is None or not segment.delete(doc_id):
+                return False
+            if segment.needs_compaction():
+                self.merge_needed.notify()
+            return True
+
+    def flush(self):
+
+        """Writes the tombstones of the segments and the buffer to disk; the buffer becomes a new segment"""
+
+        with self.lock:
+            for segment in self.segments:
+                if segment.dirty:
+                    write_deletes(self.directory, segment.segment.name, segment.deleted.to_list())
+                    segment.dirty = False
+            if not self.buffer_documents:
+                return
+
+            buffer = self.buffer
+            # Deleted documents of the buffer never reach a segment
+            removed = set(buffer.compact())
+            segments = self.segments
+            if buffer.live_docs:
+                name = self._new_segment_name()
+                write_segment(self.directory, name,
+                              ((word, buffer.index[word]) for word in buffer.sorted_terms()),
+                              ((doc_id, document, buffer.doc_lengths[doc_id])
+                               for doc_id, document in self.buffer_documents.items() if doc_id not in removed))
+                segments = segments + [SegmentIndex(Segment(self.directory, name))]
+                write_manifest(self.directory, [segment.segment.name for segment in segments])
+
+            # Readers switch from the buffer to the new segment at once
+            self.view = SegmentedView(segments, self._new_buffer(buffer.next_doc_id), FullDocuments())
+            self.buffer_words = 0
+            self.merge_needed.notify()
+
+    def _size_level(self, segment):
+
+        """Returns floor(log_merge_factor(number of documents in the segment))"""
+
+        size, level = len(segment.segment.documents), 0
+        while size >= self.merge_factor:
+            size //= self.merge_factor
+            level += 1
+        return level
+
+    def find_merge(self):
+
+        """Returns the oldest run of `merge_factor` adjacent segments on the same size level, or None"""
+
+        segments = self.segments
+        run_start = 0
+        for i in range(len(segments)):
+            if self._size_level(segments[i]) != self._size_level(segments[run_start]):
+                run_start = i
+            if i + 1 - run_start == self.merge_factor:
+                return segments[run_start:i + 1]
+        return None
+
+    def find_compaction(self):
+
+        """Returns [segment] for the oldest segment whose deleted documents reach COMPACT_RATIO of it, or None"""
+
+        for segment in self.segments:
+            if segment.needs_compaction():
+                return [segment]
+        return None
+
+    def merge(self):
+
+        """Merges one run of segments chosen by `find_merge`, or else rewrites the segment chosen by
+        `find_compaction`; returns False if there was nothing to do"""
+
+        with self.merge_lock:
+            with self.lock:
+                run = self.find_merge() or self.find_compaction()
+            if run is None:
+                return False
+            self._rewrite(run)
+            return True
+
+    def compact(self):
+
+        """Rewrites every segment with deleted documents and drops the deleted documents of the buffer;
+        returns the sorted IDs of the removed documents"""
+
+        removed = []
+        with self.merge_lock:
+            for segment in list(self.segments):
+                if segment.deleted:
+                    removed += self._rewrite([segment])
+        with self.lock:
+            buffer_removed = self.buffer.compact()
+            self.buffer_documents.remove_documents(buffer_removed)
+        return removed + buffer_removed
+
+    def _rewrite(self, run):
+
+        """Replaces a run of adjacent segments with one segment of their documents that are not deleted
+        (none if all are); needs `merge_lock`. Returns the sorted IDs of the documents left out."""
+
+        with self.lock:
+            name = self._new_segment_name()
+            removed = [segment.deleted.to_list() for segment in run]
+
+        # Segments are immutable, so the merged segment is written without holding the lock
+        merge_segments(self.directory, name, [segment.segment for segment in run], removed)
+        merged = SegmentIndex(Segment(self.directory, name))
+
+        with self.lock:
+            # Documents deleted while the merged segment was written are deleted from it instead
+            for segment, segment_removed in zip(run, removed):
+                for doc_id in difference(segment.deleted.to_list(), segment_removed):
+                    merged.delete(doc_id)
+            # Flushes only append, so the run is still adjacent in the current list
+            segments = self.segments
+            start = segments.index(run[0])
+            kept = [merged] if len(merged.segment.documents) else []
+            segments = segments[:start] + kept + segments[start + len(run):]
+            write_manifest(self.directory, [segment.segment.name for segment in segments])
+            self.view = self.view._replace(segments=segments)
+        # Readers that started before may still search the merged segments
+        self._retire(run if kept else run + [merged])
+        return [doc_id for segment_removed in removed for doc_id in segment_removed]
+
+    def _merge_loop(self):
+        while True:
+            with self.lock:
+                while not self.closed and self.find_merge() is None and self.find_compaction() is None:
+                    self.merge_needed.wait()
+                if self.closed:
+                    return
+            self.merge()
+
+    def close(self):
+
+        """Stops background merging, flushes the buffer and unmaps all segment files"""
+
+        with self.lock:
+            self.closed = True
+            self.merge_needed.notify()
+        if self.merge_thread is not None:
+            self.merge_thread.join()
+        with self.lock:
+            self.flush()
+            with self.epoch_lock:
+                retired = [segment for _, segments in self.retired for segment in segments]
+                self.retired = []
+            self._delete_segments(retired)
+            for segment in self.segments:
+                segment.segment.close()
+            self.view = self.view._replace(segments=[])
+
+    @contextmanager
+    def reading_parts(self):
+
+        """Context manager giving a reader the on-disk segments followed by a snapshot of the buffer,
+        in document ID order"""
+
+        with self.reading() as view:
+            yield view.segments + [view.buffer.snapshot()]
+
+    def postings(self, word):
+
+        """Returns the posting list of a word across all segments"""
+
+        word = word.lower()
+        result = PostingList()
+        with self.reading_parts() as parts:
+            for part in parts:
+                deleted = part.deleted
+                postings = part.index.get(word)
+                if postings is not None:
+                    # The buffer may hold postings of documents that are not visible yet
+                    end = bisect_left(postings.doc_ids, part.visible_doc_id)
+                    if end < len(postings.doc_ids):
+                        postings = PostingList.from_lists(postings.doc_ids[:end], postings.offsets[:end],
+                                                          postings.positions[:postings.offsets[end]])
+                    result.extend(postings.without(set(deleted)) if deleted else postings)
+        return result
+
+    def explain(self, query):
+
+        """Returns the plan of a query on every segment and on the buffer, as lines of text"""
+
+        lines = []
+        with self.reading_parts() as parts:
+            for part in parts:
+                lines.append(f"{part.segment.name if isinstance(part, SegmentIndex) else 'buffer'}:")
+                lines += ['  ' + line for line in part.explain(query)]
+        return lines
+
+    def sorted_terms(self):
+
+        """Returns the sorted words of all segments"""
+
+        terms = []
+        with self.reading_parts() as parts:
+            for word in heapq.merge(*(part.sorted_terms() for part in parts)):
+                if not terms or terms[-1] != word:
+                    terms.append(word)
+        return terms
+
+    def print_index(self):
+
+        """Prints the index to the screen"""
+
+        for word in self.sorted_terms():
+            postings = self.postings(word)
+            if postings:
+                print(f"'{word}': {postings}")
+
+    def search(self):
+        with self.reading_parts() as parts:
+            return [doc_id for part in parts for doc_id in part.search()]
+
+    def search_word(self, word):
+        with self.reading_parts() as parts:
+            return [doc_id for part in parts for doc_id in part.search_word(word)]
+
+    def search_range(self, keyword1, keyword2):
+        with self.reading_parts() as parts:
+            return [doc_id for part in parts for doc_id in part.search_range(keyword1, keyword2)]
+
+    def search_prefix(self, prefix):
+        with self.reading_parts() as parts:
+            return [doc_id for part in parts for doc_id in part.search_prefix(prefix)]
+
+    def search_wildcard(self, pattern):
+        with self.reading_parts() as parts:
+            return [doc_id for part in parts for doc_id in part.search_wildcard(pattern)]
+
+    def search_fuzzy(self, word, max_edits):
+        with self.reading_parts() as parts:
+            return [doc_id for part in parts for doc_id in part.search_fuzzy(word, max_edits)]
+
+    def search_distance(self, keyword1, keyword2, exact_distance):
+        with self.reading_parts() as parts:
+            return [doc_id for part in parts for doc_id in part.search_distance(keyword1, keyword2, exact_distance)]
+
+    def search_query(self, query):
+        with self.reading_parts() as parts:
+            return [doc_id for part in parts for doc_id in part.search_query(query)]
+
+    def collection_stats(self, words):
+        with self.reading_parts() as parts:
+            return sum((part.collection_stats(words) for part in parts), CollectionStats())
+
+    def search_top(self, query, k, stats=None):
+        with self.reading_parts() as parts:
+            if stats is None:
+                stats = sum((part.collection_stats(query.ranked_words()) for part in parts), CollectionStats())
+            return merge_top_k([part.search_top(query, k, stats) for part in parts], k)
+
+
+class SegmentedDocuments:
+
+    """Full documents of a persistent collection, stored next to its SegmentedIndex"""
+
+    def __init__(self, index):
+        self.index = index
+
+    def add_document(self, doc_id, document):
+        """Adds a document to the in-memory buffer"""
+        self.index.buffer_documents.add_document(doc_id, document)
+
+    @staticmethod
+    def _find(view, doc_id):
+        document = view.buffer_documents.get_document(doc_id)
+        if document is None:
+            for segment in reversed(view.segments):
+                document = segment.segment.documents.get_document(doc_id)
+                if document is not None:
+                    break
+        return document
+
+    def get_document(self, doc_id):
+        """Retrieves a document by its ID"""
+        with self.index.reading() as view:
+            return self._find(view, doc_id)
+
+    def get_documents(self, doc_ids):
+        """Retrieves the documents with the given IDs, in the same order"""
+        with self.index.reading() as view:
+            return [self._find(view, doc_id) for doc_id in doc_ids]
+
+    def get_all_documents(self):
+        """Retrieves all documents in the storage"""
+        documents = {}
+        with self.index.reading() as view:
+            for segment in view.segments:
+                documents.update(item for item in segment.segment.documents.items() if item[0] not in segment.deleted)
+            documents.update(item for item in view.buffer_documents.items() if item[0] not in view.buffer.deleted)
+        return documents
+
+
+class Shard:
+
+    """
+    One shard of a sharded collection: an index and the full documents assigned to it.
+    Persistent shards keep their segments in their own directory.
+    """
+
+    def __init__(self, directory=None, segment_options=None, analyzer=None):
+
+        if directory is None:
+            self.index, self.documents = InvertedIndex(analyzer), FullDocuments()
+        else:
+            self.index = SegmentedIndex(directory, analyzer=analyzer, **(segment_options or {}))
+            self.documents = self.index.documents
+        self.result = None
+
+    def next_doc_id(self):
+        return self.index.next_doc_id
+
+    def insert_many(self, documents, doc_ids, full_documents):
+
+        """Stores `full_documents` [(doc_id, document)] and indexes `documents` under `doc_ids`"""
+
+        for doc_id, document in full_documents:
+            self.documents.add_document(doc_id, document)
+        return self.index.insert_many(documents, doc_ids)
+
+    def get_documents(self, doc_ids):
+        return self.documents.get_documents(doc_ids)
+
+    def get_all_documents(self):
+        return self.documents.get_all_documents()
+
+    def delete(self, doc_id):
+
+        """Deletes a document; in-memory shards are compacted once enough of their documents are deleted"""
+
+        deleted = self.index.delete(doc_id)
+        if deleted and isinstance(self.index, InvertedIndex) and self.index.needs_compaction():
+            self.compact()
+        return deleted
+
+    def compact(self):
+        removed = self.index.compact()
+        if isinstance(self.index, InvertedIndex):
+            self.documents.remove_documents(removed)
+        return removed
+
+    def postings_by_word(self):
+
+        """Returns {word: PostingList} for every word in the shard"""
+
+        if isinstance(self.index, SegmentedIndex):
+            return {word: self.index.postings(word) for word in self.index.sorted_terms()}
+        removed = set(self.index.deleted)
+        postings_by_word = {word: self.index.index[word].without(removed) for word in self.index.sorted_terms()}
+        return {word: postings for word, postings in postings_by_word.items() if postings}
+
+    def search(self, method, *args):
+
+        """Runs one of the search methods of the index"""
+
+        return getattr(self.index, method)(*args)
+
+    def flush(self):
+        if isinstance(self.index, SegmentedIndex):
+            self.index.flush()
+
+    def close(self):
+        if isinstance(self.index, SegmentedIndex):
+            self.index.close()
+
+    # Shards held in this process answer immediately; see ShardProcess for the same interface across processes
+    def send(self, method, *args):
+        try:
+            self.result = (True, getattr(self, method)(*args))
+        except Exception as e:
+            self.result = (False, e)
+
+    def receive(self):
+        return self.result
+
+
+class ShardProcess:
+
+    """Holds a Shard in a worker process and forwards method calls to it over a pipe"""
+
+    def __init__(self, directory=None, segment_options=None, analyzer=None):
+
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_run_shard, args=(child_connection, directory, segment_options, analyzer),
+                                               daemon=True)
+        self.process.start()
+        child_connection.close()
+
+    def send(self, method, *args):
+        self.connection.send((method, args))
+
+    def receive(self):
+
+        """Returns (True, result) or (False, exception) for the oldest call sent"""
+
+        return self.connection.recv()
+
+
+def _run_shard(connection, directory, segment_options, analyzer):
+
+    """Main loop of a shard worker process"""
+
+    shard = Shard(directory, segment_options, analyzer)
+    while True:
+        method, args = connection.recv()
+        shard.send(method, *args)
+        connection.send(shard.receive())
+        if method == 'close':
+            break
+
+
+class ShardedIndex:
+
+    """
+    Inverted index of a collection split into shards by document ID hash.
+    Every shard holds its own index and full documents, optionally in a worker process.
+    Searches are sent to all shards at once (scatter) and their sorted results are merged
+    into one list in document ID order (gather), so shards in separate processes work in parallel.
+    """
+
+    def __init__(self, num_shards, directory=None, processes=True, segment_options=None, analyzer=None):
+
+        # Analyzes queries; every shard analyzes its documents with a copy of it
+        self.analyzer = analyzer if analyzer is not None else Analyzer()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, SHARDS_FILE), 'w') as file:
+                file.write(f"{num_shards}\n")
+
+        shard_class = ShardProcess if processes else Shard
+        self.shards = [shard_class(None if directory is None else os.path.join(directory, f"shard_{i}"), segment_options,
+                                   self.analyzer)
+                       for i in range(num_shards)]
+        # Documents added to the store but not yet sent to their shard: [[(doc_id, document)] for each shard]
+        self.pending_documents = [[] for _ in self.shards]
+        # Keeps the calls of concurrent threads from interleaving on the shard pipes
+        self.lock = threading.Lock()
+        self.next_doc_id = max(self._scatter('next_doc_id'))
+        self.documents = ShardedDocuments(self)
+
+    @property
+    def visible_doc_id(self):
+        # Searches wait for an insert to finish on the shard pipes, so what is inserted is visible
+        return self.next_doc_id
+
+    def shard_of(self, doc_id):
+        return hash(doc_id) % len(self.shards)
+
+    def call_shards(self, calls):
+
+        """Runs (shard number, method, args) calls and returns their results in order.
+        All calls are sent before any result is read, so worker processes run them in parallel."""
+
+        with self.lock:
+            for i, method, args in calls:
+                self.shards[i].send(method, *args)
+            results = [self.shards[i].receive() for i, _, _ in calls]
+        for ok, result in results:
+            if not ok:
+                raise result
+        return [result for _, result in results]
+
+    def _scatter(self, method, *args):
+        return self.call_shards([(i, method, args) for i in range(len(self.shards))])
+
+    def insert(self, tokens, doc_id=None):
+        self.insert_many([tokens], None if doc_id is None else [doc_id])
+
+    def insert_many(self, documents, doc_ids=None):
+        if any(not tokens or not isinstance(tokens, list) for tokens in documents):
+            raise ValueError("Invalid input: every document must be a non-empty list of words.")
+        if doc_ids is None:
+            doc_ids = list(range(self.next_doc_id, self.next_doc_id + len(documents)))
+        if not documents:
+            return doc_ids
+
+        # Split the batch by shard and send every shard its part
+        batches = {}
+        for doc_id, tokens in zip(doc_ids, documents):
+            shard_documents, shard_doc_ids = batches.setdefault(self.shard_of(doc_id), ([], []))
+            shard_documents.append(tokens)
+            shard_doc_ids.append(doc_id)
+        calls = []
+        for i, (shard_documents, shard_doc_ids) in batches.items():
+            calls.append((i, 'insert_many', (shard_documents, shard_doc_ids, self.pending_documents[i])))
+            self.pending_documents[i] = []
+        self.call_shards(calls)
+
+        self.next_doc_id = max(self.next_doc_id, doc_ids[-1] + 1)
+        return doc_ids
+
+    def delete(self, doc_id):
+        return self.call_shards([(self.shard_of(doc_id), 'delete', (doc_id,))])[0]
+
+    def compact(self):
+        return list(heapq.merge(*self._scatter('compact')))
+
+    def _gather(self, method, *args):
+        return list(heapq.merge(*self._scatter('search', method, *args)))
+
+    def search(self):
+        return self._gather('search')
+
+    def search_word(self, word):
+        return self._gather('search_word', word)
+
+    def search_range(self, keyword1, keyword2):
+        return self._gather('search_range', keyword1, keyword2)
+
+    def search_prefix(self, prefix):
+        return self._gather('search_prefix', prefix)
+
+    def search_wildcard(self, pattern):
+        return self._gather('search_wildcard', pattern)
+
+    def search_fuzzy(self, word, max_edits):
+        return self._gather('search_fuzzy', word, max_edits)
+
+    def search_distance(self, keyword1, keyword2, exact_distance):
+        return self._gather('search_distance', keyword1, keyword2, exact_distance)
+
+    def search_query(self, query):
+        return self._gather('search_query', query)
+
+    def explain(self, query):
+
+        """Returns the plan of a query on every shard, as lines of text"""
+
+        lines = []
+        for i, shard_lines in enumerate(self._scatter('search', 'explain', query)):
+            lines.append(f"shard {i}:")
+            lines += ['  ' + line for line in shard_lines]
+        return lines
+
+    def search_top(self, query, k):
+
+        """Ranks the documents of every shard with the statistics of the whole collection
+        and merges the top `k` of every shard"""
+
+        stats = sum(self._scatter('search', 'collection_stats', query.ranked_words()), CollectionStats())
+        return merge_top_k(self._scatter('search', 'search_top', query, k, stats), k)
+
+    def print_index(self):
+
+        """Prints the index to the screen, merging the posting lists of all shards"""
+
+        shard_postings = self._scatter('postings_by_word')
+        for word in sorted(set().union(*shard_postings)):
+            items = heapq.merge(*(postings[word].items() for postings in shard_postings if word in postings))
+            print(f"'{word}': " + '{' + ', '.join(f"{doc_id}: {list(positions)}" for doc_id, positions in items) + '}')
+
+    def flush(self):
+        self._scatter('flush')
+
+    def close(self):
+
+        """Flushes persistent shards and stops the worker processes"""
+
+        self._scatter('close')
+        for shard in self.shards:
+            if isinstance(shard, ShardProcess):
+                shard.process.join()
+
+
+class ShardedDocuments:
+
+    """Full documents of a sharded collection, stored in the shard of their document ID"""
+
+    def __init__(self, index):
+        self.index = index
+
+    def add_document(self, doc_id, document):
+        """Adds a document; it is sent to its shard together with the next insert"""
+        self.index.pending_documents[self.index.shard_of(doc_id)].append((doc_id, document))
+
+    def get_document(self, doc_id):
+        """Retrieves a document by its ID"""
+        return self.get_documents([doc_id])[0]
+
+    def get_documents(self, doc_ids):
+        """Retrieves the documents with the given IDs from their shards, in the same order"""
+        ids_by_shard = {}
+        for doc_id in doc_ids:
+            ids_by_shard.setdefault(self.index.shard_of(doc_id), []).append(doc_id)
+        results = self.index.call_shards([(i, 'get_documents', (ids,)) for i, ids in ids_by_shard.items()])
+        documents = {}
+        for ids, shard_documents in zip(ids_by_shard.values(), results):
+            documents.update(zip(ids, shard_documents))
+        return [documents[doc_id] for doc_id in doc_ids]
+
+    def get_all_documents(self):
+        """Retrieves all documents in the storage"""
+        documents = {}
+        for shard_documents in self.index._scatter('get_all_documents'):
+            documents.update(shard_documents)
+        return dict(sorted(documents.items()))
+
+
 class DB:
-    """Class for managing collections of documents"""
+    """
+    Class for managing collections of documents.
+
+    Searches may run in any number of threads while documents are inserted: they see the
+    documents that were completely inserted when they started (see InvertedIndex) and never
+    wait for writers. Writers of one collection take turns on its lock in `write_locks`, so
+    inserts into different collections run concurrently.
 
-    def __init__(self):
+    `metrics` counts commands, inserted and deleted documents and cache lookups per collection and keeps
+    histograms of command latencies (see metrics.py).
+    """
+
+    def __init__(self, data_dir=None, shard_processes=True, cache_entries=1024, cache_bytes=16 * 2**20,
+                 analyzer=None, durability='group', checkpoint_bytes=64 * 2**20, **segment_options):
         # Dictionary for storing collections: {collection_name: (InvertedIndex, FullDocuments)}
         self.collections = {}
+        # Search result cache of every collection: {collection_name: QueryCache}
+        self.caches = {}
+        # Limits of each result cache (number of queries and bytes of cached document IDs)
+        self.cache_entries = cache_entries
+        self.cache_bytes = cache_bytes
+        # Directory with one subdirectory of segment files per collection; None keeps collections in memory only
+        self.data_dir = data_dir
+        # Whether the shards of sharded collections run in worker processes
+        self.shard_processes = shard_processes
+        # Keyword arguments for SegmentedIndex (max_buffer_words, merge_factor, background_merges)
+        self.segment_options = segment_options
+        # Text analysis of all collections (see analyzer.py). It is not stored with persistent
+        # collections, so they must be reopened with the same stopwords and stemmer.
+        self.analyzer = analyzer if analyzer is not None else Analyzer()
+        # Write-ahead log of the operations since the last checkpoint (see wal.py), which is
+        # taken once the log grows beyond `checkpoint_bytes`; None without a data directory
+        self.wal = None
+        self.checkpoint_bytes = checkpoint_bytes
+        # Writer lock of every collection: {collection_name: Lock}; `lock` guards creating collections
+        self.write_locks = {}
+        self.lock = threading.Lock()
+        # Held shared by every logged operation until it is applied, and alone by checkpoints
+        self.operations = SharedLock()
+        self.metrics = MetricsRegistry()
+        self.metrics.describe('oaa_commands_total', "Commands run, by type, collection and status")
+        self.metrics.describe('oaa_command_duration_seconds', "Latency of commands, by type and collection")
+        self.metrics.describe('oaa_documents_inserted_total', "Documents inserted, by collection")
+        self.metrics.describe('oaa_documents_deleted_total', "Documents deleted, by collection")
+        self.metrics.describe('oaa_cache_lookups_total', "Result cache lookups, by collection and result")
+
+        if data_dir is not None:
+            os.makedirs(data_dir, exist_ok=True)
+            for name in sorted(os.listdir(data_dir)):
+                directory = os.path.join(data_dir, name)
+                if os.path.isdir(directory):
+                    self._add_collection(name, self._new_collection(name, read_shard_count(directory)))
+            self.wal = WriteAheadLog(os.path.join(data_dir, WAL_FILE), durability)
+            self.recover()
+
+    def _new_collection(self, name, num_shards=1):
+        directory = None if self.data_dir is None else os.path.join(self.data_dir, name)
+        if num_shards > 1:
+            inverted_index = ShardedIndex(num_shards, directory, self.shard_processes, self.segment_options, self.analyzer)
+            return inverted_index, inverted_index.documents
+        if directory is None:
+            return InvertedIndex(self.analyzer), FullDocuments()
+        inverted_index = SegmentedIndex(directory, analyzer=self.analyzer, **self.segment_options)
+        return inverted_index, inverted_index.documents
+
+    def _add_collection(self, name, collection):
+
+        """Registers a collection; its cache and writer lock are in place before other threads can find it"""
+
+        self.caches[name] = QueryCache(self.cache_entries, self.cache_bytes, self.analyzer, collection[0].visible_doc_id)
+        self.write_locks[name] = threading.Lock()
+        self.collections[name] = collection
+
+    def create_collection(self, name, num_shards=1):
+
+        """Creates a collection and returns True; returns None, after printing why, if it cannot be created"""
+
+        with self.lock:
+            if name in self.collections:
+                print(f"Collection '{name}' already exists.")
+            elif num_shards < 1:
+                print(f"Collection '{name}' needs at least one shard.")
+            else:
+                with self.operations.hold_shared():
+                    self._log(('create', name, num_shards))
+                    self._add_collection(name, self._new_collection(name, num_shards))
+                print(f"Collection '{name}' created" + (f" with {num_shards} shards." if num_shards > 1 else "."))
+                return True
+
+    def flush(self):
+
+        """Writes the documents inserted since the last flush of every persistent collection to disk"""
+
+        with self.operations.hold_exclusive():
+            self._flush()
+
+    def _flush(self):
+        for inverted_index, _ in list(self.collections.values()):
+            if isinstance(inverted_index, (SegmentedIndex, ShardedIndex)):
+                inverted_index.flush()
+
+    def close(self):
+
+        """Flushes and closes all persistent collections and stops shard worker processes"""
+
+        if self.wal is not None:
+            self.checkpoint()
+        for inverted_index, _ in list(self.collections.values()):
+            if isinstance(inverted_index, (SegmentedIndex, ShardedIndex)):
+                inverted_index.close()
+        if self.wal is not None:
+            self.wal.close()
+
+    def _log(self, record):
+
+        """Appends an operation to the write-ahead log before it is applied"""
+
+        if self.wal is not None:
+            self.wal.append(record)
+
+    def _maybe_checkpoint(self):
+        if self.wal is not None and self.wal.size >= self.checkpoint_bytes:
+            self.checkpoint()
+
+    def checkpoint(self):
+
+        """Writes every persistent collection to disk and empties the write-ahead log,
+        so that recovery only has to replay the operations logged after this point"""
+
+        with self.operations.hold_exclusive():
+            self._flush()
+            if self.wal is None:
+                return
+            for name in list(self.collections):
+                sync_directory(os.path.join(self.data_dir, name))
+            sync_directory(self.data_dir)
+            self.wal.truncate()
+
+    def recover(self):
+
+        """Replays the operations logged since the last checkpoint and returns their number.
+        Documents that reached a segment before the crash are skipped, so replaying is idempotent.
+        Records that cannot be applied are reported and skipped, so they never keep the DB from opening."""
+
+        records = list(self.wal.records())
+        # Documents deleted later in the log, which a compaction may already have removed from the segments
+        deleted = {(record[1], record[2]) for record in records if record[0] == 'delete'}
+        replayed = 0
+        for number, record in enumerate(records, 1):
+            try:
+                self._replay(record, deleted)
+            except (KeyError, ValueError) as e:
+                print(f"Skipped write-ahead log record {number} ({record[0]} in collection '{record[1]}'): {e}")
+                continue
+            replayed += 1
+        if records:
+            # Also empties the log of the skipped records
+            self.checkpoint()
+            # The caches are still empty, but have to start after the replayed documents
+            for name, (inverted_index, _) in self.collections.items():
+                self.caches[name].next_doc_id = inverted_index.visible_doc_id
+        return replayed
+
+    def _replay(self, record, deleted):
 
-    def create_collection(self, name):
-        if name in self.collections:
-            print(f"Collection '{name}' already exists.")
+        """Applies one record of the write-ahead log; `deleted` holds the (collection, doc_id) of every logged delete"""
+
+        if record[0] == 'create':
+            _, name, num_shards = record
+            if name not in self.collections:
+                self._add_collection(name, self._new_collection(name, num_shards))
+        elif record[0] == 'delete':
+            _, name, doc_id = record
+            self.collections[name][0].delete(doc_id)
         else:
-            self.collections[name] = (InvertedIndex(), FullDocuments())
-            print(f"Collection '{name}' created.")
+            _, name, first_doc_id, documents = record
+            # Checked before anything is stored (logs of older versions may hold empty documents)
+            _check_documents(documents)
+            inverted_index, full_documents = self.collections[name]
+            doc_ids = range(first_doc_id, first_doc_id + len(documents))
+            stored_ids = [doc_id for doc_id in doc_ids if doc_id < inverted_index.next_doc_id]
+            stored = {doc_id for doc_id, document in zip(stored_ids, full_documents.get_documents(stored_ids))
+                      if document is not None}
+            missing = [(doc_id, tokens) for doc_id, tokens in zip(doc_ids, documents)
+                       if doc_id not in stored and not (doc_id < inverted_index.next_doc_id and (name, doc_id) in deleted)]
+            for doc_id, tokens in missing:
+                full_documents.add_document(doc_id, tokens)
+            if missing:
+                inverted_index.insert_many([tokens for _, tokens in missing], [doc_id for doc_id, _ in missing])
 
     def insert_document(self, collection_name, document):
+
+        """Inserts a document and returns its ID; returns None, after printing why, if the collection does not exist"""
+
+        if collection_name in self.collections:
+            with self.write_locks[collection_name], self.operations.hold_shared():
+                doc_id = self._insert(collection_name, document)
+            self.metrics.increment('oaa_documents_inserted_total', collection=collection_name)
+            self._maybe_checkpoint()
+            print(f"Document added to collection '{collection_name}' with ID {doc_id}.")
+            return doc_id
+        else:
+            print(f"Collection '{collection_name}' not found.")
+
+    def _insert(self, collection_name, document):
+
+        """Logs, stores and indexes one document and returns its ID; needs the writer lock of the collection"""
+
+        _check_documents([document])
+        inverted_index, full_documents = self.collections[collection_name]
+        doc_id = inverted_index.next_doc_id
+        self._log(('insert', collection_name, doc_id, [document]))
+        # The document is stored before the index publishes it to searches
+        full_documents.add_document(doc_id, document)
+
+        inverted_index.insert(document)
+        self.caches[collection_name].update(doc_id, document)
+        return doc_id
+
+    def delete_document(self, collection_name, doc_id):
+
+        """Deletes a document and returns True; returns None, after printing why, if it does not exist"""
+
+        if collection_name in self.collections:
+            with self.write_locks[collection_name], self.operations.hold_shared():
+                deleted = self._delete(collection_name, doc_id)
+            self._maybe_checkpoint()
+            if deleted:
+                print(f"Document {doc_id} deleted from collection '{collection_name}'.")
+                return True
+            else:
+                print(f"Document {doc_id} not found in collection '{collection_name}'.")
+        else:
+            print(f"Collection '{collection_name}' not found.")
+
+    def update_document(self, collection_name, doc_id, document):
+
+        """Replaces a document: the old version is deleted and the new one is inserted with a new ID,
+        since document IDs only grow. Returns the new ID, or None, after printing why, if the
+        document does not exist."""
+
+        if collection_name in self.collections:
+            # Checked first, so that an invalid new version does not delete the old one
+            _check_documents([document])
+            with self.write_locks[collection_name], self.operations.hold_shared():
+                new_doc_id = self._delete(collection_name, doc_id) and self._insert(collection_name, document)
+            if new_doc_id:
+                self.metrics.increment('oaa_documents_inserted_total', collection=collection_name)
+            self._maybe_checkpoint()
+            if new_doc_id:
+                print(f"Document {doc_id} in collection '{collection_name}' updated, new ID {new_doc_id}.")
+                return new_doc_id
+            else:
+                print(f"Document {doc_id} not found in collection '{collection_name}'.")
+        else:
+            print(f"Collection '{collection_name}' not found.")
+
+    def _delete(self, collection_name, doc_id):
+
+        """Logs and applies the delete of a document and returns whether it existed; needs the writer lock
+        of the collection. Collections held in memory are compacted once COMPACT_RATIO of them is deleted."""
+
+        inverted_index, full_documents = self.collections[collection_name]
+        if not 1 <= doc_id < inverted_index.visible_doc_id:
+            return False
+        self._log(('delete', collection_name, doc_id))
+        if not inverted_index.delete(doc_id):
+            return False
+        self.caches[collection_name].remove(doc_id)
+        if isinstance(inverted_index, InvertedIndex) and inverted_index.needs_compaction():
+            full_documents.remove_documents(inverted_index.compact())
+        self.metrics.increment('oaa_documents_deleted_total', collection=collection_name)
+        return True
+
+    def compact(self, collection_name):
+
+        """Removes the deleted documents of a collection from its posting lists and document store and
+        returns their number; returns None, after printing why, if the collection does not exist"""
+
         if collection_name in self.collections:
             inverted_index, full_documents = self.collections[collection_name]
+            with self.write_locks[collection_name]:
+                removed = inverted_index.compact()
+                if isinstance(inverted_index, InvertedIndex):
+                    full_documents.remove_documents(removed)
+            print(f"Collection '{collection_name}' compacted, {len(removed)} deleted documents removed.")
+            return len(removed)
+        else:
+            print(f"Collection '{collection_name}' not found.")
 
-            doc_id = inverted_index.next_doc_id
-            full_documents.add_document(doc_id, document)
+    def insert_many(self, collection_name, documents, batch_size=10000, workers=None):
 
-            inverted_index.insert(document)
-            print(f"Document added to collection '{collection_name}' with ID {doc_id}.")
+        """Inserts documents from an iterable in batches and reports the throughput.
+        Each document is either a list of words or a string, which is split into words.
+        Documents without any words are skipped. With `workers` > 1 the batches are
+        indexed in parallel on a process pool. Returns the number of inserted documents,
+        or None if the collection does not exist."""
+
+        if collection_name not in self.collections:
+            print(f"Collection '{collection_name}' not found.")
+            return None
+
+        with self.write_locks[collection_name]:
+            return self._insert_many(collection_name, documents, batch_size, workers)
+
+    def _insert_many(self, collection_name, documents, batch_size, workers):
+        inverted_index, full_documents = self.collections[collection_name]
+        cache = self.caches[collection_name]
+        start = time.perf_counter()
+        inserted = skipped = 0
+
+        def token_lists():
+            nonlocal skipped
+            for document in documents:
+                tokens = self.analyzer.tokenize(document) if isinstance(document, str) else document
+                if tokens:
+                    yield tokens
+                else:
+                    skipped += 1
+
+        # Shards of sharded collections already index their documents in parallel
+        if workers is not None and workers > 1 and not isinstance(inverted_index, ShardedIndex):
+            batches = _build_partial_indexes(token_lists(), inverted_index.next_doc_id, workers, batch_size, self.analyzer)
         else:
+            batches = ((batch, None) for batch in _chunks(token_lists(), batch_size))
+
+        for batch, partial_index in batches:
+            _check_documents(batch)
+            with self.operations.hold_shared():
+                doc_id = inverted_index.next_doc_id
+                self._log(('insert', collection_name, doc_id, batch))
+                for i, tokens in enumerate(batch):
+                    full_documents.add_document(doc_id + i, tokens)
+                if partial_index is None:
+                    inverted_index.insert_many(batch)
+                else:
+                    inverted_index.append_index(partial_index)
+                for i, tokens in enumerate(batch):
+                    cache.update(doc_id + i, tokens)
+            inserted += len(batch)
+            self.metrics.increment('oaa_documents_inserted_total', len(batch), collection=collection_name)
+            self._maybe_checkpoint()
+
+        elapsed = time.perf_counter() - start
+        rate = inserted / elapsed if elapsed > 0 else 0.0
+        print(f"Inserted {inserted} documents into collection '{collection_name}' "
+              f"in {elapsed:.2f} seconds ({rate:.0f} docs/sec), skipped {skipped} empty documents.")
+        return inserted
+
+    def insert_file(self, collection_name, filename, workers=None):
+
+        """Bulk inserts documents from a file with one document per line.
+        Lines of `.jsonl` files hold a JSON string or an object with a "text" field."""
+
+        with open(filename, encoding='utf-8') as file:
+            if filename.endswith('.jsonl'):
+                documents = (_json_document(line) for line in file if line.strip())
+            else:
+                documents = file
+            return self.insert_many(collection_name, documents, workers=workers)
+
+    def cache_stats(self, collection_name):
+
+        """Returns the hit, miss and eviction counters of the collection's result cache"""
+
+        if collection_name in self.caches:
+            return self.caches[collection_name].stats()
+        print(f"Collection '{collection_name}' not found.")
+
+    def _cached_search(self, collection_name, key, search):
+
+        """Returns the document IDs of a normalized query from the collection's cache,
+        running `search` and caching its result on a miss"""
+
+        inverted_index, _ = self.collections[collection_name]
+        cache = self.caches[collection_name]
+        # Documents inserted while the search runs are left out, so the result matches the cache
+        limit = inverted_index.visible_doc_id
+        # Results of a search that a delete may have overtaken are not cached
+        removals = cache.removals
+        doc_ids = cache.get(key, limit)
+        result = 'hit' if doc_ids is not None else 'miss'
+        self.metrics.increment('oaa_cache_lookups_total', collection=collection_name, result=result)
+        profile = active_profile()
+        if profile is not None:
+            profile.cache = result
+        if doc_ids is None:
+            doc_ids = search()
+            doc_ids = doc_ids[:bisect_left(doc_ids, limit)]
+            cache.put(key, doc_ids, limit, removals)
+        return doc_ids
+
+    def record_command(self, command_type, collection_name, seconds, ok):
+
+        """Counts a command and records its latency"""
+
+        labels = {'command': command_type.lower(), 'collection': collection_name or ''}
+        self.metrics.increment('oaa_commands_total', status='ok' if ok else 'error', **labels)
+        self.metrics.observe('oaa_command_duration_seconds', seconds, **labels)
+
+    def print_metrics(self):
+        print(self.metrics.dump() or "No metrics recorded yet.")
+
+    def explain(self, collection_name, query=None, k=None):
+
+        """Prints the plan of a search without running it: the order in which the query is
+        evaluated and the sizes of the posting lists it reads. Returns True, or None, after
+        printing why, if the collection does not exist."""
+
+        if collection_name not in self.collections:
             print(f"Collection '{collection_name}' not found.")
+            return
+        inverted_index, _ = self.collections[collection_name]
+        print("Plan:")
+        if query is None:
+            key, lines = ('all',), ["list all documents"]
+        else:
+            query = query.analyze(self.analyzer)
+            key = query.key() if isinstance(query, (Term, Range, Distance)) else ('query', query)
+            lines = inverted_index.explain(query)
+        if k is not None:
+            print(f"  rank the matching documents with BM25 and keep the top {k}; documents that cannot "
+                  f"reach the top {k} are skipped (MaxScore)")
+        elif key in self.caches[collection_name]:
+            print("  the result is in the result cache; on a miss:")
+        for line in lines:
+            print(f"  {line}")
+        return True
 
     def print_index(self, collection_name):
         if collection_name in self.collections:
             inverted_index, _ = self.collections[collection_name]
             inverted_index.print_index()
+            return True
         else:
             print(f"Collection '{collection_name}' not found.")
 
-    def search(self, collection_name):
-        if collection_name in self.collections:
-            inverted_index, full_documents = self.collections[collection_name]
-            doc_ids = inverted_index.search()
-            documents = [full_documents.get_document(doc_id) for doc_id in doc_ids]
-            print(f"All documents in collection '{collection_name}': {documents}")
+    def iter_search(self, collection_name, query=None, offset=0, limit=None):
+
+        """Returns an iterator of (doc_id, document) for the documents matching a query.Query tree
+        (all documents if `query` is None) in document ID order, skipping the first `offset` and
+        stopping after `limit` of them. Only the document IDs are computed up front; the documents
+        are read from the store a page at a time as the iterator advances."""
+
+        inverted_index, full_documents = self._get_collection(collection_name)
+        _check_page(offset, limit)
+        if query is not None:
+            with phase('analyze'):
+                query = query.analyze(self.analyzer)
+        if query is None:
+            key, search = ('all',), inverted_index.search
         else:
-            print(f"Collection '{collection_name}' not found.")
+            # Words, ranges and distances share the cache entries of the other search methods
+            key = query.key() if isinstance(query, (Term, Range, Distance)) else ('query', query)
+            search = lambda: inverted_index.search_query(query)
+        with phase('search'):
+            doc_ids = self._cached_search(collection_name, key, search)
+        profile = active_profile()
+        if profile is not None:
+            profile.matched = len(doc_ids)
+        return _paged_documents(full_documents, doc_ids[offset:None if limit is None else offset + limit])
 
-    def search_word(self, collection_name, word):
+    def iter_search_top(self, collection_name, query, k, offset=0, limit=None):
+
+        """Returns an iterator of (doc_id, document, score) for the `k` documents matching `query`
+        with the highest BM25 scores, best first, paged like `iter_search`"""
+
+        inverted_index, full_documents = self._get_collection(collection_name)
+        _check_page(offset, limit)
+        with phase('analyze'):
+            query = query.analyze(self.analyzer)
+        with phase('search'):
+            results = inverted_index.search_top(query, k if limit is None else min(k, offset + limit))[offset:]
+        profile = active_profile()
+        if profile is not None:
+            profile.matched = len(results)
+        documents = _paged_documents(full_documents, [doc_id for doc_id, _ in results])
+        return ((doc_id, document, score) for (doc_id, document), (_, score) in zip(documents, results))
+
+    def _get_collection(self, collection_name):
+        if collection_name not in self.collections:
+            raise ValueError(f"Collection '{collection_name}' not found.")
+        return self.collections[collection_name]
+
+    @staticmethod
+    def _print_results(title, results):
+
+        """Prints results as a list, one at a time, without building the whole list or its text"""
+
+        with phase('print'):
+            print(f"{title}[", end='')
+            for i, result in enumerate(results):
+                print(f"{', ' if i else ''}{result!r}", end='')
+            print("]")
+
+    def search(self, collection_name, offset=0, limit=None):
         if collection_name in self.collections:
-            inverted_index, full_documents = self.collections[collection_name]
-            doc_ids = inverted_index.search_word(word)
-            documents = [full_documents.get_document(doc_id) for doc_id in doc_ids]
-            print(f"Search results: {documents}")
+            results = self.iter_search(collection_name, None, offset, limit)
+            self._print_results(f"All documents in collection '{collection_name}': ", (document for _, document in results))
+            return True
         else:
             print(f"Collection '{collection_name}' not found.")
 
-    def search_range(self, collection_name, word1, word2):
+    def search_word(self, collection_name, word, offset=0, limit=None):
+        return self.search_query(collection_name, Term(word), offset, limit)
+
+    def search_range(self, collection_name, word1, word2, offset=0, limit=None):
+        return self.search_query(collection_name, Range(word1, word2), offset, limit)
+
+    def search_distance(self, collection_name, word1, word2, exact_dist, offset=0, limit=None):
+        return self.search_query(collection_name, Distance(word1, word2, exact_dist), offset, limit)
+
+    def search_query(self, collection_name, query, offset=0, limit=None):
         if collection_name in self.collections:
-            inverted_index, full_documents = self.collections[collection_name]
-            doc_ids = inverted_index.search_range(word1, word2)
-            documents = [full_documents.get_document(doc_id) for doc_id in doc_ids]
-            print(f"Search results: {documents}")
+            results = self.iter_search(collection_name, query, offset, limit)
+            self._print_results("Search results: ", (document for _, document in results))
+            return True
         else:
             print(f"Collection '{collection_name}' not found.")
 
-    def search_distance(self, collection_name, word1, word2, exact_dist):
+    def search_top(self, collection_name, query, k, offset=0, limit=None):
         if collection_name in self.collections:
-            inverted_index, full_documents = self.collections[collection_name]
-            doc_ids = inverted_index.search_distance(word1, word2, exact_dist)
-            documents = [full_documents.get_document(doc_id) for doc_id in doc_ids]
-            print(f"Search results: {documents}")
+            results = self.iter_search_top(collection_name, query, k, offset, limit)
+            self._print_results("Search results: ", ((round(score, 3), document) for _, document, score in results))
+            return True
         else:
             print(f"Collection '{collection_name}' not found.")
+
+
+def _check_page(offset, limit):
+    if offset < 0 or (limit is not None and limit < 0):
+        raise ValueError("Invalid input: 'offset' and 'limit' must not be negative.")
+
+
+def _check_documents(documents):
+
+    """Raises ValueError unless every document is a non-empty list of words. Documents are
+    checked before they are logged or stored, so that only documents the index accepts
+    reach the write-ahead log and the document store."""
+
+    if any(not tokens or not isinstance(tokens, list) for tokens in documents):
+        raise ValueError("Invalid input: every document must be a non-empty list of words.")
+
+
+def _paged_documents(full_documents, doc_ids):
+
+    """Yields (doc_id, document) for `doc_ids`, reading the documents from the store in pages of RESULT_PAGE_SIZE"""
+
+    for start in range(0, len(doc_ids), RESULT_PAGE_SIZE):
+        page = doc_ids[start:start + RESULT_PAGE_SIZE]
+        with phase('fetch'):
+            documents = full_documents.get_documents(page)
+        yield from zip(page, documents)
+
+
+def read_shard_count(directory):
+
+    """Returns the number of shards of a stored collection (1 if it is not sharded)"""
+
+    path = os.path.join(directory, SHARDS_FILE)
+    if not os.path.exists(path):
+        return 1
+    with open(path) as file:
+        return int(file.read())
+
+
+def _json_document(line):
+
+    """Returns the document text stored on a line of a JSONL file"""
+
+    value = json.loads(line)
+    return value if isinstance(value, str) else value['text']
@@ -1,4 +1,11 @@
 import re # For processing regular expressions
+from analyzer import WORD_PATTERN, tokenize
+# Quoted strings without whitespace are single WORD tokens, the others are DOCUMENT tokens
+WORD_WITHOUT_SPACE = re.compile(r'\S*')
+# ... and those that also contain * or ? are wildcard PATTERN tokens
+WILDCARD = re.compile(r'[*?]')
+# Maximum number of edits of a fuzzy word written as "word"~ without a number
+DEFAULT_MAX_EDITS = 2
 
 class Token(object):
 
@@ -7,10 +14,12 @@ class Token(object):
     Each token has a type (e.g., CREATE, WORD) and a value.
     """
 
-    def __init__(self, type, value):
+    def __init__(self, type, value, text=None):
 
         self.type = type
         self.value = value
+        # Original text of quoted strings, whose value is split into words
+        self.text = text
 
     def __str__(self):
 
@@ -27,6 +36,51 @@ class Token(object):
 
         return self.__str__()
     
+# Master pattern of the lexer: every character of the input belongs to exactly one match,
+# so `finditer` splits the whole input into whitespace and tokens in one pass
+TOKEN_PATTERN = re.compile(r'''
+      (?P<SPACE>\s+)
+    | (?P<EOI>;)
+    | (?P<MIN>-)
+    | (?P<LPAREN>\()
+    | (?P<RPAREN>\))
+    | "(?P<QUOTED>[^"]*)"
+    | (?P<UNCLOSED_QUOTE>")
+    | <(?P<ANGLE>[^>]*)>
+    | (?P<UNCLOSED_ANGLE><)
+    | (?P<FUZZY>~\d*)
+    | (?P<BARE>[^\s;"()]+)
+''', re.VERBOSE)
+
+# Types of bare words in order of priority; keywords are case insensitive and the
+# first five also match words that only start with them. Anything else is JUNK.
+BARE_WORD_PATTERN = re.compile(r'''
+      (?i:(?P<CREATE>CREATE)
+        | (?P<INSERT>INSERT)
+        | (?P<PRINT_INDEX>PRINT_INDEX)
+        | (?P<SEARCH>SEARCH)
+        | (?P<WHERE>WHERE)
+        | (?P<BULK>BULK$)
+        | (?P<DELETE>DELETE$)
+        | (?P<UPDATE>UPDATE$)
+        | (?P<COMPACT>COMPACT$)
+        | (?P<FROM>FROM$)
+        | (?P<SHARDS>SHARDS$)
+        | (?P<AND>AND$)
+        | (?P<OR>OR$)
+        | (?P<NOT>NOT$)
+        | (?P<TOP>TOP$)
+        | (?P<LIMIT>LIMIT$)
+        | (?P<OFFSET>OFFSET$)
+        | (?P<EXPLAIN>EXPLAIN$)
+        | (?P<PROFILE>PROFILE$)
+        | (?P<METRICS>METRICS$)
+        | (?P<NEAR>NEAR/\d+$)
+        | (?P<ONEAR>ONEAR/\d+$))
+    | (?P<COLLECTION>[a-zA-Z][a-zA-Z0-9_]*$)
+    | (?P<NUMBER>\d+$)
+''', re.VERBOSE)
+
 class Lexer(object):
 
     """
@@ -37,142 +91,68 @@ class Lexer(object):
     def __init__(self, text):
 
         self.text = text
+        self.matches = TOKEN_PATTERN.finditer(text)
         self.pos = 0
-        self.current_char = self.text[self.pos] if self.text else None
 
     def error(self):
         raise Exception('Error in lexer')
 
-    def advance(self):
-
-        """Moves the `pos` pointer and sets the `current_char` variable"""
-
-        self.pos += 1
-        if self.pos >= len(self.text):
-            self.current_char = None  # Indicates the end of the input
-        else:
-            self.current_char = self.text[self.pos]
-
-    def skip_whitespace(self):
-
-        """Skips whitespace"""
-
-        while self.current_char is not None and self.current_char.isspace():
-            self.advance()
-
     def get_token_type(self, token):
 
-        """Determines the token type based on its value using regular expressions"""
-        
-        token_patterns = {
-            r'CREATE': 'CREATE',
-            r'INSERT': 'INSERT',
-            r'PRINT_INDEX': 'PRINT_INDEX',
-            r'SEARCH': 'SEARCH',
-            r'WHERE': 'WHERE',
-            r'^[a-zA-Z][a-zA-Z0-9_]*$': 'COLLECTION',
-            r'^"[a-zA-Z][a-zA-Z0-9_]*"$': 'WORD', 
-            r'^".*"$': 'DOCUMENT',
-            r'^-': 'MIN',
-            r'^<\d+>$': 'DIST',
-            r'^;$': 'EOI',
-            r'.+': 'JUNK'
-        }
-
-        # Check which pattern the token matches
-        for pattern, token_type in token_patterns.items():
-            if re.match(pattern, token, re.IGNORECASE if token_type in ['CREATE', 'INSERT', 'PRINT_INDEX', 'SEARCH', 'WHERE'] else 0):
-                return token_type
-
-        self.error()
+        """Determines the type of a bare word (a token that is not quoted, in angle brackets or punctuation)"""
+
+        match = BARE_WORD_PATTERN.match(token)
+        return match.lastgroup if match else 'JUNK'
 
     def tokenize_text(self, text):
 
         """Splits the text into individual words using regular expressions"""
         
-        words = re.findall(r'[a-zA-Z0-9_]+', text)
+        words = tokenize(text)
         return words
 
     def get_next_token(self):
 
         """Retrieves the next token from the input.
         Handles quoted strings, angle brackets, and regular words."""
-        
-        while self.current_char is not None:
 
+        for match in self.matches:
+            self.pos = match.end()
+            kind = match.lastgroup
 
-            if self.current_char.isspace():
-                self.skip_whitespace()
+            if kind == 'SPACE':
                 continue
 
-            if self.current_char == ';':
-                self.advance()
-                return Token('EOI', ';')
-
-            if self.current_char == '-':
-                self.advance()
-                return Token('MIN', '-')
-
-            result = ''  # To store the token value
-
-            if self.current_char == '"':
-                self.advance()
-                result, contains_space = self._get_quoted_string()
-                token_type = 'DOCUMENT' if contains_space else 'WORD'
-                result = self.tokenize_text(result)
-                return Token(token_type, result)
-
-            if self.current_char == '<':
-                self.advance()
-                result = self._get_angle_bracket_content()
-                if result.isdigit():
-                    return Token('DIST', int(result))  
-                else:
-                    self.error()  # Error if not a number
-
-            # Collecting regular words/identifiers
-            while self.current_char is not None and not self.current_char.isspace() and self.current_char not in [';', '"']:
-                result += self.current_char
-                self.advance()
-
-            if result:
+            if kind == 'BARE':
+                result = match.group()
                 token_type = self.get_token_type(result)
+                if token_type in ('NEAR', 'ONEAR'):
+                    return Token(token_type, int(result.partition('/')[2]))
                 return Token(token_type, result)
 
-        return Token('EOF', None)
-
-    def _get_quoted_string(self):
+            if kind == 'QUOTED':
+                result = match.group('QUOTED')
+                if WORD_WITHOUT_SPACE.fullmatch(result) and WILDCARD.search(result):
+                    return Token('PATTERN', result.lower(), result)
+                token_type = 'WORD' if WORD_WITHOUT_SPACE.fullmatch(result) else 'DOCUMENT'
+                return Token(token_type, self.tokenize_text(result), result)
 
-        """Helper method for processing quoted strings and determining if they contain spaces """
-        
-        result = ''
-        contains_space = False
-        while self.current_char is not None and self.current_char != '"':
-            if self.current_char.isspace():
-                contains_space = True
-            result += self.current_char
-            self.advance()
-
-        if self.current_char is None:
-            self.error()  # Unclosed quote
-
-        self.advance() 
-        return result, contains_space
+            if kind == 'ANGLE':
+                result = match.group('ANGLE')
+                if result.isdigit():
+                    return Token('DIST', int(result))
+                self.error()  # Error if not a number
 
-    def _get_angle_bracket_content(self):
+            if kind == 'FUZZY':
+                result = match.group('FUZZY')
+                return Token('FUZZY', int(result[1:]) if len(result) > 1 else DEFAULT_MAX_EDITS)
 
-        """Helper method for collecting content in angle brackets"""
-        
-        result = ''
-        while self.current_char is not None and self.current_char != '>':
-            result += self.current_char
-            self.advance()
+            if kind in ('UNCLOSED_QUOTE', 'UNCLOSED_ANGLE'):
+                self.error()
 
-        if self.current_char is None:
-            self.error()  # Unclosed angle bracket
+            return Token(kind, match.group())
 
-        self.advance()  
-        return result
+        return Token('EOF', None)
 
 
 if __name__ == '__main__':
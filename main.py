@@ -1,54 +1,197 @@
+"""
+Command-line interface: runs the commands typed or piped into the standard input.
+
+Input is read as a stream: `read_statements` splits it into statements at semicolons as
+lines arrive, so a piped script starts running at once and is never held in memory as a
+whole. A statement may span several lines, and a semicolon inside a quoted document does
+not end it. `-q` and `file <filename>` are typed on a line of their own.
+
+Everything printed goes through a BufferedOutput, which writes to the terminal in large
+chunks. With --quiet the echo and confirmation lines of commands that change collections
+are dropped, and a summary of the commands run is printed at the end, so replaying
+millions of INSERTs is limited by indexing rather than by writing to the terminal.
+"""
+
+import argparse
+import re
+import sys
+import time
+from collections import Counter
+from contextlib import redirect_stdout
+from io import StringIO
 from lexer import Lexer
-from parser import Parser
+from parser import WRITE_COMMANDS, Parser
 from invertedIndex import DB
-import sys
 
-def execute_file_commands(filename, db):
+# Quotes and semicolons: a semicolon outside of quoted strings ends a statement
+DELIMITERS = re.compile(r'[";]')
+# Bytes of output collected before they are written to the terminal
+OUTPUT_BUFFER_SIZE = 64 * 1024
+
+
+def read_statements(lines):
+
+    """Yields the statements of an iterable of lines as soon as their closing semicolon arrives.
+    `-q` and `file <filename>` lines between statements are yielded as they are. Every line is
+    scanned once, so long statements spanning many lines cost linear time."""
+
+    # Text of the unfinished statement, and whether it ends inside a quoted string
+    parts = []
+    quoted = False
+    for line in lines:
+        if not parts:
+            command = line.strip()
+            if command.lower() == '-q' or command.startswith('file '):
+                yield command
+                continue
+        start = 0
+        for match in DELIMITERS.finditer(line):
+            if match.group() == '"':
+                quoted = not quoted
+            elif not quoted:
+                parts.append(line[start:match.end()])
+                statement = ''.join(parts).strip()
+                if statement != ';':
+                    yield statement
+                parts = []
+                start = match.end()
+        rest = line[start:]
+        if parts or rest.strip():
+            parts.append(rest)
+    # An unfinished statement is run too, so that the parser reports it
+    if parts:
+        yield ''.join(parts).strip()
+
+
+class BufferedOutput:
+
+    """sys.stdout replacement that collects printed text and writes it to `stream` in chunks of `buffer_size`"""
+
+    def __init__(self, stream, buffer_size=OUTPUT_BUFFER_SIZE):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.parts = []
+        self.size = 0
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.buffer_size:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.parts:
+            self.stream.write(''.join(self.parts))
+            self.parts = []
+            self.size = 0
+        self.stream.flush()
+
+
+class CommandRunner:
+
+    """
+    Runs statements on a DB and counts them by command type and errors: exceptions, and
+    commands which the DB did not carry out (it prints why). In quiet mode commands that
+    change collections print nothing but their errors, and `print_summary` reports what
+    was run.
+    """
+
+    def __init__(self, db, quiet=False):
+        self.db = db
+        self.quiet = quiet
+        self.counts = Counter()
+        self.errors = 0
+        self.start = time.perf_counter()
+
+    def run(self, statement, echo=False):
+
+        """Runs one statement, printing `Command: <statement>` first if `echo` is set"""
+
+        try:
+            parser = Parser(Lexer(statement), self.db)
+            command_type = parser.current_token.type
+            self.counts[command_type] += 1
+            if self.quiet and command_type in WRITE_COMMANDS:
+                output = StringIO()
+                with redirect_stdout(output):
+                    parser.auto_parse()
+                if parser.failed:
+                    # The DB prints why it did not carry out the command last
+                    print(f"Error: {output.getvalue().splitlines()[-1]}")
+            else:
+                if echo:
+                    print(f"Command: {statement}")
+                parser.auto_parse()
+            if parser.failed:
+                self.errors += 1
+        except Exception as e:
+            self.errors += 1
+            print(f"Error: {e}")
+
+    def print_summary(self):
+        elapsed = time.perf_counter() - self.start
+        total = sum(self.counts.values())
+        rate = total / elapsed if elapsed > 0 else 0.0
+        by_type = ', '.join(f"{command_type}: {count}" for command_type, count in self.counts.most_common())
+        print(f"Ran {total} commands ({by_type or 'none'}) in {elapsed:.2f} seconds ({rate:.0f} commands/sec), "
+              f"{self.errors} errors.")
+
+
+def execute_file_commands(filename, db, runner=None):
 
     """Executes commands from a given file"""
 
+    runner = runner if runner is not None else CommandRunner(db)
     try:
-        filename = filename.strip() 
+        filename = filename.strip()
         with open(filename, 'r') as file:
-            for line in file:
-                if line.strip():  # Skip empty lines
-                    print(f"Command: {line.strip()}")
-                    lexer = Lexer(line.strip())
-                    parser = Parser(lexer, db)
-                    parser.auto_parse()
+            for statement in read_statements(file):
+                runner.run(statement, echo=True)
     except Exception as e:
         print(f"Error: {e}")
 
 
 def main():
-    print("Welcome to the text collection management system!")
-    print("You can execute commands interactively or from a file.")
-    print("Type '-q' to quit.")
-    print("To execute commands from a file (u need to be in the same directory), use: `file <filename>`")
+    arg_parser = argparse.ArgumentParser(description="Runs commands typed or piped into the standard input")
+    # Collections are kept on disk when a data directory is given: `python main.py <data_dir>`
+    arg_parser.add_argument('data_dir', nargs='?', default=None)
+    arg_parser.add_argument('--quiet', action='store_true',
+                            help="print only search results and errors, and a summary at the end")
+    args = arg_parser.parse_args()
 
-    db = DB()
-    while True:
-        try:
-            text = sys.stdin.read()
+    if not args.quiet:
+        print("Welcome to the text collection management system!")
+        print("You can execute commands interactively or from a file.")
+        print("Type '-q' to quit.")
+        print("To execute commands from a file (u need to be in the same directory), use: `file <filename>`")
 
+    db = DB(args.data_dir)
+    runner = CommandRunner(db, args.quiet)
+    # Typed commands are answered at once; piped ones are answered in chunks
+    interactive = sys.stdin.isatty()
+    output = sys.stdout = BufferedOutput(sys.stdout)
+    try:
+        for statement in read_statements(sys.stdin):
             # Exit on '-q'
-            if text.strip().lower() == '-q':
+            if statement.lower() == '-q':
                 print("Exiting the system.")
                 break
 
             # Execute commands from a file
-            if text.startswith('file '):
-                filename = text.split(' ', 1)[1]
-                execute_file_commands(filename, db)
-                continue
-
-            # Process single command
-            lexer = Lexer(text)
-            parser = Parser(lexer, db)
-            parser.auto_parse()
-
-        except Exception as e:
-            print(f"Error: {e}")
+            if statement.startswith('file '):
+                execute_file_commands(statement.split(' ', 1)[1], db, runner)
+                db.checkpoint()
+            else:
+                runner.run(statement)
+            if interactive:
+                output.flush()
+    finally:
+        db.close()
+        if args.quiet:
+            runner.print_summary()
+        sys.stdout = output.stream
+        output.flush()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,224 @@
+"""
+Metrics registry and query profiles.
+
+`MetricsRegistry` keeps counters and latency histograms, each identified by a name and a
+set of labels (e.g. the command type and the collection). Recording a value costs one
+dictionary lookup and a short critical section, so metrics are always on. The registry
+can be dumped as a readable summary or exported in the Prometheus text format.
+
+A `Profile` collects what one command spends its time on. While a profile is active in
+a thread (`with profile.activate():`), the instrumented code paths add the time of their
+phases (`phase`) and the posting lists they look up (`touch`) to it; with no active
+profile they cost one thread-local lookup.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+
+# Upper bounds in seconds of the latency histogram buckets; the last bucket is unbounded
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+
+
+class Histogram:
+
+    """Counts of observed values in fixed buckets, with their sum"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+
+        """Returns the upper bound of the bucket holding the q-quantile (inf for the last bucket)"""
+
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank and count:
+                return bound
+        return 0.0
+
+
+class MetricsRegistry:
+
+    """Named counters and histograms with labels, safe to update from many threads"""
+
+    def __init__(self):
+        # {(name, labels): value} and {(name, labels): Histogram}; labels are sorted (key, value) tuples
+        self.counters = {}
+        self.histograms = {}
+        # Help texts of the metrics for the Prometheus export: {name: text}
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def counter(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def histogram(self, name, **labels):
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def dump(self):
+
+        """Returns a readable summary: one line per counter and per histogram"""
+
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                lines.append(f"{name}{_format_labels(labels)} count: {histogram.count}"
+                             f"  mean: {histogram.sum / histogram.count * 1e3:.3f} ms"
+                             f"  p50 <= {histogram.quantile(0.5) * 1e3:g} ms"
+                             f"  p99 <= {histogram.quantile(0.99) * 1e3:g} ms")
+        return '\n'.join(lines)
+
+    def prometheus(self):
+
+        """Returns all metrics in the Prometheus text exposition format"""
+
+        lines = []
+        with self.lock:
+            counters, histograms = sorted(self.counters.items()), sorted(self.histograms.items())
+            for kind, series in (('counter', counters), ('histogram', histograms)):
+                previous = None
+                for (name, labels), value in series:
+                    if name != previous:
+                        if name in self.help:
+                            lines.append(f"# HELP {name} {self.help[name]}")
+                        lines.append(f"# TYPE {name} {kind}")
+                        previous = name
+                    if kind == 'counter':
+                        lines.append(f"{name}{_format_labels(labels)} {value}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(value.buckets + (float('inf'),), value.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {value.sum!r}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {value.count}")
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+_active = threading.local()
+
+
+def active_profile():
+
+    """Returns the profile active in this thread, or None"""
+
+    return getattr(_active, 'profile', None)
+
+
+def phase(name):
+
+    """Context manager that adds the time of a block to phase `name` of the active profile, if any"""
+
+    profile = getattr(_active, 'profile', None)
+    return nullcontext() if profile is None else profile.phase(name)
+
+
+def touch(word, length):
+
+    """Records that the active profile, if any, looked up the posting list of a word with `length` documents"""
+
+    profile = getattr(_active, 'profile', None)
+    if profile is not None:
+        profile.touch(word, length)
+
+
+class Profile:
+
+    """Per-phase timings and posting list statistics of one command"""
+
+    def __init__(self):
+        # {phase: seconds}, in the order the phases first ran; nested phases are not counted in their parent
+        self.times = {}
+        self.stack = []
+        # {word: [number of lookups, total documents in the posting lists]}, summed over segments and shards
+        self.postings = {}
+        self.matched = None
+        self.cache = None
+
+    @contextmanager
+    def activate(self):
+        previous = getattr(_active, 'profile', None)
+        _active.profile = self
+        try:
+            yield self
+        finally:
+            _active.profile = previous
+
+    @contextmanager
+    def phase(self, name):
+        self.times.setdefault(name, 0.0)
+        self.stack.append(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stack.pop()
+            self.times[name] += elapsed
+            if self.stack:
+                self.times[self.stack[-1]] -= elapsed
+
+    def touch(self, word, length):
+        entry = self.postings.setdefault(word, [0, 0])
+        entry[0] += 1
+        entry[1] += length
+
+    def report(self):
+
+        """Returns the profile as lines of text"""
+
+        total = sum(self.times.values())
+        lines = ["Profile:"]
+        for name, seconds in self.times.items():
+            share = seconds / total if total else 0.0
+            lines.append(f"  {name:<12} {seconds * 1e3:9.3f} ms  {share:6.1%}")
+        lines.append(f"  {'total':<12} {total * 1e3:9.3f} ms")
+        if self.cache is not None:
+            lines.append(f"  result cache: {self.cache}")
+        if self.postings:
+            lines.append("  posting lists: " + ', '.join(f"'{word}': {documents}" for word, (_, documents)
+                                                        in self.postings.items()))
+        elif self.cache != 'hit':
+            lines.append("  posting lists: none looked up in this process")
+        scanned = sum(documents for _, documents in self.postings.values())
+        if self.matched is not None:
+            lines.append(f"  documents scanned: {scanned}, matched: {self.matched}")
+        return lines
@@ -1,5 +1,14 @@
-from lexer import Lexer
+import re
+import time
+from lexer import Lexer, Token
 from invertedIndex import DB
+from metrics import Profile
+from query import And, Distance, Fuzzy, Near, Not, Or, Phrase, Query, Range, Term, Wildcard
+
+# Commands that change a collection; SEARCH and PRINT_INDEX only read it
+WRITE_COMMANDS = ('CREATE', 'INSERT', 'BULK', 'DELETE', 'UPDATE', 'COMPACT')
+# Collection names; the lexer reads keywords such as TOP or LIMIT as keywords even where they name a collection
+COLLECTION_NAME = re.compile(r'[a-zA-Z][a-zA-Z0-9_]*')
 
 class Parser(object):
 
@@ -12,6 +21,19 @@ class Parser(object):
         
         self.lexer = lexer 
         self.db = db
+        # Number of shards given in `CREATE <collection> SHARDS <N>;`, None if not given
+        self.num_shards = None
+        # Number of results given in `SEARCH <collection> WHERE <query> TOP <k>;`, None if not given
+        self.top_k = None
+        # Page of results given in `SEARCH ... LIMIT <n> OFFSET <m>;`, None if not given
+        self.limit = None
+        self.offset = None
+        # Query of the parsed SEARCH (None for all documents), for EXPLAIN
+        self.query = None
+        # Collection the command works on, for the metrics of the DB
+        self.collection_name = None
+        # Whether the DB did not carry out the command, e.g. on a missing collection (it prints why)
+        self.failed = False
         self.current_token = self.lexer.get_next_token()
 
     def error(self):
@@ -29,10 +51,35 @@ class Parser(object):
         """
     
         if self.current_token.type == token_type or (token_type_second and self.current_token.type == token_type_second):
+            if self.current_token.type == 'COLLECTION':
+                self.collection_name = self.current_token.value
             self.current_token = self.lexer.get_next_token()
         else:
             self.error()
 
+    def eat_collection(self):
+
+        """Eats the collection name of a command. A keyword in its place is a collection name too,
+        so that collections named like keywords added to the language (`top`, `limit`, ...) still work."""
+
+        token = self.current_token
+        if token.type != 'COLLECTION' and isinstance(token.value, str) and COLLECTION_NAME.fullmatch(token.value):
+            self.current_token = Token('COLLECTION', token.value)
+        self.eat('COLLECTION')
+
+    def eat_quoted(self):
+
+        """Eats a quoted document or word outside of a query and returns its token. Quoted words
+        with * or ? are PATTERN tokens, which only queries read as wildcards; here they are
+        split into words like any other quoted text."""
+
+        token = self.current_token
+        if token.type == 'PATTERN':
+            self.eat('PATTERN')
+            return Token('WORD', self.lexer.tokenize_text(token.text), token.text)
+        self.eat('DOCUMENT', 'WORD')
+        return token
+
     def parse_create(self):
 
         """Parses the CREATE command"""
@@ -41,7 +88,11 @@ class Parser(object):
         self.eat('CREATE')
         #('COLLECTION', 'hello')  
         collection_name = self.current_token.value 
-        self.eat('COLLECTION') 
+        self.eat_collection() 
+        if self.current_token.type == 'SHARDS': # SHARDS N
+            self.eat('SHARDS')
+            self.num_shards = int(self.current_token.value)
+            self.eat('NUMBER')
         #('EOI', ';')
         self.eat('EOI') 
         print(f"Creating collection: {collection_name}")
@@ -53,106 +104,337 @@ class Parser(object):
 
         self.eat('INSERT')  
         collection_name = self.current_token.value 
-        self.eat('COLLECTION')  
-        document = self.current_token.value 
-        self.eat('DOCUMENT', 'WORD')  
+        self.eat_collection()  
+        document = self.eat_quoted().value
         self.eat('EOI')  
         print(f"Inserting in {collection_name} document: {document}")
         return collection_name, document
     
+    def parse_bulk_insert(self):
+
+        """Parses the BULK INSERT command"""
+
+        self.eat('BULK')
+        self.eat('INSERT')
+        collection_name = self.current_token.value
+        self.eat_collection()
+        self.eat('FROM')
+        filename = self.eat_quoted().text
+        self.eat('EOI')
+        print(f"Bulk inserting in {collection_name} documents from file: {filename}")
+        return collection_name, filename
+
+    def parse_delete(self):
+
+        """Parses the DELETE command"""
+
+        self.eat('DELETE')
+        collection_name = self.current_token.value
+        self.eat_collection()
+        doc_id = int(self.current_token.value)
+        self.eat('NUMBER')
+        self.eat('EOI')
+        print(f"Deleting from {collection_name} document: {doc_id}")
+        return collection_name, doc_id
+
+    def parse_update(self):
+
+        """Parses the UPDATE command"""
+
+        self.eat('UPDATE')
+        collection_name = self.current_token.value
+        self.eat_collection()
+        doc_id = int(self.current_token.value)
+        self.eat('NUMBER')
+        document = self.eat_quoted().value
+        self.eat('EOI')
+        print(f"Updating in {collection_name} document {doc_id}: {document}")
+        return collection_name, doc_id, document
+
+    def parse_compact(self):
+
+        """Parses the COMPACT command"""
+
+        self.eat('COMPACT')
+        collection_name = self.current_token.value
+        self.eat_collection()
+        self.eat('EOI')
+        print(f"Compacting collection: {collection_name}")
+        return collection_name
+
     def parse_print_index(self): 
 
         """Parses the PRINT_INDEX command"""
 
         self.eat('PRINT_INDEX')  
         collection_name = self.current_token.value  
-        self.eat('COLLECTION')  
+        self.eat_collection()  
         self.eat('EOI')  
         print(f"Printing index in collection: {collection_name}")
         return collection_name
     
     def parse_search(self):
 
-        """Parses the SEARCH command"""
+        """Parses the SEARCH command.
+        Single word, range and distance queries are returned as (collection_name, word1, word2, dist);
+        other queries, and all queries with TOP k, are returned as (collection_name, query, None, None)
+        with a query.Query tree."""
 
         self.eat('SEARCH')  
         collection_name = self.current_token.value  
-        self.eat('COLLECTION')  
+        self.eat_collection()  
 
-        if self.current_token.type == 'WHERE': # WHERE “keyword”
+        if self.current_token.type == 'WHERE': # WHERE <query>
             self.eat('WHERE')
-            word1 = self.current_token.value  
-            self.eat('WORD')  
-
-            if self.current_token.type == 'MIN':  # WHERE “keyword_1” - “keyword_1”
-                self.eat('MIN')
-                word2 = self.current_token.value
-                self.eat('WORD')
-                self.eat('EOI')  
-                print(f"Searching in collection {collection_name} for documents with word between '{word1[0]}' and '{word2[0]}'")
-                return collection_name, word1[0], word2[0], None
-            
-            
-            if self.current_token.type == 'DIST': # WHERE “keyword_1” <N> “keyword_2” 
-                dist = self.current_token.value
-                self.eat('DIST')
-                word2 = self.current_token.value
-                self.eat('WORD')
-                self.eat('EOI')  
-                print(f"Searching in collection {collection_name} for documents with word on distance {dist} between '{word1[0]}' and '{word2[0]}'")
-                return collection_name, word1[0], word2[0], dist
-            
-            self.eat('EOI') 
-
-            print(f"Searching in collection {collection_name} for documents with word '{word1[0]}'")
-            return collection_name, word1[0], None, None
+            query = self.query = self.parse_query()
+            if self.current_token.type == 'TOP': # TOP k
+                self.eat('TOP')
+                self.top_k = int(self.current_token.value)
+                self.eat('NUMBER')
+            self.parse_page()
+            self.eat('EOI')
+
+            if self.top_k is not None:
+                print(f"Searching in collection {collection_name} for the top {self.top_k} documents matching {query}")
+                return collection_name, query, None, None
+
+            if isinstance(query, Range):  # WHERE “keyword_1” - “keyword_1”
+                print(f"Searching in collection {collection_name} for documents with word between '{query.word1}' and '{query.word2}'")
+                return collection_name, query.word1, query.word2, None
+
+            if isinstance(query, Distance): # WHERE “keyword_1” <N> “keyword_2” 
+                print(f"Searching in collection {collection_name} for documents with word on distance {query.distance} between '{query.word1}' and '{query.word2}'")
+                return collection_name, query.word1, query.word2, query.distance
+
+            if isinstance(query, Term): # WHERE “keyword”
+                print(f"Searching in collection {collection_name} for documents with word '{query.word}'")
+                return collection_name, query.word, None, None
+
+            print(f"Searching in collection {collection_name} for documents matching {query}")
+            return collection_name, query, None, None
         
+        self.parse_page()
         self.eat('EOI')  
 
         print(f"Searching all documents in collection: {collection_name}")
         return collection_name, None, None, None
+
+    def parse_page(self):
+
+        """Parses the optional [LIMIT n] [OFFSET m] clauses at the end of SEARCH"""
+
+        if self.current_token.type == 'LIMIT':
+            self.eat('LIMIT')
+            self.limit = int(self.current_token.value)
+            self.eat('NUMBER')
+        if self.current_token.type == 'OFFSET':
+            self.eat('OFFSET')
+            self.offset = int(self.current_token.value)
+            self.eat('NUMBER')
+
+    def page_options(self):
+
+        """Returns the LIMIT and OFFSET of the parsed SEARCH as keyword arguments, without the ones not given"""
+
+        options = {}
+        if self.offset is not None:
+            options['offset'] = self.offset
+        if self.limit is not None:
+            options['limit'] = self.limit
+        return options
+
+    def parse_query(self):
+
+        """Parses a boolean query: and_query (OR and_query)*"""
+
+        children = [self.parse_and_query()]
+        while self.current_token.type == 'OR':
+            self.eat('OR')
+            children.append(self.parse_and_query())
+        return children[0] if len(children) == 1 else Or(children)
+
+    def parse_and_query(self):
+
+        """Parses not_query (AND not_query)*"""
+
+        children = [self.parse_not_query()]
+        while self.current_token.type == 'AND':
+            self.eat('AND')
+            children.append(self.parse_not_query())
+        return children[0] if len(children) == 1 else And(children)
+
+    def eat_words(self, token_type):
+
+        """Eats a quoted WORD or DOCUMENT of a query and returns its words. Quotes that hold
+        no word, such as "   ", are invalid syntax."""
+
+        words = self.current_token.value
+        self.eat(token_type)
+        if not words:
+            self.error()
+        return words
+
+    def parse_not_query(self):
+
+        """Parses NOT not_query | ( query ) | "phrase" | "pattern" | “keyword” [- “keyword” | <N> “keyword” | (NEAR/N “keyword”)+ | ~N]"""
+
+        if self.current_token.type == 'NOT':
+            self.eat('NOT')
+            return Not(self.parse_not_query())
+
+        if self.current_token.type == 'LPAREN':
+            self.eat('LPAREN')
+            query = self.parse_query()
+            self.eat('RPAREN')
+            return query
+
+        if self.current_token.type == 'DOCUMENT': # "keyword_1 keyword_2 ..." phrase
+            words = self.eat_words('DOCUMENT')
+            return Phrase(words) if len(words) > 1 else Term(words[0])
+
+        if self.current_token.type == 'PATTERN': # "co*ch" wildcard
+            pattern = self.current_token.value
+            self.eat('PATTERN')
+            return Wildcard(pattern)
+
+        word1 = self.eat_words('WORD')
+
+        if self.current_token.type == 'FUZZY': # “keyword”~N
+            max_edits = self.current_token.value
+            self.eat('FUZZY')
+            return Fuzzy(word1[0], max_edits)
+
+        if self.current_token.type == 'MIN':
+            self.eat('MIN')
+            word2 = self.eat_words('WORD')
+            return Range(word1[0], word2[0])
+
+        if self.current_token.type in ('NEAR', 'ONEAR'): # “keyword_1” NEAR/N “keyword_2” [NEAR/N “keyword_3” ...]
+            operator, distance = self.current_token.type, self.current_token.value
+            words = [word1[0]]
+            while self.current_token.type in ('NEAR', 'ONEAR'):
+                if (self.current_token.type, self.current_token.value) != (operator, distance):
+                    self.error()  # One chain uses one operator and one window
+                self.eat(operator)
+                words.append(self.eat_words('WORD')[0])
+            return Near(words, distance, ordered=operator == 'ONEAR')
+
+        if self.current_token.type == 'DIST':
+            dist = self.current_token.value
+            self.eat('DIST')
+            word2 = self.eat_words('WORD')
+            return Distance(word1[0], word2[0], dist)
+
+        return Term(word1[0])
     
     def auto_parse(self):
 
-        """Automatically parses the command based on the token type"""
+        """Automatically parses the command based on the token type and records its latency in the DB metrics"""
 
         command_type = self.current_token.type
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = self.dispatch(command_type)
+            ok = True
+            return result
+        finally:
+            self.db.record_command(command_type, self.collection_name, time.perf_counter() - start, ok)
+
+    def dispatch(self, command_type):
+
+        """Parses and runs a command of the given type"""
 
         if command_type == 'CREATE':
             collection_name = self.parse_create()
-            self.db.create_collection(collection_name) 
+            if self.num_shards is None:
+                self.failed = self.db.create_collection(collection_name) is None
+            else:
+                self.failed = self.db.create_collection(collection_name, self.num_shards) is None
             return  collection_name
             
         elif command_type == 'INSERT':
             collection_name, document = self.parse_insert()
-            self.db.insert_document(collection_name, document)
+            self.failed = self.db.insert_document(collection_name, document) is None
             return  collection_name, document
             
+        elif command_type == 'BULK':
+            collection_name, filename = self.parse_bulk_insert()
+            self.failed = self.db.insert_file(collection_name, filename) is None
+            return collection_name, filename
+
+        elif command_type == 'DELETE':
+            collection_name, doc_id = self.parse_delete()
+            self.failed = self.db.delete_document(collection_name, doc_id) is None
+            return collection_name, doc_id
+
+        elif command_type == 'UPDATE':
+            collection_name, doc_id, document = self.parse_update()
+            self.failed = self.db.update_document(collection_name, doc_id, document) is None
+            return collection_name, doc_id, document
+
+        elif command_type == 'COMPACT':
+            collection_name = self.parse_compact()
+            self.failed = self.db.compact(collection_name) is None
+            return collection_name
+
         elif command_type == 'PRINT_INDEX':
             collection_name = self.parse_print_index()
-            self.db.print_index(collection_name)
+            self.failed = self.db.print_index(collection_name) is None
             return collection_name  
 
         elif command_type == 'SEARCH':
-            collection_name, word1, word2, dist = self.parse_search()
-            if collection_name and word1 and word2 and dist:
-                self.db.search_distance(collection_name, word1, word2, dist)
-                return collection_name, word1, word2, dist
+            return self.run_search(*self.parse_search())
 
-            elif collection_name and word1 and word2 and not dist:
-                self.db.search_range(collection_name, word1, word2)
-                return collection_name, word1, word2, dist
-
-            elif collection_name and word1 and not word2 and not dist:
-                self.db.search_word(collection_name, word1)
-                return collection_name, word1, word2, dist
+        elif command_type == 'EXPLAIN': # EXPLAIN SEARCH ...; prints the plan without running the search
+            self.eat('EXPLAIN')
+            collection_name, word1, word2, dist = self.parse_search()
+            self.failed = self.db.explain(collection_name, self.query, self.top_k) is None
+            return collection_name, word1, word2, dist
+
+        elif command_type == 'PROFILE': # PROFILE SEARCH ...; runs the search and prints where the time went
+            self.eat('PROFILE')
+            profile = Profile()
+            with profile.activate():
+                with profile.phase('lex + parse'):
+                    parsed = self.parse_search()
+                self.run_search(*parsed)
+            for line in profile.report():
+                print(line)
+            return parsed
+
+        elif command_type == 'METRICS':
+            self.eat('METRICS')
+            self.eat('EOI')
+            self.db.print_metrics()
 
-            elif collection_name and not word1 and not word2 and not dist:
-                self.db.search(collection_name)
-                return collection_name, word1, word2, dist
         else:
             self.error() 
 
+    def run_search(self, collection_name, word1, word2, dist):
+
+        """Runs a parsed SEARCH command"""
+
+        page = self.page_options()
+        if self.top_k is not None:
+            self.failed = self.db.search_top(collection_name, word1, self.top_k, **page) is None
+
+        elif isinstance(word1, Query):
+            self.failed = self.db.search_query(collection_name, word1, **page) is None
+
+        elif collection_name and word1 and word2 and dist is not None:
+            self.failed = self.db.search_distance(collection_name, word1, word2, dist, **page) is None
+
+        elif collection_name and word1 and word2 and dist is None:
+            self.failed = self.db.search_range(collection_name, word1, word2, **page) is None
+
+        elif collection_name and word1 and not word2 and not dist:
+            self.failed = self.db.search_word(collection_name, word1, **page) is None
+
+        elif collection_name and not word1 and not word2 and not dist:
+            self.failed = self.db.search(collection_name, **page) is None
+        return collection_name, word1, word2, dist
+
 
 
 
@@ -0,0 +1,508 @@
+from array import array
+from collections import deque
+from collections.abc import Sequence
+from heapq import merge
+from itertools import accumulate, chain, compress, repeat
+from operator import sub
+from bisect import bisect_left
+import bitmap
+
+# Sorted ID sequences of at least BITMAP_MIN_LENGTH IDs are intersected and subtracted
+# through byte masks (see bitmap.py) unless one is more than BITMAP_MAX_RATIO times longer
+# than the other, where galloping search skips most of the longer one
+BITMAP_MIN_LENGTH = 100
+BITMAP_MAX_RATIO = 8
+# Documents per block of an encoded posting list; BlockPostings decodes one block at a time
+BLOCK_SIZE = 128
+
+
+class PostingList:
+
+    """
+    Compact posting list for a single word.
+    Document IDs and positions are kept in flat `array('I')` buffers instead of a
+    dict of lists, which avoids the per-object overhead of one dict entry and one
+    list for every (word, document) pair. Supports the read-only parts of the
+    mapping interface ({document_id: [positions]}) used by the inverted index.
+
+    Readers may use the list while one writer appends to it. The writer appends the offset
+    of a new document, then its positions, then its ID, and readers read in the opposite
+    order: every document a reader finds has its offset in place, and the end of the last
+    document's positions is read before looking for the offset of a next one, so it never
+    takes in positions of a document that is being appended.
+    """
+
+    __slots__ = ('doc_ids', 'offsets', 'positions')
+
+    def __init__(self):
+
+        # Sorted document IDs
+        self.doc_ids = array('I')
+        # offsets[i] is the index in `positions` of the first position in document doc_ids[i]
+        self.offsets = array('I')
+        # Positions of all documents, concatenated in document order
+        self.positions = array('I')
+
+    def add(self, doc_id, position):
+
+        """Appends a position; documents and positions must be added in increasing order"""
+
+        if not self.doc_ids or self.doc_ids[-1] != doc_id:
+            if self.doc_ids and doc_id < self.doc_ids[-1]:
+                raise ValueError("Document IDs must be added in increasing order.")
+            self.offsets.append(len(self.positions))
+            self.positions.append(position)
+            self.doc_ids.append(doc_id)
+        else:
+            self.positions.append(position)
+
+    @classmethod
+    def from_lists(cls, doc_ids, offsets, positions):
+
+        """Builds a posting list from already sorted document IDs, offsets and positions"""
+
+        postings = cls()
+        postings.doc_ids = array('I', doc_ids)
+        postings.offsets = array('I', offsets)
+        postings.positions = array('I', positions)
+        return postings
+
+    def extend(self, other):
+
+        """Appends the postings of `other`, whose document IDs must all be greater than ours"""
+
+        if other.doc_ids and self.doc_ids and other.doc_ids[0] <= self.doc_ids[-1]:
+            raise ValueError("Document IDs must be added in increasing order.")
+        base = len(self.positions)
+        self.offsets.extend(map(base.__add__, other.offsets) if base else other.offsets)
+        self.positions.extend(other.positions)
+        self.doc_ids.extend(other.doc_ids)
+
+    def without(self, doc_ids):
+
+        """Returns the posting list without the documents in the set `doc_ids`,
+        or the list itself if it holds none of them"""
+
+        if not doc_ids:
+            return self
+        hits = list(map(doc_ids.__contains__, self.doc_ids))
+        if not any(hits):
+            return self
+        # The runs of documents between removed ones are copied with slices
+        postings = PostingList()
+        n = len(self.doc_ids)
+        start = 0
+        for removed in chain(compress(range(n), hits), (n,)):
+            if start < removed:
+                first = self.offsets[start]
+                end = self.offsets[removed] if removed < n else len(self.positions)
+                postings.offsets.extend(map((len(postings.positions) - first).__add__, self.offsets[start:removed]))
+                postings.positions.extend(self.positions[first:end])
+                postings.doc_ids.extend(self.doc_ids[start:removed])
+            start = removed + 1
+        return postings
+
+    def seek(self, doc_id, lo=0, hi=None):
+
+        """Returns the index of the first document >= doc_id in doc_ids[lo:hi], or hi if there is none"""
+
+        return bisect_left(self.doc_ids, doc_id, lo, len(self.doc_ids) if hi is None else hi)
+
+    def _find(self, doc_id):
+
+        """Returns the index of `doc_id` in `doc_ids`, or -1 if it is not there"""
+
+        i = bisect_left(self.doc_ids, doc_id)
+        if i < len(self.doc_ids) and self.doc_ids[i] == doc_id:
+            return i
+        return -1
+
+    def _end(self, i):
+
+        """Returns the index in `positions` after the last position of the i-th document"""
+
+        # Read first: if no document follows the i-th one below, none had positions yet either
+        end = len(self.positions)
+        return self.offsets[i + 1] if i + 1 < len(self.offsets) else end
+
+    def positions_at(self, i):
+
+        """Returns the positions of the i-th document of the list"""
+
+        return self.positions[self.offsets[i]:self._end(i)]
+
+    def frequency_at(self, i):
+
+        """Returns the number of positions of the i-th document of the list"""
+
+        return self._end(i) - self.offsets[i]
+
+    def max_frequency(self):
+
+        """Returns the largest number of positions in one document of the list"""
+
+        num_docs = len(self.doc_ids)
+        if not num_docs:
+            return 0
+        end = len(self.positions)
+        offsets = self.offsets[:num_docs + 1]
+        ends = offsets[1:]
+        if len(ends) < num_docs:
+            ends.append(end)
+        return max(map(sub, ends, offsets))
+
+    def __getitem__(self, doc_id):
+        i = self._find(doc_id)
+        if i < 0:
+            raise KeyError(doc_id)
+        return self.positions_at(i)
+
+    def get(self, doc_id, default=None):
+        i = self._find(doc_id)
+        return self.positions_at(i) if i >= 0 else default
+
+    def __contains__(self, doc_id):
+        return self._find(doc_id) >= 0
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __iter__(self):
+        return iter(self.doc_ids)
+
+    def keys(self):
+        return self.doc_ids
+
+    def items(self):
+        for i, doc_id in enumerate(self.doc_ids):
+            yield doc_id, self.positions_at(i)
+
+    def __eq__(self, other):
+        if not isinstance(other, PostingList):
+            return NotImplemented
+        return (self.doc_ids == other.doc_ids and self.offsets == other.offsets
+                and self.positions == other.positions)
+
+    def __repr__(self):
+        return '{' + ', '.join(f"{doc_id}: {list(positions)}" for doc_id, positions in self.items()) + '}'
+
+    def encode(self):
+
+        """Encodes the list as bytes: document IDs and positions are delta encoded
+        and every number is written as a variable-byte integer. The documents are split
+        into blocks of BLOCK_SIZE, and a skip table in front of them gives the last
+        document ID (delta encoded) and the size in bytes of every block."""
+
+        out = bytearray()
+        encode_varint(len(self.doc_ids), out)
+        blocks = bytearray()
+        previous_doc_id = 0
+        for start in range(0, len(self.doc_ids), BLOCK_SIZE):
+            block = bytearray()
+            block_start = previous_doc_id
+            for i in range(start, min(start + BLOCK_SIZE, len(self.doc_ids))):
+                doc_id = self.doc_ids[i]
+                encode_varint(doc_id - previous_doc_id, block)
+                previous_doc_id = doc_id
+                positions = self.positions_at(i)
+                encode_varint(len(positions), block)
+                previous_position = 0
+                for position in positions:
+                    encode_varint(position - previous_position, block)
+                    previous_position = position
+            encode_varint(previous_doc_id - block_start, out)
+            encode_varint(len(block), out)
+            blocks += block
+        return bytes(out + blocks)
+
+    @classmethod
+    def decode(cls, buffer, pos=0):
+
+        """Builds a posting list from the output of `encode`"""
+
+        postings = cls()
+        num_docs, pos = decode_varint(buffer, pos)
+        # The blocks follow each other, so the skip table is not needed to read them all
+        for _ in range(2 * (-(-num_docs // BLOCK_SIZE))):
+            _, pos = decode_varint(buffer, pos)
+        _decode_documents(buffer, pos, num_docs, 0, postings.doc_ids, postings.offsets, postings.positions)
+        return postings
+
+
+def _decode_documents(buffer, pos, num_docs, doc_id, doc_ids, offsets, positions):
+
+    """Appends `num_docs` encoded documents starting at `pos` to the arrays; `doc_id` is the
+    document ID the first gap is relative to"""
+
+    for _ in range(num_docs):
+        gap, pos = decode_varint(buffer, pos)
+        doc_id += gap
+        doc_ids.append(doc_id)
+        offsets.append(len(positions))
+        num_positions, pos = decode_varint(buffer, pos)
+        position = 0
+        for _ in range(num_positions):
+            gap, pos = decode_varint(buffer, pos)
+            position += gap
+            positions.append(position)
+
+
+class BlockPostings:
+
+    """
+    Read-only posting list over the output of `PostingList.encode` that decodes one block
+    of BLOCK_SIZE documents at a time. Only the skip table is read up front, and `seek`
+    uses the last document IDs of the blocks to go straight to the block of a document,
+    so ranking, which only looks at the candidate documents of most words, does not decode
+    the rest of their lists. Supports what `ranking.ScoredTerm` reads from a PostingList.
+    """
+
+    def __init__(self, buffer, max_frequency):
+
+        self.buffer = buffer
+        self.num_docs, pos = decode_varint(buffer, 0)
+        self._max_frequency = max_frequency
+        # Last document ID and start in `buffer` of every block
+        self.last_ids = array('Q')
+        sizes = []
+        for _ in range(-(-self.num_docs // BLOCK_SIZE)):
+            gap, pos = decode_varint(buffer, pos)
+            self.last_ids.append((self.last_ids[-1] if self.last_ids else 0) + gap)
+            size, pos = decode_varint(buffer, pos)
+            sizes.append(size)
+        # The blocks follow the skip table in order
+        self.starts = array('Q', accumulate([pos] + sizes))[:-1]
+        # Number and contents of the decoded block
+        self.block = -1
+        self.block_postings = PostingList()
+
+    @property
+    def doc_ids(self):
+        # Not stored, which would make a reference cycle that keeps the mapped buffer alive
+        return _BlockDocIds(self)
+
+    def _load(self, block):
+
+        """Decodes a block unless it is the decoded one already"""
+
+        if block != self.block:
+            postings = PostingList()
+            _decode_documents(self.buffer, self.starts[block],
+                              min(BLOCK_SIZE, self.num_docs - block * BLOCK_SIZE),
+                              self.last_ids[block - 1] if block else 0,
+                              postings.doc_ids, postings.offsets, postings.positions)
+            self.block, self.block_postings = block, postings
+        return self.block_postings
+
+    def seek(self, doc_id, lo=0, hi=None):
+
+        """Returns the index of the first document >= doc_id in doc_ids[lo:hi], or hi if there is none"""
+
+        hi = self.num_docs if hi is None else hi
+        block = bisect_left(self.last_ids, doc_id, lo // BLOCK_SIZE)
+        base = block * BLOCK_SIZE
+        if base >= hi:
+            return hi
+        i = base + self._load(block).seek(doc_id, max(lo - base, 0))
+        return min(i, hi)
+
+    def doc_id_at(self, i):
+        return self._load(i // BLOCK_SIZE).doc_ids[i % BLOCK_SIZE]
+
+    def positions_at(self, i):
+        return self._load(i // BLOCK_SIZE).positions_at(i % BLOCK_SIZE)
+
+    def frequency_at(self, i):
+        return self._load(i // BLOCK_SIZE).frequency_at(i % BLOCK_SIZE)
+
+    def max_frequency(self):
+
+        """Returns the largest number of positions in one document, which the caller stored next to the list"""
+
+        return self._max_frequency
+
+    def __len__(self):
+        return self.num_docs
+
+
+class _BlockDocIds(Sequence):
+
+    """The document IDs of a BlockPostings, decoded block by block on access"""
+
+    def __init__(self, postings):
+        self.postings = postings
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.postings.doc_id_at(i)
+
+    def __len__(self):
+        return self.postings.num_docs
+
+
+def encode_varint(value, out):
+
+    """Appends `value` to `out` as a variable-byte integer (7 bits per byte, high bit = more bytes follow)"""
+
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(buffer, pos):
+
+    """Reads a variable-byte integer starting at `pos`; returns the value and the position after it"""
+
+    value = 0
+    shift = 0
+    while True:
+        byte = buffer[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def has_distance(positions1, positions2, distance):
+
+    """Checks whether some p1 in `positions1` and p2 in `positions2` satisfy |p1 - p2| == distance.
+    Both position lists must be sorted; they are merged in a single linear pass."""
+
+    n = len(positions2)
+    lower = upper = 0  # Pointers into positions2 for the targets p1 - distance and p1 + distance
+
+    for p1 in positions1:
+        while lower < n and positions2[lower] < p1 - distance:
+            lower += 1
+        if lower < n and positions2[lower] == p1 - distance:
+            return True
+
+        while upper < n and positions2[upper] < p1 + distance:
+            upper += 1
+        if upper < n and positions2[upper] == p1 + distance:
+            return True
+
+        if lower == n:
+            return False  # Every remaining p1 is too far past the end of positions2
+
+    return False
+
+
+def within_window(position_lists, counts, window):
+
+    """Checks whether a window of positions p..p + window holds counts[i] positions of
+    position_lists[i] for every i. The sorted lists are merged into one stream, which a
+    sliding window scans once: it grows by the next position and shrinks from the left
+    while it is wider than `window`, so the cost does not depend on `window`."""
+
+    if counts == [1, 1]:
+        # Two words: the nearest position of the second word for each of the first is enough
+        positions1, positions2 = position_lists
+        j, n = 0, len(positions2)
+        for p1 in positions1:
+            while j < n and positions2[j] < p1 - window:
+                j += 1
+            if j == n:
+                return False
+            if positions2[j] <= p1 + window:
+                return True
+        return False
+
+    in_window = [0] * len(position_lists)
+    missing = len(position_lists)  # Lists with fewer than counts[i] positions in the window
+    entries = deque()
+    for entry in merge(*(zip(positions, repeat(i)) for i, positions in enumerate(position_lists))):
+        pos, i = entry
+        entries.append(entry)
+        in_window[i] += 1
+        if in_window[i] == counts[i]:
+            missing -= 1
+        while pos - entries[0][0] > window:
+            _, j = entries.popleft()
+            if in_window[j] == counts[j]:
+                missing += 1
+            in_window[j] -= 1
+        if not missing:
+            return True
+    return False
+
+
+def in_order_within(position_lists, window):
+
+    """Checks whether some p1 < p2 < ... < pk, with pi in position_lists[i], satisfy pk - p1 <= window.
+    For every p1 the earliest following positions give the earliest pk; they never move back
+    as p1 grows, so every list is scanned once from left to right."""
+
+    cursors = [0] * (len(position_lists) - 1)
+    for start in position_lists[0]:
+        pos = start
+        for i, positions in enumerate(position_lists[1:]):
+            cursor, n = cursors[i], len(positions)
+            while cursor < n and positions[cursor] <= pos:
+                cursor += 1
+            cursors[i] = cursor
+            if cursor == n:
+                return False  # No later start can be followed by this word either
+            pos = positions[cursor]
+            if pos - start > window:
+                break
+        else:
+            return True
+    return False
+
+
+def intersect(doc_ids1, doc_ids2):
+
+    """Intersects two sorted document ID sequences.
+    Every ID of the shorter sequence is looked up in the longer one by galloping
+    (exponential) search from the previous match, so the cost is
+    O(n log(m / n)) for lengths n <= m instead of O(n + m). Long sequences of
+    similar lengths are intersected through byte masks instead."""
+
+    if len(doc_ids1) > len(doc_ids2):
+        doc_ids1, doc_ids2 = doc_ids2, doc_ids1
+    if len(doc_ids1) >= BITMAP_MIN_LENGTH and len(doc_ids2) <= BITMAP_MAX_RATIO * len(doc_ids1):
+        return bitmap.intersection(doc_ids1, doc_ids2)
+    result = []
+    lo, n = 0, len(doc_ids2)
+    for doc_id in doc_ids1:
+        lo = _gallop(doc_ids2, doc_id, lo, n)
+        if lo == n:
+            break
+        if doc_ids2[lo] == doc_id:
+            result.append(doc_id)
+            lo += 1
+    return result
+
+
+def difference(doc_ids1, doc_ids2):
+
+    """Returns the IDs of sorted `doc_ids1` that are not in sorted `doc_ids2`, using galloping
+    search, or byte masks unless `doc_ids2` is much longer"""
+
+    if len(doc_ids1) >= BITMAP_MIN_LENGTH and len(doc_ids2) <= BITMAP_MAX_RATIO * len(doc_ids1):
+        return bitmap.difference(doc_ids1, doc_ids2)
+    result = []
+    lo, n = 0, len(doc_ids2)
+    for doc_id in doc_ids1:
+        lo = _gallop(doc_ids2, doc_id, lo, n)
+        if lo == n or doc_ids2[lo] != doc_id:
+            result.append(doc_id)
+    return result
+
+
+def _gallop(doc_ids, doc_id, lo, n):
+
+    """Returns the first index >= lo with doc_ids[index] >= doc_id (or n)"""
+
+    bound = 1
+    while lo + bound < n and doc_ids[lo + bound] < doc_id:
+        bound *= 2
+    return bisect_left(doc_ids, doc_id, lo, min(lo + bound + 1, n))
@@ -0,0 +1,537 @@
+"""
+Query trees for boolean searches.
+
+Leaves are words, ranges, wildcard and fuzzy words, distance and proximity queries and
+phrases; inner nodes are AND, OR and NOT.
+`evaluate` returns the sorted IDs of the matching documents of an index. AND nodes are
+planned from estimated result sizes: the rarest operand is evaluated first and the others
+are intersected with it by galloping search, so a conjunction costs about as much as its
+most selective operand. Long results of similar sizes and NOT are combined through byte
+masks instead, and OR unites results in sets, one per chunk of IDs for large unions (see
+bitmap.py). `matches` evaluates a query on a single document, given as {word: [positions]}. `explain` describes the plan `evaluate` follows, with the sizes of
+the posting lists involved.
+
+Queries are written in words and evaluated on terms: `analyze` maps every word through
+the analyzer of the collection (see analyzer.py). A word the analyzer removes keeps its
+raw form in terms and distances, where it matches nothing, and leaves a gap in phrases.
+"""
+
+from bitmap import union
+from metrics import touch
+from collections import Counter
+from postings import PostingList, difference, has_distance, in_order_within, intersect, within_window
+from termindex import edit_distance, wildcard_regex
+
+
+class QueryContext:
+
+    """Evaluation state of one query on one index: memoizes posting list lookups"""
+
+    def __init__(self, index):
+        self.index = index
+        self.postings_by_word = {}
+
+    def postings(self, word):
+
+        """Returns the posting list of `word` (empty if the word is not in the index)"""
+
+        postings = self.postings_by_word.get(word)
+        if postings is None:
+            postings = self.postings_by_word[word] = self.index.index.get(word) or PostingList()
+            touch(word, len(postings))
+        return postings
+
+    def document_frequency(self, word):
+        return len(self.postings(word))
+
+
+class Query:
+
+    """Base class of query nodes"""
+
+    def key(self):
+
+        """Returns a tuple identifying the query, used for equality and hashing"""
+
+        raise NotImplementedError
+
+    def __eq__(self, other):
+        return isinstance(other, Query) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def estimate(self, context):
+
+        """Returns an upper bound of the number of matching documents"""
+
+        raise NotImplementedError
+
+    def evaluate(self, context):
+
+        """Returns the sorted IDs of the matching documents"""
+
+        raise NotImplementedError
+
+    def matches(self, positions):
+
+        """Checks whether a single document, given as {word: [positions]}, matches the query"""
+
+        raise NotImplementedError
+
+    def ranked_words(self):
+
+        """Returns the words a matching document is ranked by (words under NOT and ranges are not)"""
+
+        return []
+
+    def analyze(self, analyzer):
+
+        """Returns the query with its words replaced by their terms"""
+
+        return self
+
+    def explain(self, context, depth=0):
+
+        """Returns the evaluation plan of the query as lines of text indented by `depth` levels"""
+
+        return [f"{'  ' * depth}{self!r}: at most {self.estimate(context)} documents"]
+
+
+class Term(Query):
+
+    def __init__(self, word):
+        self.word = word.lower()
+
+    def key(self):
+        return ('word', self.word)
+
+    def __repr__(self):
+        return f'"{self.word}"'
+
+    def estimate(self, context):
+        return context.document_frequency(self.word)
+
+    def evaluate(self, context):
+        return list(context.postings(self.word).keys())
+
+    def matches(self, positions):
+        return self.word in positions
+
+    def ranked_words(self):
+        return [self.word]
+
+    def analyze(self, analyzer):
+        return Term(analyzer.term(self.word) or self.word)
+
+    def explain(self, context, depth=0):
+        return [f"{'  ' * depth}{self!r}: posting list of {context.document_frequency(self.word)} documents"]
+
+
+class Range(Query):
+
+    def __init__(self, word1, word2):
+        self.word1, self.word2 = word1.lower(), word2.lower()
+
+    def key(self):
+        return ('range', self.word1, self.word2)
+
+    def __repr__(self):
+        return f'"{self.word1}" - "{self.word2}"'
+
+    def estimate(self, context):
+        return sum(context.document_frequency(word) for word in context.index.terms_in_range(self.word1, self.word2))
+
+    def evaluate(self, context):
+        return context.index.search_range(self.word1, self.word2)
+
+    def matches(self, positions):
+        return any(self.word1 <= word <= self.word2 for word in positions)
+
+    def explain(self, context, depth=0):
+        words = context.index.terms_in_range(self.word1, self.word2)
+        return [f"{'  ' * depth}{self!r}: union of the posting lists of {len(words)} words in the range, "
+                f"{sum(map(context.document_frequency, words))} documents"]
+
+
+class Wildcard(Query):
+
+    """Words matching a pattern in which * stands for any characters and ? for one character.
+    The pattern is not analyzed, so it is matched against the stored terms as written."""
+
+    def __init__(self, pattern):
+        self.pattern = pattern.lower()
+
+    def key(self):
+        return ('wildcard', self.pattern)
+
+    def __repr__(self):
+        return f'"{self.pattern}"'
+
+    def estimate(self, context):
+        return sum(context.document_frequency(word) for word in context.index.terms_matching(self.pattern))
+
+    def evaluate(self, context):
+        return context.index.search_wildcard(self.pattern)
+
+    def matches(self, positions):
+        regex = wildcard_regex(self.pattern)
+        return any(regex.fullmatch(word) for word in positions)
+
+    def explain(self, context, depth=0):
+        words = context.index.terms_matching(self.pattern)
+        return [f"{'  ' * depth}{self!r}: union of the posting lists of {len(words)} words found through the k-gram index, "
+                f"{sum(map(context.document_frequency, words))} documents"]
+
+
+class Fuzzy(Query):
+
+    """Words within `max_edits` insertions, deletions or substitutions of a word"""
+
+    def __init__(self, word, max_edits):
+        self.word, self.max_edits = word.lower(), max_edits
+
+    def key(self):
+        return ('fuzzy', self.word, self.max_edits)
+
+    def __repr__(self):
+        return f'"{self.word}"~{self.max_edits}'
+
+    def estimate(self, context):
+        return sum(context.document_frequency(word) for word in context.index.terms_fuzzy(self.word, self.max_edits))
+
+    def evaluate(self, context):
+        return context.index.search_fuzzy(self.word, self.max_edits)
+
+    def matches(self, positions):
+        return any(edit_distance(self.word, word) <= self.max_edits for word in positions)
+
+    def analyze(self, analyzer):
+        return Fuzzy(analyzer.term(self.word) or self.word, self.max_edits)
+
+    def explain(self, context, depth=0):
+        words = context.index.terms_fuzzy(self.word, self.max_edits)
+        return [f"{'  ' * depth}{self!r}: union of the posting lists of {len(words)} words found by the Levenshtein "
+                f"automaton, {sum(map(context.document_frequency, words))} documents"]
+
+
+class Distance(Query):
+
+    def __init__(self, word1, word2, distance):
+        self.word1, self.word2, self.distance = word1.lower(), word2.lower(), distance
+
+    def key(self):
+        return ('distance', self.word1, self.word2, self.distance)
+
+    def __repr__(self):
+        return f'"{self.word1}" <{self.distance}> "{self.word2}"'
+
+    def estimate(self, context):
+        return min(context.document_frequency(self.word1), context.document_frequency(self.word2))
+
+    def evaluate(self, context):
+        return context.index.search_distance(self.word1, self.word2, self.distance)
+
+    def matches(self, positions):
+        return (self.word1 in positions and self.word2 in positions
+                and has_distance(positions[self.word1], positions[self.word2], self.distance))
+
+    def ranked_words(self):
+        return [self.word1, self.word2]
+
+    def analyze(self, analyzer):
+        return Distance(analyzer.term(self.word1) or self.word1, analyzer.term(self.word2) or self.word2, self.distance)
+
+    def explain(self, context, depth=0):
+        return [f"{'  ' * depth}{self!r}: walk the posting list of {self.estimate(context)} documents of the rarer word "
+                f"(\"{self.word1}\": {context.document_frequency(self.word1)}, "
+                f"\"{self.word2}\": {context.document_frequency(self.word2)}) and compare positions"]
+
+
+class Near(Query):
+
+    """Two or more words within a window of `distance` words: the first and the last of them are
+    at most `distance` positions apart. With `ordered` they must also occur in the given order."""
+
+    def __init__(self, words, distance, ordered=False):
+        self.words, self.distance, self.ordered = [word.lower() for word in words], distance, ordered
+
+    def key(self):
+        return ('onear' if self.ordered else 'near', self.distance) + tuple(self.words)
+
+    def __repr__(self):
+        operator = f" {'ONEAR' if self.ordered else 'NEAR'}/{self.distance} "
+        return operator.join(f'"{word}"' for word in self.words)
+
+    def estimate(self, context):
+        return min(context.document_frequency(word) for word in self.words)
+
+    def evaluate(self, context):
+        # Documents containing every word, intersected from the rarest word up
+        words = sorted(set(self.words), key=context.document_frequency)
+        doc_ids = list(context.postings(words[0]).keys())
+        for word in words[1:]:
+            if not doc_ids:
+                break
+            doc_ids = intersect(doc_ids, context.postings(word).keys())
+
+        if self.ordered:
+            postings = [context.postings(word) for word in self.words]
+            return [doc_id for doc_id in doc_ids
+                    if in_order_within([word_postings[doc_id] for word_postings in postings], self.distance)]
+        counts = Counter(self.words)
+        postings = [context.postings(word) for word in counts]
+        return [doc_id for doc_id in doc_ids
+                if within_window([word_postings[doc_id] for word_postings in postings], list(counts.values()),
+                                 self.distance)]
+
+    def matches(self, positions):
+        if not all(word in positions for word in self.words):
+            return False
+        if self.ordered:
+            return in_order_within([positions[word] for word in self.words], self.distance)
+        counts = Counter(self.words)
+        return within_window([positions[word] for word in counts], list(counts.values()), self.distance)
+
+    def ranked_words(self):
+        return list(self.words)
+
+    def analyze(self, analyzer):
+        return Near([analyzer.term(word) or word for word in self.words], self.distance, self.ordered)
+
+    def explain(self, context, depth=0):
+        words = sorted(set(self.words), key=context.document_frequency)
+        window = 'in order ' if self.ordered else ''
+        return [f"{'  ' * depth}{self!r}: intersect rarest first "
+                + ', '.join(f'"{word}" ({context.document_frequency(word)})' for word in words)
+                + f", then look for the words {window}within {self.distance} positions in one pass over their positions"]
+
+
+class Phrase(Query):
+
+    """Words that occur next to each other in the given order. None stands for a removed word,
+    which may be any word of the document."""
+
+    def __init__(self, words):
+        words = [None if word is None else word.lower() for word in words]
+        # Gaps at the ends do not constrain the phrase
+        while words and words[-1] is None:
+            words.pop()
+        self.words = words[next(i for i, word in enumerate(words) if word is not None):]
+
+    def key(self):
+        return ('phrase',) + tuple(self.words)
+
+    def __repr__(self):
+        return '"' + ' '.join('*' if word is None else word for word in self.words) + '"'
+
+    def _offsets(self):
+
+        """Returns (offset in the phrase, word) of every word that is not a gap"""
+
+        return [(i, word) for i, word in enumerate(self.words) if word is not None]
+
+    def estimate(self, context):
+        return min(context.document_frequency(word) for _, word in self._offsets())
+
+    def evaluate(self, context):
+        # Documents containing every word, intersected from the rarest word up
+        words = sorted({word for _, word in self._offsets()}, key=context.document_frequency)
+        doc_ids = list(context.postings(words[0]).keys())
+        for word in words[1:]:
+            if not doc_ids:
+                break
+            doc_ids = intersect(doc_ids, context.postings(word).keys())
+
+        position_lists = [(i, context.postings(word)) for i, word in self._offsets()]
+        return [doc_id for doc_id in doc_ids
+                if self._has_phrase([(i, postings[doc_id]) for i, postings in position_lists])]
+
+    def matches(self, positions):
+        offsets = self._offsets()
+        return all(word in positions for _, word in offsets) and \
+            self._has_phrase([(i, positions[word]) for i, word in offsets])
+
+    def ranked_words(self):
+        return [word for word in self.words if word is not None]
+
+    def analyze(self, analyzer):
+        terms = [None if word is None else analyzer.term(word) for word in self.words]
+        if all(term is None for term in terms):
+            return self
+        return Phrase(terms)
+
+    def explain(self, context, depth=0):
+        words = sorted({word for _, word in self._offsets()}, key=context.document_frequency)
+        return [f"{'  ' * depth}{self!r}: intersect rarest first "
+                + ', '.join(f'"{word}" ({context.document_frequency(word)})' for word in words)
+                + ", then compare positions"]
+
+    @staticmethod
+    def _has_phrase(position_lists):
+
+        """Checks whether some p has p + i in the position list of offset i for every (i, positions);
+        the first offset is 0"""
+
+        starts = set(position_lists[0][1])
+        for i, positions in position_lists[1:]:
+            starts.intersection_update(pos - i for pos in positions)
+            if not starts:
+                return False
+        return True
+
+
+class And(Query):
+
+    def __init__(self, children):
+        self.children = children
+
+    def key(self):
+        return ('and',) + tuple(child.key() for child in self.children)
+
+    def __repr__(self):
+        return '(' + ' AND '.join(map(repr, self.children)) + ')'
+
+    def estimate(self, context):
+        positives = [child for child in self.children if not isinstance(child, Not)]
+        if not positives:
+            return len(context.index.search())
+        return min(child.estimate(context) for child in positives)
+
+    def evaluate(self, context):
+        positives = [child for child in self.children if not isinstance(child, Not)]
+        negatives = [child.child for child in self.children if isinstance(child, Not)]
+
+        if positives:
+            # Query plan: start from the operand with the fewest documents
+            positives.sort(key=lambda child: child.estimate(context))
+            doc_ids = positives[0].evaluate(context)
+            for child in positives[1:]:
+                if not doc_ids:
+                    return []
+                if isinstance(child, Term):
+                    doc_ids = intersect(doc_ids, context.postings(child.word).keys())
+                else:
+                    doc_ids = intersect(doc_ids, child.evaluate(context))
+        else:
+            doc_ids = context.index.search()
+
+        for child in negatives:
+            if not doc_ids:
+                break
+            if isinstance(child, Term):
+                doc_ids = difference(doc_ids, context.postings(child.word).keys())
+            else:
+                doc_ids = difference(doc_ids, child.evaluate(context))
+        return doc_ids
+
+    def matches(self, positions):
+        return all(child.matches(positions) for child in self.children)
+
+    def ranked_words(self):
+        return [word for child in self.children for word in child.ranked_words()]
+
+    def analyze(self, analyzer):
+        return And([child.analyze(analyzer) for child in self.children])
+
+    def explain(self, context, depth=0):
+        positives = sorted((child for child in self.children if not isinstance(child, Not)),
+                           key=lambda child: child.estimate(context))
+        negatives = [child.child for child in self.children if isinstance(child, Not)]
+        indent = '  ' * depth
+        if positives:
+            lines = [f"{indent}AND: start from the operand with the fewest documents, intersect the others by galloping search"]
+        else:
+            lines = [f"{indent}AND: start from all {len(context.index.search())} documents"]
+        for child in positives:
+            lines += child.explain(context, depth + 1)
+        for child in negatives:
+            lines.append(f"{indent}  minus:")
+            lines += child.explain(context, depth + 2)
+        return lines
+
+
+class Or(Query):
+
+    def __init__(self, children):
+        self.children = children
+
+    def key(self):
+        return ('or',) + tuple(child.key() for child in self.children)
+
+    def __repr__(self):
+        return '(' + ' OR '.join(map(repr, self.children)) + ')'
+
+    def estimate(self, context):
+        return sum(child.estimate(context) for child in self.children)
+
+    def evaluate(self, context):
+        return union([child.evaluate(context) for child in self.children])
+
+    def matches(self, positions):
+        return any(child.matches(positions) for child in self.children)
+
+    def ranked_words(self):
+        return [word for child in self.children for word in child.ranked_words()]
+
+    def analyze(self, analyzer):
+        return Or([child.analyze(analyzer) for child in self.children])
+
+    def explain(self, context, depth=0):
+        lines = [f"{'  ' * depth}OR: unite the results of {len(self.children)} operands in sets"]
+        for child in self.children:
+            lines += child.explain(context, depth + 1)
+        return lines
+
+
+class Not(Query):
+
+    def __init__(self, child):
+        self.child = child
+
+    def key(self):
+        return ('not', self.child.key())
+
+    def __repr__(self):
+        return f'NOT {self.child!r}'
+
+    def estimate(self, context):
+        return len(context.index.search())
+
+    def evaluate(self, context):
+        return difference(context.index.search(), self.child.evaluate(context))
+
+    def matches(self, positions):
+        return not self.child.matches(positions)
+
+    def analyze(self, analyzer):
+        return Not(self.child.analyze(analyzer))
+
+    def explain(self, context, depth=0):
+        return ([f"{'  ' * depth}NOT: all {len(context.index.search())} documents minus"]
+                + self.child.explain(context, depth + 1))
+
+
+def evaluate(query, index):
+
+    """Returns the sorted IDs of the documents of `index` that match `query`"""
+
+    return query.evaluate(QueryContext(index))
+
+
+def explain(query, index):
+
+    """Returns the plan `evaluate` follows for `query` on `index`, as lines of text"""
+
+    return query.explain(QueryContext(index))
+
+
+def document_positions(tokens):
+
+    """Returns {word: [positions]} of a document, for `Query.matches`; None tokens (removed words) are skipped"""
+
+    positions = {}
+    for pos, word in enumerate(tokens):
+        if word is not None:
+            positions.setdefault(word.lower(), []).append(pos)
+    return positions
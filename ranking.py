@@ -0,0 +1,205 @@
+"""
+Ranked retrieval with BM25.
+
+`top_k` returns the k best scoring documents of an index that match a query. Documents
+are scored with BM25 over the words of the query, using the term frequencies stored in
+the posting lists and the length of every document.
+
+Documents that cannot reach the top k are skipped with MaxScore pruning: every word has
+an upper bound of its score in any document, and the words are sorted by their bounds.
+Once k documents have been found, the words whose bounds add up to less than the k-th
+best score are non-essential: a document containing only those cannot enter the top k,
+so candidates are only taken from the posting lists of the essential words, and the
+non-essential words are looked up (by binary search) only while the candidate can still
+beat the threshold. The set of essential words shrinks as the threshold grows, so common
+words stop being scanned as soon as the rarer words have filled the top k.
+
+Segments store the highest term frequency of every word next to its posting list, and
+their lists are read through BlockPostings, which decodes only the blocks that the cursors
+move into: the blocks of a non-essential word that hold no candidate are never decoded.
+"""
+
+import heapq
+import math
+from itertools import accumulate
+from metrics import touch
+from query import Or, Term, evaluate
+
+# BM25 parameters: term frequency saturation and document length normalization
+K1 = 1.2
+B = 0.75
+
+# Relative slack added to upper bounds, so rounding errors never prune a document that belongs in the top k
+BOUND_SLACK = 1e-9
+
+
+class CollectionStats:
+
+    """
+    Collection-wide statistics that BM25 scores depend on: the number of documents,
+    their total length and the document frequencies of the query words.
+    Parts of a collection (segments, shards) are scored with the statistics of the whole
+    collection, so scores do not depend on how the documents are split between them.
+    """
+
+    def __init__(self, num_docs=0, total_length=0, document_frequencies=None):
+        self.num_docs = num_docs
+        self.total_length = total_length
+        self.document_frequencies = document_frequencies or {}
+
+    def __add__(self, other):
+        document_frequencies = dict(self.document_frequencies)
+        for word, frequency in other.document_frequencies.items():
+            document_frequencies[word] = document_frequencies.get(word, 0) + frequency
+        return CollectionStats(self.num_docs + other.num_docs, self.total_length + other.total_length,
+                               document_frequencies)
+
+    def average_length(self):
+        return self.total_length / self.num_docs if self.num_docs else 1.0
+
+    def idf(self, word):
+
+        """Inverse document frequency of a word (the variant that is never negative)"""
+
+        frequency = self.document_frequencies.get(word, 0)
+        return math.log(1 + (self.num_docs - frequency + 0.5) / (frequency + 0.5))
+
+
+def term_score(idf, frequency, length, average_length):
+
+    """BM25 score of a word that occurs `frequency` times in a document of `length` words"""
+
+    return idf * frequency * (K1 + 1) / (frequency + K1 * (1 - B + B * length / average_length))
+
+
+class ScoredTerm:
+
+    """A query word with its posting list (a PostingList, or a BlockPostings of a segment),
+    IDF and the upper bound of its score"""
+
+    def __init__(self, postings, idf, average_length, limit=None):
+
+        self.postings = postings
+        self.doc_ids = postings.doc_ids
+        # Documents from `end` on are not part of the ranked snapshot
+        self.end = len(postings) if limit is None else postings.seek(limit)
+        self.idf = idf
+        # The score grows with the frequency and falls with the document length, and a document
+        # is at least as long as the frequency of any of its words, so this bounds every document
+        frequency = postings.max_frequency()
+        self.bound = term_score(idf, frequency, frequency, average_length) * (1 + BOUND_SLACK)
+        # Index of the next document to look at
+        self.cursor = 0
+
+    def seek(self, doc_id):
+
+        """Moves the cursor to the first document >= doc_id; returns True if that is doc_id"""
+
+        self.cursor = self.postings.seek(doc_id, self.cursor, self.end)
+        return self.cursor < self.end and self.doc_ids[self.cursor] == doc_id
+
+    def score(self, length, average_length):
+
+        """Score of the document under the cursor"""
+
+        return term_score(self.idf, self.postings.frequency_at(self.cursor), length, average_length)
+
+
+def _is_disjunction(query):
+
+    """Checks whether the documents matching the query are exactly those containing one of its words"""
+
+    return isinstance(query, Term) or (isinstance(query, Or) and all(isinstance(child, Term) for child in query.children))
+
+
+def top_k(index, query, k, stats, limit=None):
+
+    """Returns [(doc_id, score)] of the `k` best scoring documents of `index` that match `query`,
+    best first; documents with equal scores are ordered by ID. `stats` are the CollectionStats
+    of the whole collection `index` belongs to. Documents with IDs from `limit` on and the
+    deleted documents of the index are ignored."""
+
+    if k <= 0:
+        return []
+
+    average_length = stats.average_length()
+    # Read before the posting lists, which still hold the deleted documents until a compaction
+    deleted = index.deleted or None
+    terms = []
+    for word in dict.fromkeys(query.ranked_words()):
+        postings = index.ranked_postings(word)
+        if postings:
+            touch(word, len(postings))
+            terms.append(ScoredTerm(postings, stats.idf(word), average_length, limit))
+    terms.sort(key=lambda term: term.bound)
+    # bounds[i]: the highest total score of terms[0..i]
+    bounds = list(accumulate(term.bound for term in terms))
+    max_score = bounds[-1] if bounds else 0.0
+
+    # Min-heap of (score, -doc_id) holding the best k documents found so far
+    heap = []
+
+    def threshold():
+        return heap[0][0] if len(heap) == k else -1.0
+
+    def score_document(doc_id, contributions, partial, rest, length=None):
+
+        """Adds the scores of terms[rest], terms[rest - 1], ..., terms[0] and keeps the document
+        if it makes the top k; stops early once the document can no longer get there"""
+
+        for i in range(rest, -1, -1):
+            if partial + bounds[i] <= threshold():
+                return
+            term = terms[i]
+            if term.seek(doc_id):
+                if length is None:
+                    length = index.document_length(doc_id)
+                contribution = term.score(length, average_length)
+                contributions.append(contribution)
+                partial += contribution
+
+        # fsum is exact, so the score does not depend on the order the terms were added in
+        entry = (math.fsum(contributions), -doc_id)
+        if len(heap) < k:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+    if _is_disjunction(query):
+        # terms[first_essential:] are the essential terms
+        first_essential = 0
+        while True:
+            while first_essential < len(terms) and bounds[first_essential] <= threshold():
+                first_essential += 1
+            essential = [term for term in terms[first_essential:] if term.cursor < term.end]
+            if not essential:
+                break
+            doc_id = min(term.doc_ids[term.cursor] for term in essential)
+            if deleted is not None and doc_id in deleted:
+                for term in essential:
+                    if term.doc_ids[term.cursor] == doc_id:
+                        term.cursor += 1
+                continue
+            length = index.document_length(doc_id)
+            contributions = []
+            for term in essential:
+                if term.doc_ids[term.cursor] == doc_id:
+                    contributions.append(term.score(length, average_length))
+                    term.cursor += 1
+            score_document(doc_id, contributions, sum(contributions), first_essential - 1, length)
+    else:
+        for doc_id in evaluate(query, index):
+            if max_score <= threshold() or (limit is not None and doc_id >= limit):
+                break
+            if deleted is None or doc_id not in deleted:
+                score_document(doc_id, [], 0.0, len(terms) - 1)
+
+    return [(-negative_doc_id, score) for score, negative_doc_id in sorted(heap, reverse=True)]
+
+
+def merge_top_k(results, k):
+
+    """Merges the top k lists of several parts of a collection into the top k of the whole collection"""
+
+    return heapq.nsmallest(k, (entry for result in results for entry in result),
+                           key=lambda entry: (-entry[1], entry[0]))
@@ -0,0 +1,392 @@
+"""
+Immutable on-disk segments.
+
+A segment is written once and never modified. It consists of three files:
+
+    <name>.terms     sorted term dictionary with offsets into the postings file, and the
+                     document frequency and highest term frequency of every word
+    <name>.postings  delta + varint encoded posting lists, in blocks behind a skip table
+    <name>.docs      document store: sorted document IDs, offsets, document lengths and UTF-8 text
+
+Documents deleted from a segment are recorded next to it, in <name>.del (the sorted IDs
+of the deleted documents), which is replaced as a whole when more documents are deleted.
+They stay in the other files until the segment is merged or compacted into a new one.
+
+All files are opened with `mmap`, so opening a segment costs the same regardless of
+its size and only the pages touched by queries are read from disk. Integers are
+stored as 64-bit little-endian numbers. On little-endian machines the arrays of a file
+are read as views of the map; on big-endian machines they are byte-swapped copies.
+"""
+
+import heapq
+import mmap
+import os
+import struct
+import sys
+from array import array
+from itertools import groupby
+from bisect import bisect_left
+from collections.abc import Mapping, Sequence
+from postings import BlockPostings, PostingList
+from wal import sync_directory
+
+HEADER = struct.Struct('<4sQ')
+TERMS_MAGIC = b'OAT2'
+DOCS_MAGIC = b'OADL'
+MANIFEST = 'segments'
+# Numbers per entry of the term dictionary: term offset, postings offset, document frequency, maximum frequency
+ENTRY_SIZE = 4
+LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+def write_segment(directory, name, postings_by_term, documents):
+
+    """Writes a segment to `directory`.
+
+    postings_by_term: iterable of (word, PostingList) pairs sorted by word
+    documents: iterable of (document_id, document(str), length in words) sorted by document ID
+    """
+
+    # Entry i describes word i, and the offsets of entry i + 1 end the word and its postings
+    entries = array('Q', [0, 0])
+    term_blob = bytearray()
+    with open(os.path.join(directory, name + '.postings'), 'wb') as postings_file:
+        for word, postings in postings_by_term:
+            term_blob += word.encode('utf-8')
+            postings_file.write(postings.encode())
+            entries.extend((len(postings), postings.max_frequency(), len(term_blob), postings_file.tell()))
+        _sync(postings_file)
+    entries.extend((0, 0))
+
+    with open(os.path.join(directory, name + '.terms'), 'wb') as terms_file:
+        terms_file.write(HEADER.pack(TERMS_MAGIC, len(entries) // ENTRY_SIZE - 1))
+        terms_file.write(_to_bytes(entries))
+        terms_file.write(term_blob)
+        _sync(terms_file)
+
+    doc_ids, doc_offsets, doc_lengths = array('Q'), array('Q', [0]), array('Q')
+    doc_blob = bytearray()
+    for doc_id, document, length in documents:
+        doc_ids.append(doc_id)
+        doc_blob += document.encode('utf-8')
+        doc_offsets.append(len(doc_blob))
+        doc_lengths.append(length)
+    with open(os.path.join(directory, name + '.docs'), 'wb') as docs_file:
+        docs_file.write(HEADER.pack(DOCS_MAGIC, len(doc_ids)))
+        docs_file.write(_to_bytes(doc_ids))
+        docs_file.write(_to_bytes(doc_offsets))
+        docs_file.write(_to_bytes(doc_lengths))
+        docs_file.write(doc_blob)
+        _sync(docs_file)
+
+
+def merge_segments(directory, name, segments, deleted=None):
+
+    """Writes a segment holding the contents of `segments`, which must be given in document ID order.
+    `deleted` gives the IDs of the deleted documents of every segment, which are left out."""
+
+    dictionaries = [segment.term_dictionary for segment in segments]
+    deleted = [set(doc_ids) for doc_ids in deleted] if deleted else [set() for _ in segments]
+    deleted_ids = set().union(*deleted)
+
+    def numbered_terms(k):
+        return ((word, k, i) for i, word in enumerate(dictionaries[k].terms))
+
+    # (word, segment number, word number) for every word of every segment, sorted by word and segment
+    entries = heapq.merge(*(numbered_terms(k) for k in range(len(dictionaries))))
+
+    def merged_postings():
+        for word, group in groupby(entries, key=lambda entry: entry[0]):
+            postings = PostingList()
+            for _, k, i in group:
+                postings.extend(PostingList.decode(dictionaries[k].encoded_postings(i)).without(deleted[k]))
+            # Words that only occurred in deleted documents are dropped
+            if postings:
+                yield word, postings
+
+    write_segment(directory, name, merged_postings(),
+                  (record for segment in segments for record in segment.documents.records()
+                   if record[0] not in deleted_ids))
+
+
+def write_deletes(directory, name, doc_ids):
+
+    """Atomically replaces the deleted document IDs of a segment"""
+
+    path = os.path.join(directory, name + '.del')
+    with open(path + '.tmp', 'wb') as file:
+        file.write(_to_bytes(array('Q', doc_ids)))
+        _sync(file)
+    os.replace(path + '.tmp', path)
+    sync_directory(directory)
+
+
+def read_deletes(directory, name):
+
+    """Returns the sorted IDs of the deleted documents of a segment"""
+
+    path = os.path.join(directory, name + '.del')
+    if not os.path.exists(path):
+        return array('Q')
+    with open(path, 'rb') as file:
+        doc_ids = file.read()
+    return array('Q', _from_bytes(memoryview(doc_ids)))
+
+
+def _to_bytes(values):
+
+    """Returns the little-endian bytes of an array('Q')"""
+
+    if not LITTLE_ENDIAN:
+        values = array('Q', values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(buffer):
+
+    """Returns the 64-bit numbers of little-endian bytes: a view of them if the machine is little-endian"""
+
+    if LITTLE_ENDIAN:
+        return buffer.cast('Q')
+    values = array('Q')
+    values.frombytes(buffer)
+    values.byteswap()
+    return values
+
+
+def _release(values):
+    if isinstance(values, memoryview):
+        values.release()
+
+
+def _sync(file):
+    file.flush()
+    os.fsync(file.fileno())
+
+
+def _open_mmap(path, magic):
+
+    """Memory-maps a segment file and checks its header; returns the map and the entry count"""
+
+    with open(path, 'rb') as file:
+        mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    file_magic, count = HEADER.unpack_from(mm)
+    if file_magic != magic:
+        mm.close()
+        raise ValueError(f"'{path}' is not a segment file.")
+    return mm, count
+
+
+class TermList(Sequence):
+
+    """Sorted sequence of the words of a segment, decoded from the mapped file on access.
+    Works with `bisect`, so lookups only touch O(log V) entries."""
+
+    def __init__(self, mm, count):
+
+        self.count = count
+        end = HEADER.size + 8 * ENTRY_SIZE * (count + 1)
+        self.entries = _from_bytes(memoryview(mm)[HEADER.size:end])
+        self.blob = memoryview(mm)[end:]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.count))]
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return str(self.blob[self.entries[ENTRY_SIZE * i]:self.entries[ENTRY_SIZE * (i + 1)]], 'utf-8')
+
+    def release(self):
+        _release(self.entries)
+        self.blob.release()
+
+
+class TermDictionary(Mapping):
+
+    """Read-only {word: PostingList} mapping over the term dictionary and postings files.
+    Posting lists are decoded from the mapped postings file when they are looked up, and
+    `ranked_postings` decodes them block by block for ranking."""
+
+    def __init__(self, terms_path, postings_path):
+
+        self.terms_mm, count = _open_mmap(terms_path, TERMS_MAGIC)
+        self.terms = TermList(self.terms_mm, count)
+        with open(postings_path, 'rb') as file:
+            self.postings_mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(file.fileno()).st_size else b''
+        self.postings = memoryview(self.postings_mm)
+
+    def _find(self, word):
+        i = bisect_left(self.terms, word)
+        if i < len(self.terms) and self.terms[i] == word:
+            return i
+        return -1
+
+    def encoded_postings(self, i):
+
+        """Returns the encoded posting list of the i-th word"""
+
+        entries = self.terms.entries
+        return self.postings[entries[ENTRY_SIZE * i + 1]:entries[ENTRY_SIZE * (i + 1) + 1]]
+
+    def document_frequency(self, word):
+
+        """Returns the number of documents containing `word`, without decoding its posting list"""
+
+        i = self._find(word)
+        return self.terms.entries[ENTRY_SIZE * i + 2] if i >= 0 else 0
+
+    def ranked_postings(self, word):
+
+        """Returns the posting list of `word` as a BlockPostings, or None if the word is not in the segment"""
+
+        i = self._find(word)
+        if i < 0:
+            return None
+        return BlockPostings(self.encoded_postings(i), self.terms.entries[ENTRY_SIZE * i + 3])
+
+    def __getitem__(self, word):
+        i = self._find(word)
+        if i < 0:
+            raise KeyError(word)
+        return PostingList.decode(self.encoded_postings(i))
+
+    def __contains__(self, word):
+        return self._find(word) >= 0
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def close(self):
+        self.terms.release()
+        self.postings.release()
+        self.terms_mm.close()
+        if isinstance(self.postings_mm, mmap.mmap):
+            self.postings_mm.close()
+
+
+class DocumentStore:
+
+    """Read-only document store over a mapped documents file"""
+
+    def __init__(self, path):
+
+        self.mm, count = _open_mmap(path, DOCS_MAGIC)
+        view = memoryview(self.mm)
+        self.doc_ids = _from_bytes(view[HEADER.size:HEADER.size + 8 * count])
+        self.offsets = _from_bytes(view[HEADER.size + 8 * count:HEADER.size + 8 * (2 * count + 1)])
+        self.lengths = _from_bytes(view[HEADER.size + 8 * (2 * count + 1):HEADER.size + 8 * (3 * count + 1)])
+        self.blob = view[HEADER.size + 8 * (3 * count + 1):]
+        view.release()
+        self._total_length = None
+
+    def _find(self, doc_id):
+        i = bisect_left(self.doc_ids, doc_id)
+        if i < len(self.doc_ids) and self.doc_ids[i] == doc_id:
+            return i
+        return -1
+
+    def get_document(self, doc_id):
+
+        """Retrieves a document by its ID"""
+
+        i = self._find(doc_id)
+        if i < 0:
+            return None
+        return str(self.blob[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+    def length(self, doc_id):
+
+        """Returns the number of words of a document"""
+
+        return self.lengths[self._find(doc_id)]
+
+    @property
+    def total_length(self):
+
+        """Number of words of all documents, computed on first use"""
+
+        if self._total_length is None:
+            self._total_length = sum(self.lengths)
+        return self._total_length
+
+    def __contains__(self, doc_id):
+        return self._find(doc_id) >= 0
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def items(self):
+        for i, doc_id in enumerate(self.doc_ids):
+            yield doc_id, str(self.blob[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+    def records(self):
+
+        """Yields (doc_id, document, length) in the form `write_segment` takes"""
+
+        for i, (doc_id, document) in enumerate(self.items()):
+            yield doc_id, document, self.lengths[i]
+
+    def close(self):
+        _release(self.doc_ids)
+        _release(self.offsets)
+        _release(self.lengths)
+        self.blob.release()
+        self.mm.close()
+
+
+class Segment:
+
+    """An opened immutable segment: its term dictionary and document store"""
+
+    def __init__(self, directory, name):
+
+        self.directory = directory
+        self.name = name
+        path = os.path.join(directory, name)
+        self.term_dictionary = TermDictionary(path + '.terms', path + '.postings')
+        self.documents = DocumentStore(path + '.docs')
+        # Sorted IDs of the documents deleted when the segment was opened
+        self.deleted = read_deletes(directory, name)
+
+    def close(self):
+        self.term_dictionary.close()
+        self.documents.close()
+
+    def delete_files(self):
+        for extension in ('.terms', '.postings', '.docs', '.del'):
+            path = os.path.join(self.directory, self.name + extension)
+            if extension != '.del' or os.path.exists(path):
+                os.remove(path)
+
+
+def read_manifest(directory):
+
+    """Returns the names of the live segments of a collection, oldest first"""
+
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return []
+    with open(path) as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+def write_manifest(directory, names):
+
+    """Atomically replaces the list of live segments of a collection"""
+
+    path = os.path.join(directory, MANIFEST)
+    with open(path + '.tmp', 'w') as file:
+        file.write(''.join(name + '\n' for name in names))
+        _sync(file)
+    os.replace(path + '.tmp', path)
+    # The renamed manifest must be on disk before the write-ahead log is emptied
+    sync_directory(directory)
@@ -0,0 +1,328 @@
+"""
+Network server for the command language.
+
+    python server.py [data_dir] [--host 127.0.0.1] [--port 7070] [--http-port 8080] [--threads 8]
+
+Commands are the same as in main.py and run through `Lexer` and `Parser` against one
+shared DB. Two protocols are offered:
+
+    line protocol (--port)   one command per line; every command is answered with
+                             "OK <n>\\n" or "ERR <n>\\n" followed by n bytes of UTF-8 output
+    HTTP (--http-port)       POST / with the command as the body, or as {"command": ...};
+                             the answer is {"ok": ..., "output": ...}; GET /metrics
+                             returns the metrics of the DB in the Prometheus text format
+
+Clients may pipeline: send many commands without waiting, and read the answers in the
+order of the commands. Commands run on a thread pool. The DB lets searches run while
+documents are inserted, and serializes the inserts into one collection itself, so
+commands of different connections never wait for each other here. Within a connection
+a reader/writer lock keeps the order: its searches run concurrently, while commands that
+change a collection (CREATE, INSERT, DELETE, ...) wait for the earlier commands of the
+connection and hold it alone. Locks are
+granted in arrival order, so every connection sees its own commands take effect in order.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from invertedIndex import DB
+from lexer import Lexer
+from parser import WRITE_COMMANDS, Parser
+
+# Answers waiting to be sent on one connection before reading more commands from it
+MAX_PIPELINE = 1000
+
+
+class ThreadOutput:
+
+    """sys.stdout replacement that collects the prints of a thread in its own buffer while it runs a command"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        return (self.stream if buffer is None else buffer).write(text)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+
+    def capture(self, function, *args):
+
+        """Calls a function and returns what it printed"""
+
+        self.local.buffer = StringIO()
+        try:
+            function(*args)
+            return self.local.buffer.getvalue()
+        finally:
+            self.local.buffer = None
+
+
+class ReadWriteLock:
+
+    """
+    Reader/writer lock for asyncio tasks: readers share the lock, a writer holds it alone.
+    Requests are queued the moment they are made and granted strictly in that order,
+    so a reader never overtakes an earlier writer or the other way round.
+    """
+
+    def __init__(self):
+        self.readers = 0
+        self.writer = False
+        # Waiting requests: (future, exclusive)
+        self.waiting = deque()
+
+    def acquire(self, exclusive):
+
+        """Queues a request and returns a future that is done once the lock is granted"""
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.append((future, exclusive))
+        self._grant()
+        return future
+
+    def release(self, exclusive):
+        if exclusive:
+            self.writer = False
+        else:
+            self.readers -= 1
+        self._grant()
+
+    def _grant(self):
+        while self.waiting:
+            future, exclusive = self.waiting[0]
+            if self.writer or (exclusive and self.readers):
+                return
+            self.waiting.popleft()
+            if future.cancelled():
+                continue
+            if exclusive:
+                self.writer = True
+            else:
+                self.readers += 1
+            future.set_result(None)
+
+
+class CommandServer:
+
+    """Runs the commands of all connections against one DB"""
+
+    def __init__(self, db, threads=8):
+
+        self.db = db
+        self.executor = ThreadPoolExecutor(threads)
+        self.output = ThreadOutput(sys.stdout)
+
+    @staticmethod
+    def is_write(command):
+
+        """Tells from the first token of a command whether it changes the DB"""
+
+        try:
+            return Lexer(command).get_next_token().type in WRITE_COMMANDS
+        except Exception:
+            return False  # Parsing the command reports the error
+
+    def run(self, command):
+
+        """Runs one command in the calling thread; returns (ok, printed output)"""
+
+        errors = []
+        parser = None
+
+        def parse():
+            nonlocal parser
+            try:
+                parser = Parser(Lexer(command), self.db)
+                parser.auto_parse()
+            except Exception as e:
+                errors.append(e)
+                print(f"Error: {e}")
+
+        output = self.output.capture(parse)
+        # Commands the DB did not carry out, such as a search of a missing collection, fail too
+        return not errors and not parser.failed, output
+
+    def execute(self, command, lock):
+
+        """Starts a command of the connection with the ReadWriteLock `lock` and returns a task
+        resolving to (ok, output). The lock is requested right away, before the task first runs."""
+
+        exclusive = self.is_write(command)
+        granted = lock.acquire(exclusive)
+        return asyncio.ensure_future(self._execute(command, lock, granted, exclusive))
+
+    async def _execute(self, command, lock, granted, exclusive):
+        try:
+            await granted
+        except asyncio.CancelledError:
+            if granted.done() and not granted.cancelled():
+                lock.release(exclusive)
+            raise
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, self.run, command)
+        finally:
+            lock.release(exclusive)
+
+    async def _serve_pipeline(self, read_command, write_answer, writer):
+
+        """Reads commands until `read_command` returns None, answering them in order while later ones run.
+        `read_command` may also return an answer (ok, output[, content type]) to send in place of running a command."""
+
+        answers = asyncio.Queue(MAX_PIPELINE)
+        lock = ReadWriteLock()
+
+        async def send_answers():
+            while True:
+                task = await answers.get()
+                if task is None:
+                    return
+                write_answer(*await task)
+                await writer.drain()
+
+        sender = asyncio.ensure_future(send_answers())
+        try:
+            while not sender.done():
+                command = await read_command()
+                if command is None:
+                    break
+                if isinstance(command, tuple):
+                    answer = asyncio.get_running_loop().create_future()
+                    answer.set_result(command)
+                    await answers.put(answer)
+                    continue
+                await answers.put(self.execute(command, lock))
+        finally:
+            if not sender.done():
+                await answers.put(None)
+            try:
+                await sender
+            except ConnectionError:
+                pass
+            writer.close()
+
+    async def handle_line_client(self, reader, writer):
+
+        """Serves one connection of the line protocol"""
+
+        async def read_command():
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return None
+                command = line.decode('utf-8', errors='replace').strip()
+                if command:
+                    return command
+
+        def write_answer(ok, output):
+            data = output.encode('utf-8')
+            writer.write(f"{'OK' if ok else 'ERR'} {len(data)}\n".encode() + data)
+
+        await self._serve_pipeline(read_command, write_answer, writer)
+
+    async def handle_http_client(self, reader, writer):
+
+        """Serves one HTTP/1.1 connection; requests on a kept-alive connection may be pipelined"""
+
+        keep_alive = True
+
+        async def read_command():
+            nonlocal keep_alive
+            if not keep_alive:
+                return None
+            try:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    return None
+                method, path, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode('latin-1').strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+            except (ValueError, asyncio.IncompleteReadError):
+                keep_alive = False
+                return False, "Malformed HTTP request"
+            keep_alive = headers.get('connection', '').lower() != 'close' and version != 'HTTP/1.0'
+            if method == 'GET' and path == '/metrics':
+                return True, self.db.metrics.prometheus(), 'text/plain; version=0.0.4'
+            if method != 'POST':
+                keep_alive = False
+                return False, "Commands are sent with POST"
+            text = body.decode('utf-8', errors='replace')
+            if headers.get('content-type', '').startswith('application/json'):
+                try:
+                    text = json.loads(text)['command']
+                except (ValueError, KeyError, TypeError):
+                    keep_alive = False
+                    return False, 'Expected {"command": ...}'
+            return text.strip()
+
+        def write_answer(ok, output, content_type=None):
+            if content_type is None:
+                body, content_type = json.dumps({'ok': ok, 'output': output}).encode('utf-8'), 'application/json'
+            else:
+                body = output.encode('utf-8')
+            status = "200 OK" if ok else "400 Bad Request"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+
+        await self._serve_pipeline(read_command, write_answer, writer)
+
+    async def start(self, host='127.0.0.1', port=7070, http_port=None):
+
+        """Starts listening; returns the asyncio servers. Port 0 picks a free port."""
+
+        sys.stdout = self.output
+        servers = [await asyncio.start_server(self.handle_line_client, host, port)]
+        if http_port is not None:
+            servers.append(await asyncio.start_server(self.handle_http_client, host, http_port))
+        return servers
+
+    def close(self):
+        sys.stdout = self.output.stream
+        self.executor.shutdown()
+
+
+async def serve(db, host, port, http_port, threads):
+    server = CommandServer(db, threads)
+    servers = await server.start(host, port, http_port)
+    for listener in servers:
+        print(f"Listening on {':'.join(map(str, listener.sockets[0].getsockname()[:2]))}")
+    try:
+        await asyncio.gather(*(listener.serve_forever() for listener in servers))
+    finally:
+        server.close()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Serves the command language over TCP and HTTP")
+    arg_parser.add_argument('data_dir', nargs='?', default=None)
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=7070)
+    arg_parser.add_argument('--http-port', type=int, default=None)
+    arg_parser.add_argument('--threads', type=int, default=8)
+    args = arg_parser.parse_args()
+
+    db = DB(args.data_dir)
+    try:
+        asyncio.run(serve(db, args.host, args.port, args.http_port, args.threads))
+    except KeyboardInterrupt:
+        print("Exiting the system.")
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Term lookups for wildcard and fuzzy queries.
+
+`KGramIndex` maps every k-gram (k consecutive characters) of the terms of a term
+sequence, with the ends of a term marked, to the sorted numbers of the terms containing
+it. The literal parts of a wildcard pattern such as "co*ch" give k-grams every matching
+term must contain ("\0co", "ch\0"), so intersecting their lists yields a few candidates,
+which are then checked against the pattern. The index only grows: it catches up with the
+sequence on every lookup, so it works over the append-only vocabulary of an analyzer as
+well as over the immutable term list of a segment.
+
+`fuzzy_terms` finds the terms within a number of edits of a word with a Levenshtein
+automaton, run over the sorted term dictionary: the terms are visited in order, the
+automaton states (rows of the edit distance table) of a shared prefix are reused, and
+once a prefix is farther from every prefix of the word than the allowed number of edits,
+all terms starting with it are skipped with one binary search.
+"""
+
+import re
+import threading
+from array import array
+from bisect import bisect_left
+from postings import intersect
+
+# Length of the k-grams
+K = 3
+# Marks the start and the end of a term in its k-grams
+BOUNDARY = '\0'
+WILDCARDS = re.compile(r'[*?]')
+
+
+def wildcard_regex(pattern):
+
+    """Returns the compiled regular expression of a wildcard pattern: * matches any characters, ? one character"""
+
+    return re.compile(''.join('.*' if char == '*' else '.' if char == '?' else re.escape(char) for char in pattern),
+                      re.DOTALL)
+
+
+def literal_prefix(pattern):
+
+    """Returns the part of a wildcard pattern before its first wildcard"""
+
+    match = WILDCARDS.search(pattern)
+    return pattern if match is None else pattern[:match.start()]
+
+
+class KGramIndex:
+
+    """{k-gram: array of the numbers of the terms containing it} over an append-only term sequence"""
+
+    def __init__(self, k=K):
+        self.k = k
+        self.grams = {}
+        # Number of terms of the sequence indexed so far
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # The index is rebuilt from the terms when it is first used after unpickling
+        return {'k': self.k}
+
+    def __setstate__(self, state):
+        self.__init__(state['k'])
+
+    def _grams(self, text):
+        return {text[i:i + self.k] for i in range(len(text) - self.k + 1)}
+
+    def _update(self, terms):
+        end = len(terms)
+        for number in range(self.size, end):
+            for gram in self._grams(BOUNDARY + terms[number] + BOUNDARY):
+                numbers = self.grams.get(gram)
+                if numbers is None:
+                    numbers = self.grams[gram] = array('I')
+                numbers.append(number)
+        self.size = end
+
+    def candidates(self, terms, pattern):
+
+        """Returns the sorted numbers of the terms of `terms` that contain every k-gram of the
+        literal parts of a wildcard pattern, or None if those parts are too short to have any"""
+
+        grams = set()
+        for literal in WILDCARDS.split(BOUNDARY + pattern + BOUNDARY):
+            grams |= self._grams(literal)
+        if not grams:
+            return None
+        with self.lock:
+            self._update(terms)
+            # Rarest k-gram first, so the intermediate results stay small
+            lists = sorted((self.grams.get(gram, ()) for gram in grams), key=len)
+            numbers = list(lists[0])
+            for numbers2 in lists[1:]:
+                if not numbers:
+                    break
+                numbers = intersect(numbers, numbers2)
+        return numbers
+
+
+def _next_row(row, word, char):
+
+    """Returns the row of the edit distance table after `char`, given the row before it"""
+
+    result = [row[0] + 1]
+    for j, word_char in enumerate(word):
+        result.append(min(result[j] + 1, row[j + 1] + 1, row[j] + (word_char != char)))
+    return result
+
+
+def edit_distance(word1, word2):
+
+    """Returns the Levenshtein distance (insertions, deletions and substitutions) between two words"""
+
+    row = list(range(len(word2) + 1))
+    for char in word1:
+        row = _next_row(row, word2, char)
+    return row[-1]
+
+
+def fuzzy_terms(terms, word, max_edits):
+
+    """Returns the terms of the sorted sequence `terms` within `max_edits` edits of `word`, in order"""
+
+    result = []
+    # rows[d]: row of the edit distance table after the first d characters of `previous`
+    rows = [list(range(len(word) + 1))]
+    previous = ''
+    i, n = 0, len(terms)
+    while i < n:
+        term = terms[i]
+        depth = 0
+        while depth < len(rows) - 1 and depth < len(term) and term[depth] == previous[depth]:
+            depth += 1
+        del rows[depth + 1:]
+        previous = term
+        while depth < len(term):
+            row = _next_row(rows[-1], word, term[depth])
+            depth += 1
+            if min(row) > max_edits:
+                break
+            rows.append(row)
+        else:
+            if rows[-1][-1] <= max_edits:
+                result.append(term)
+            i += 1
+            continue
+        # No term starting with term[:depth] is close enough: skip to the first term after them
+        prefix = term[:depth]
+        i = bisect_left(terms, prefix[:-1] + chr(ord(prefix[-1]) + 1), i + 1)
+    return result
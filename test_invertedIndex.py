@@ -0,0 +1,1127 @@
+import math
+import os
+import pickle
+import random
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from array import array
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest.mock import patch
+from analyzer import ENGLISH_STOPWORDS, REMOVED, Analyzer, s_stemmer
+import bitmap
+import fnmatch
+import itertools
+from bitmap import ARRAY_MAX_SIZE, DocIdSet, union
+from invertedIndex import DB, InvertedIndex, SegmentIndex, build_index_parallel, has_distance
+from cache import QueryCache
+from docstore import BlockStore
+from postings import PostingList, difference, in_order_within, intersect, within_window
+from query import And, Distance, Fuzzy, Near, Not, Or, Phrase, Range, Term, Wildcard, document_positions
+from ranking import CollectionStats, term_score
+from segment import Segment, read_manifest, write_segment
+from termindex import KGramIndex, edit_distance, fuzzy_terms
+from wal import WriteAheadLog
+
+class TestInvertedIndex(unittest.TestCase):
+    def setUp(self):
+
+        """Set up an index with a few small documents"""
+
+        self.index = InvertedIndex()
+        self.index.insert(['The', 'cat', 'jumps', 'onto', 'the', 'couch'])
+        self.index.insert(['The', 'soft', 'couch'])
+        self.index.insert(['cozy', 'cat'])
+
+    def test_search_range(self):
+        """Test range search over the sorted term dictionary"""
+        self.assertEqual(sorted(self.index.search_range('cat', 'cozy')), [1, 2, 3])
+        self.assertEqual(sorted(self.index.search_range('d', 'p')), [1])
+        self.assertEqual(self.index.search_range('x', 'z'), [])
+
+    def test_search_range_after_insert(self):
+        """Test that words inserted after a range query are found by later queries"""
+        self.index.search_range('a', 'z')
+        self.index.insert(['apple'])
+        self.assertEqual(self.index.search_range('a', 'b'), [4])
+        self.assertEqual(self.index.sorted_terms(), sorted(self.index.index))
+
+    def test_search_prefix(self):
+        """Test prefix search"""
+        self.assertEqual(sorted(self.index.search_prefix('co')), [1, 2, 3])
+        self.assertEqual(self.index.search_prefix('so'), [2])
+        self.assertEqual(self.index.search_prefix('q'), [])
+
+    def test_search_wildcard_and_fuzzy(self):
+        """Test wildcard and fuzzy search, including words inserted after the first query"""
+        self.assertEqual(self.index.search_wildcard('co*ch'), [1, 2])
+        self.assertEqual(self.index.search_wildcard('c?t'), [1, 3])
+        self.assertEqual(self.index.search_wildcard('*o*'), [1, 2, 3])
+        self.assertEqual(self.index.search_wildcard('x*'), [])
+        self.assertEqual(self.index.search_fuzzy('cot', 1), [1, 3])
+        self.assertEqual(self.index.search_fuzzy('coach', 1), [1, 2])
+        self.assertEqual(self.index.search_fuzzy('coach', 0), [])
+        self.index.insert(['crouch'])
+        self.assertEqual(self.index.search_wildcard('*ouch'), [1, 2, 4])
+        self.assertEqual(self.index.search_fuzzy('couch', 1), [1, 2, 4])
+
+    def test_search_distance(self):
+        """Test distance search, including distance 0 and the same word on both sides"""
+        self.assertEqual(self.index.search_distance('cat', 'couch', 4), [1])
+        self.assertEqual(self.index.search_distance('couch', 'cat', 4), [1])
+        self.assertEqual(self.index.search_distance('cat', 'couch', 3), [])
+        self.assertEqual(self.index.search_distance('the', 'the', 4), [1])
+        self.assertEqual(self.index.search_distance('the', 'the', 0), [1, 2])
+        self.assertEqual(self.index.search_distance('cat', 'missing', 1), [])
+
+    def test_has_distance_matches_brute_force(self):
+        """Test the linear merge against the quadratic comparison of all position pairs"""
+        rng = random.Random(0)
+        for _ in range(500):
+            positions1 = sorted(rng.sample(range(40), rng.randint(0, 8)))
+            positions2 = sorted(rng.sample(range(40), rng.randint(0, 8)))
+            distance = rng.randint(0, 10)
+            expected = any(abs(p1 - p2) == distance for p1 in positions1 for p2 in positions2)
+            self.assertEqual(has_distance(positions1, positions2, distance), expected)
+
+    def test_proximity_windows_match_brute_force(self):
+        """Test the sliding window and the ordered scan against trying every choice of positions"""
+        rng = random.Random(0)
+        for _ in range(500):
+            tokens = rng.choices('abcd', k=rng.randint(1, 20))
+            words = rng.choices('abc', k=rng.randint(2, 4))
+            window = rng.randint(0, 8)
+            positions = document_positions(tokens)
+            if not all(word in positions for word in words):
+                continue
+            choices = list(itertools.product(*(positions[word] for word in words)))
+            near = any(len(set(choice)) == len(choice) and max(choice) - min(choice) <= window for choice in choices)
+            ordered = any(all(p < q for p, q in zip(choice, choice[1:])) and choice[-1] - choice[0] <= window
+                          for choice in choices)
+            distinct = list(dict.fromkeys(words))
+            self.assertEqual(within_window([positions[word] for word in distinct],
+                                           [words.count(word) for word in distinct], window), near, (tokens, words))
+            self.assertEqual(in_order_within([positions[word] for word in words], window), ordered, (tokens, words))
+
+    def test_insert_many_matches_insert(self):
+        """Test that batch insertion builds the same index as inserting one document at a time"""
+        documents = [['The', 'cat', 'jumps', 'onto', 'the', 'couch'], ['The', 'soft', 'couch'], ['cozy', 'cat']]
+        index = InvertedIndex()
+        index.insert(documents[0])
+        self.assertEqual(index.insert_many(documents[1:]), [2, 3])
+        self.assertEqual(index.index, self.index.index)
+        self.assertEqual(index.sorted_terms(), self.index.sorted_terms())
+        with self.assertRaises(ValueError):
+            index.insert_many([['ok'], []])
+
+    def test_build_index_parallel(self):
+        """Test that the parallel build produces the same index as serial insertion"""
+        rng = random.Random(0)
+        words = ['cat', 'Couch', 'soft', 'cozy', 'the', 'window']
+        documents = [rng.choices(words, k=rng.randint(1, 12)) for _ in range(50)]
+        serial_index = InvertedIndex()
+        for tokens in documents:
+            serial_index.insert(tokens)
+
+        index = build_index_parallel(documents, workers=2, chunk_size=7)
+        self.assertEqual(index.index, serial_index.index)
+        self.assertEqual(index.sorted_terms(), serial_index.sorted_terms())
+        self.assertEqual(index.next_doc_id, serial_index.next_doc_id)
+
+    def test_print_index_format(self):
+        """Test that posting lists print like the {document_id: [positions]} dict they replace"""
+        self.assertEqual(repr(self.index.index['the']), '{1: [0, 4], 2: [0]}')
+
+    def test_delete_and_compact(self):
+        """Test that deleted documents disappear from searches at once and from the postings on compaction"""
+        self.assertTrue(self.index.delete(2))
+        self.assertFalse(self.index.delete(2))
+        self.assertFalse(self.index.delete(4))
+        self.assertEqual(self.index.search(), [1, 3])
+        self.assertEqual(self.index.search_word('couch'), [1])
+        self.assertEqual(self.index.search_prefix('so'), [])
+        self.assertEqual(self.index.search_distance('the', 'couch', 2), [])
+        self.assertEqual(self.index.search_query(Not(Term('cozy'))), [1])
+        self.assertEqual([doc_id for doc_id, _ in self.index.search_top(Term('couch'), 3)], [1])
+        self.assertEqual(self.index.collection_stats([]).num_docs, 2)
+        self.assertEqual(self.index.collection_stats([]).total_length, 8)
+        self.assertTrue(self.index.needs_compaction())
+        copy = pickle.loads(pickle.dumps(self.index))
+        self.assertEqual(copy.search_word('couch'), [1])
+        self.assertFalse(copy.delete(2))
+
+        self.assertEqual(self.index.compact(), [2])
+        self.assertFalse(self.index.needs_compaction())
+        self.assertEqual(self.index.search_word('couch'), [1])
+        self.assertEqual(repr(self.index.index['the']), '{1: [0, 4]}')
+        # Words that only occurred in deleted documents are dropped
+        self.assertNotIn('soft', self.index.index)
+        self.assertEqual(self.index.terms_with_prefix('so'), [])
+        self.assertEqual(self.index.compact(), [])
+        self.index.insert(['soft', 'cat'])
+        self.assertEqual(self.index.search_word('soft'), [4])
+        self.assertEqual(self.index.search_range('a', 'z'), [1, 3, 4])
+
+class TestTermIndex(unittest.TestCase):
+    def setUp(self):
+
+        """Set up an index over a random vocabulary of short words"""
+
+        rng = random.Random(0)
+        self.words = sorted({''.join(rng.choices('abcde', k=rng.randint(1, 7))) for _ in range(2000)})
+        self.index = InvertedIndex()
+        self.index.insert_many([[word] for word in self.words])
+
+    def test_edit_distance(self):
+        """Test the Levenshtein distance on a few known pairs"""
+        self.assertEqual(edit_distance('kitten', 'sitting'), 3)
+        self.assertEqual(edit_distance('', 'abc'), 3)
+        self.assertEqual(edit_distance('flaw', 'lawn'), 2)
+        self.assertEqual(edit_distance('same', 'same'), 0)
+
+    def test_wildcard_matches_fnmatch(self):
+        """Test that k-gram candidates checked against the pattern find exactly the matching words"""
+        for pattern in ['ab*', 'a*e', '*abc*', '?b?', 'a?c*e', '*cde', '*', 'e?', 'abcabca', '*a*b*c*d*']:
+            self.assertEqual(self.index.terms_matching(pattern), fnmatch.filter(self.words, pattern), pattern)
+
+    def test_fuzzy_matches_brute_force(self):
+        """Test that the Levenshtein automaton finds exactly the words within the allowed edits"""
+        for word in ['abc', 'eeeee', 'a', 'abcdeab', 'x']:
+            for max_edits in range(3):
+                expected = [term for term in self.words if edit_distance(word, term) <= max_edits]
+                self.assertEqual(self.index.terms_fuzzy(word, max_edits), expected, (word, max_edits))
+        self.assertEqual(fuzzy_terms([], 'abc', 2), [])
+
+    def test_k_gram_index_catches_up(self):
+        """Test that the k-gram index sees terms appended after it was first used"""
+        grams, terms = KGramIndex(), ['couch', 'cat']
+        self.assertEqual(grams.candidates(terms, '*ouc*'), [0])
+        terms.append('pouch')
+        self.assertEqual(grams.candidates(terms, '*ouc*'), [0, 2])
+        self.assertIsNone(grams.candidates(terms, 'c*'))
+        self.assertEqual(pickle.loads(pickle.dumps(grams)).candidates(terms, '*ouc*'), [0, 2])
+
+class TestPostingList(unittest.TestCase):
+    def test_mapping_interface(self):
+        """Test the dict-like access to document IDs and positions"""
+        postings = PostingList()
+        for doc_id, pos in [(1, 0), (1, 7), (5, 2), (300, 1)]:
+            postings.add(doc_id, pos)
+        self.assertEqual(list(postings), [1, 5, 300])
+        self.assertEqual(list(postings[1]), [0, 7])
+        self.assertIn(5, postings)
+        self.assertNotIn(2, postings)
+        self.assertIsNone(postings.get(2))
+        with self.assertRaises(ValueError):
+            postings.add(4, 0)
+
+    def test_encode_decode(self):
+        """Test that delta + varint encoding round-trips"""
+        postings = PostingList()
+        for doc_id in (1, 2, 130, 70000):
+            for pos in (0, 3, 200, 100000):
+                postings.add(doc_id, pos)
+        self.assertEqual(PostingList.decode(postings.encode()), postings)
+        self.assertEqual(PostingList.decode(PostingList().encode()), PostingList())
+
+    def test_reads_during_append(self):
+        """Test that reading the last document does not take in the positions of a document appended meanwhile"""
+
+        class Positions(list):
+            # A writer appends document 9 (its offset, then a position) right before the reader reads the length
+            def __len__(self):
+                if len(postings.offsets) == 1:
+                    postings.offsets.append(list.__len__(self))
+                    self.append(4)
+                return list.__len__(self)
+
+        for read in (lambda: list(postings.positions_at(0)), lambda: postings.frequency_at(0),
+                     lambda: postings.max_frequency()):
+            postings = PostingList.from_lists([1], [0], [0, 5, 6])
+            postings.positions = Positions(postings.positions)
+            self.assertIn(read(), ([0, 5, 6], 3))
+class TestBooleanQuery(unittest.TestCase):
+    def setUp(self):
+
+        """Set up an index of random documents over a small vocabulary"""
+
+        rng = random.Random(0)
+        words = ['cat', 'couch', 'soft', 'cozy', 'the', 'window', 'sun']
+        self.documents = [rng.choices(words, k=rng.randint(1, 8)) for _ in range(200)]
+        self.index = InvertedIndex()
+        self.index.insert_many(self.documents)
+
+    def test_queries_match_brute_force(self):
+        """Test that planned evaluation agrees with checking every document on its own"""
+        queries = [Term('cat'),
+                   And([Term('cat'), Term('sun')]),
+                   And([Term('sun'), Term('cat'), Term('cozy')]),
+                   Or([Term('window'), Term('soft'), Term('missing')]),
+                   And([Term('the'), Not(Term('cat'))]),
+                   Not(Or([Term('cat'), Term('couch')])),
+                   Phrase(['soft', 'couch']),
+                   Phrase(['the', 'cat', 'the']),
+                   And([Range('cozy', 'soft'), Distance('cat', 'sun', 2), Not(Phrase(['sun', 'sun']))]),
+                   Or([And([Term('cat'), Term('missing')]), Not(Term('the'))]),
+                   And([Wildcard('*o*'), Not(Wildcard('c?t'))]),
+                   Or([Fuzzy('sin', 1), Fuzzy('coy', 1)]),
+                   Near(['cat', 'sun'], 3),
+                   Near(['the', 'cat', 'the'], 4),
+                   And([Near(['soft', 'couch', 'window'], 5, ordered=True), Not(Near(['cat', 'sun'], 1))])]
+        for query in queries:
+            expected = [doc_id for doc_id, tokens in enumerate(self.documents, 1)
+                        if query.matches(document_positions(tokens))]
+            self.assertEqual(self.index.search_query(query), expected, query)
+
+    def test_intersect_and_difference(self):
+        """Test galloping intersection and difference against set operations"""
+        rng = random.Random(1)
+        for _ in range(200):
+            a = sorted(rng.sample(range(300), rng.randint(0, 50)))
+            b = sorted(rng.sample(range(300), rng.randint(0, 150)))
+            self.assertEqual(list(intersect(a, b)), sorted(set(a) & set(b)))
+            self.assertEqual(list(difference(a, b)), sorted(set(a) - set(b)))
+        # Long sequences of similar lengths go through byte masks
+        for _ in range(5):
+            a = sorted(rng.sample(range(1, 200000), rng.randint(1000, 20000)))
+            b = sorted(rng.sample(range(1, 200000), rng.randint(1000, 20000)))
+            self.assertEqual(list(intersect(a, b)), sorted(set(a) & set(b)))
+            self.assertEqual(list(difference(a, b)), sorted(set(a) - set(b)))
+            self.assertEqual(list(difference(a, b[:100])), sorted(set(a) - set(b[:100])))
+
+class TestDocIdSet(unittest.TestCase):
+    def random_ids(self, rng):
+
+        """Sorted random IDs that fill some chunks sparsely and others densely"""
+
+        ids = set(rng.sample(range(1, 1 << 16), rng.choice([0, 10, ARRAY_MAX_SIZE, 20000])))
+        ids.update(rng.sample(range(3 << 16, 4 << 16), rng.choice([0, 100, ARRAY_MAX_SIZE + 1])))
+        ids.update(rng.sample(range(1 << 32, (1 << 32) + 1000), rng.choice([0, 5])))
+        return sorted(ids)
+
+    def test_set_operations_match_sets(self):
+        """Test unions, intersections, differences and listing against Python sets"""
+        rng = random.Random(0)
+        for _ in range(12):
+            a, b, c = self.random_ids(rng), self.random_ids(rng), self.random_ids(rng)
+            set_a, set_b = DocIdSet(array('Q', a)), DocIdSet(b)
+            self.assertEqual(len(set_a), len(a))
+            self.assertEqual((set_a | set_b).to_list(), sorted(set(a) | set(b)))
+            self.assertEqual(union([array('Q', a), b, c]), sorted(set(a) | set(b) | set(c)))
+            with patch.object(bitmap, 'UNION_CHUNKED_SIZE', 0):
+                self.assertEqual(union([array('Q', a), b, c]), sorted(set(a) | set(b) | set(c)))
+            self.assertEqual(bitmap.intersection(a, b), sorted(set(a) & set(b)))
+            self.assertEqual(bitmap.difference(a, b), sorted(set(a) - set(b)))
+            limit = rng.randrange(1, 5 << 16)
+            self.assertEqual(set_b.to_list(limit), [doc_id for doc_id in b if doc_id < limit])
+            self.assertEqual(set_b.count_below(limit), len([doc_id for doc_id in b if doc_id < limit]))
+
+    def test_add_and_discard(self):
+        """Test that added and removed IDs keep the set equal to a Python set, across container kinds"""
+        rng = random.Random(1)
+        doc_ids, expected = DocIdSet(), set()
+        for doc_id in range(1, 3 * ARRAY_MAX_SIZE):
+            doc_ids.add(doc_id)
+            expected.add(doc_id)
+        for _ in range(2000):
+            doc_id = rng.randrange(1, 4 * ARRAY_MAX_SIZE)
+            if rng.random() < 0.3:
+                doc_ids.add(doc_id)
+                expected.add(doc_id)
+            else:
+                doc_ids.discard(doc_id)
+                expected.discard(doc_id)
+            self.assertEqual(doc_id in doc_ids, doc_id in expected)
+        self.assertEqual(doc_ids.to_list(), sorted(expected))
+        self.assertEqual(DocIdSet(sorted(expected)), doc_ids)
+
+class TestRanking(unittest.TestCase):
+    def setUp(self):
+
+        """Set up an index of random documents with words of very different frequencies"""
+
+        rng = random.Random(0)
+        words = ['the'] * 20 + ['cat'] * 5 + ['couch'] * 3 + ['soft', 'cozy', 'window', 'sun']
+        self.documents = [rng.choices(words, k=rng.randint(1, 12)) for _ in range(300)]
+        self.index = InvertedIndex()
+        self.index.insert_many(self.documents)
+
+    def brute_force_top(self, query, k):
+
+        """Scores every matching document without pruning"""
+
+        stats = CollectionStats(len(self.documents), sum(map(len, self.documents)),
+                                {word: sum(word in tokens for tokens in self.documents) for word in query.ranked_words()})
+        results = []
+        for doc_id, tokens in enumerate(self.documents, 1):
+            if query.matches(document_positions(tokens)):
+                score = math.fsum(term_score(stats.idf(word), tokens.count(word), len(tokens), stats.average_length())
+                                  for word in dict.fromkeys(query.ranked_words()) if word in tokens)
+                results.append((doc_id, score))
+        results.sort(key=lambda result: (-result[1], result[0]))
+        return results[:k]
+
+    def test_top_k_matches_brute_force(self):
+        """Test that pruned top k retrieval returns exactly the best k documents"""
+        queries = [Term('the'), Term('sun'), Or([Term('the'), Term('cat'), Term('sun')]),
+                   Or([Term('cozy'), Term('window'), Term('missing')]),
+                   And([Term('cat'), Or([Term('soft'), Term('the')])]),
+                   And([Term('the'), Not(Term('cat'))]), Phrase(['the', 'cat']), Not(Term('the'))]
+        for query in queries:
+            for k in (1, 3, 10, 1000):
+                self.assertEqual(self.index.search_top(query, k), self.brute_force_top(query, k), (query, k))
+        self.assertEqual(self.index.search_top(Term('the'), 0), [])
+
+    def test_top_k_on_segment(self):
+        """Test that ranking a segment, whose posting lists are decoded block by block, matches the in-memory index"""
+        with tempfile.TemporaryDirectory() as directory:
+            write_segment(directory, 's', ((word, self.index.index[word]) for word in self.index.sorted_terms()),
+                          ((doc_id, ' '.join(tokens), len(tokens)) for doc_id, tokens in enumerate(self.documents, 1)))
+            segment = SegmentIndex(Segment(directory, 's'))
+            try:
+                for word in ('the', 'sun'):
+                    postings = self.index.index[word]
+                    ranked = segment.ranked_postings(word)
+                    self.assertEqual(segment.index.document_frequency(word), len(postings))
+                    self.assertEqual(ranked.max_frequency(), postings.max_frequency())
+                    self.assertEqual(list(ranked.doc_ids), list(postings.doc_ids))
+                # Seeking to the last document decodes only the last block
+                postings, ranked = self.index.index['the'], segment.ranked_postings('the')
+                self.assertGreater(len(ranked.last_ids), 1)
+                self.assertEqual(ranked.seek(postings.doc_ids[-1]), len(postings) - 1)
+                self.assertEqual(ranked.block, len(ranked.last_ids) - 1)
+                self.assertIsNone(segment.ranked_postings('missing'))
+                # Block postings are views of the mapped file, which cannot be closed while they exist
+                del ranked
+                for query in [Term('the'), Or([Term('the'), Term('cat'), Term('sun')]),
+                              And([Term('cat'), Or([Term('soft'), Term('the')])])]:
+                    for k in (1, 10, 1000):
+                        self.assertEqual(segment.search_top(query, k), self.index.search_top(query, k), (query, k))
+            finally:
+                segment.segment.close()
+
+class TestBlockStore(unittest.TestCase):
+    def test_get_matches_dict(self):
+        """Test that documents read back from compressed blocks equal the stored ones"""
+        rng = random.Random(0)
+        words = ['cat', 'couch', 'soft', 'cozy', 'the', 'window', 'sun', 'žluťoučký']
+        for codec in ('zlib', 'lzma'):
+            store = BlockStore(block_size=200, codec=codec, cache_blocks=2)
+            documents = {}
+            for doc_id in range(1, 500, 2):
+                documents[doc_id] = ' '.join(rng.choices(words, k=rng.randint(1, 30)))
+                store.add(doc_id, documents[doc_id])
+            self.assertGreater(len(store.blocks), 10)
+            self.assertEqual(dict(store.items()), documents)
+            for doc_id in rng.sample(range(502), 200):
+                self.assertEqual(store.get(doc_id), documents.get(doc_id))
+            self.assertLessEqual(len(store.cache), 2)
+
+    def test_add_order(self):
+        """Test that IDs must increase"""
+        store = BlockStore(block_size=10)
+        store.add(1, 'a')
+        with self.assertRaises(ValueError):
+            store.add(1, 'b')
+        self.assertEqual(store.get(1), 'a')
+        store.add(2, 'a long document')
+        with self.assertRaises(ValueError):
+            store.add(2, 'c')
+        with self.assertRaises(ValueError):
+            BlockStore(codec='rar')
+
+class TestAnalyzer(unittest.TestCase):
+    def test_pipeline(self):
+        """Test normalization, stopword removal, stemming and term IDs"""
+        self.assertEqual([s_stemmer(word) for word in ['cats', 'flies', 'horses', 'glass', 'bus', 'its']],
+                         ['cat', 'fly', 'horse', 'glass', 'bus', 'its'])
+        analyzer = Analyzer(ENGLISH_STOPWORDS, s_stemmer)
+        self.assertEqual(analyzer.analyze_text('The Cats flies, is a cat'), [None, 'cat', 'fly', None, None, 'cat'])
+        term_ids = analyzer.term_ids(['cat', 'Cats', 'CAT', 'the', 'fly'])
+        self.assertEqual(term_ids[:3], [term_ids[0]] * 3)
+        self.assertEqual(term_ids[3], REMOVED)
+        self.assertEqual(len(analyzer.vocabulary), 2)
+        self.assertEqual(analyzer.term('Horses'), 'horse')
+        # Query words are not added to the vocabulary
+        self.assertEqual(len(analyzer.vocabulary), 2)
+
+        copy = pickle.loads(pickle.dumps(analyzer))
+        self.assertEqual((copy.stopwords, copy.stemmer), (analyzer.stopwords, s_stemmer))
+        self.assertEqual((len(copy.vocabulary), copy.memo), (0, {}))
+
+    def test_db_with_analyzer(self):
+        """Test searches and cached results of a collection with stopwords and stemming"""
+        db = DB(analyzer=Analyzer(ENGLISH_STOPWORDS, s_stemmer))
+        with redirect_stdout(StringIO()):
+            db.create_collection('c')
+            db.insert_document('c', ['The', 'cats', 'sat', 'on', 'the', 'mat'])
+            db.insert_many('c', ['A cat and the dogs', 'dog'], workers=2, batch_size=1)
+        inverted_index, _ = db.collections['c']
+        self.assertEqual(sorted(inverted_index.index), ['cat', 'dog', 'mat', 'sat'])
+
+        def search(query):
+            return [doc_id for doc_id, _ in db.iter_search('c', query)]
+
+        self.assertEqual(search(Term('CAT')), [1, 2])
+        self.assertEqual(search(Term('the')), [])
+        # Removed words leave gaps in phrases, so positions keep counting them
+        self.assertEqual(search(Phrase(['cats', 'and', 'the', 'dog'])), [2])
+        self.assertEqual(search(Phrase(['cat', 'dog'])), [])
+        self.assertEqual(search(Phrase(['sat', 'in', 'a', 'mats'])), [1])
+        self.assertEqual(search(Distance('mats', 'cat', 4)), [1])
+        self.assertEqual([doc_id for doc_id, _, _ in db.iter_search_top('c', Or([Term('dogs'), Term('the')]), 5)], [3, 2])
+
+        # Cached results are updated with the terms of new documents
+        query = And([Term('cats'), Not(Phrase(['the', 'dogs']))])
+        self.assertEqual(search(query), [1])
+        with redirect_stdout(StringIO()):
+            db.insert_document('c', ['CATS', 'of', 'a', 'dog'])
+            db.insert_document('c', ['cat', 'the', 'dog'])
+        self.assertEqual(search(Term('cats')), [1, 2, 4, 5])
+        self.assertEqual(search(query), [1])
+        self.assertEqual(db.cache_stats('c')['updates'], 3)
+
+class TestWriteAheadLog(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'wal.log')
+
+    def test_records_and_torn_tail(self):
+        """Test reading back records and cutting off a torn record"""
+        wal = WriteAheadLog(self.path, 'sync')
+        records = [('create', 'c', 1)] + [('insert', 'c', i, [['doc', str(i)]]) for i in range(1, 6)]
+        for record in records:
+            wal.append(record)
+        self.assertEqual(wal.syncs, len(records))
+        wal.close()
+        with open(self.path, 'ab') as file:
+            file.write(b'\x10\x00\x00\x00junk')
+
+        wal = WriteAheadLog(self.path, 'async')
+        self.addCleanup(wal.close)
+        self.assertEqual(list(wal.records()), records)
+        self.assertEqual(wal.size, os.path.getsize(self.path))
+        wal.append(('create', 'd', 1))
+        self.assertEqual(list(wal.records())[-1], ('create', 'd', 1))
+        self.assertEqual(wal.syncs, 1)
+        wal.truncate()
+        self.assertEqual(list(wal.records()), [])
+
+    def test_group_commit(self):
+        """Test that group commit fsyncs many records at once and soon after they arrive"""
+        wal = WriteAheadLog(self.path, 'group', group_commit_records=10, group_commit_interval=0.01)
+        self.addCleanup(wal.close)
+        for i in range(25):
+            wal.append(('insert', 'c', i, [['doc']]))
+        self.assertLessEqual(wal.syncs, 3)
+        for _ in range(100):
+            if not wal.pending:
+                break
+            time.sleep(0.01)
+        self.assertEqual(wal.pending, 0)
+        self.assertEqual(len(list(wal.records())), 25)
+        with self.assertRaises(ValueError):
+            WriteAheadLog(self.path, 'never')
+
+class TestDB(unittest.TestCase):
+    def test_insert_file(self):
+        """Test bulk insertion from a JSONL file"""
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as file:
+            file.write('"The cat sat"\n{"text": "a cozy, soft couch"}\n"!!!"\n\n{"text": "cat"}\n')
+        self.addCleanup(os.remove, file.name)
+
+        db = DB()
+        with redirect_stdout(StringIO()):
+            db.create_collection('c')
+            self.assertEqual(db.insert_file('c', file.name), 3)
+        inverted_index, full_documents = db.collections['c']
+        self.assertEqual(inverted_index.search_word('cat'), [1, 3])
+        self.assertEqual(full_documents.get_document(2), 'a cozy soft couch')
+
+    def test_iter_search_pages(self):
+        """Test that search results are streamed in pages and can be sliced with offset and limit"""
+        db = DB()
+        with redirect_stdout(StringIO()):
+            db.create_collection('c')
+            db.insert_many('c', [f"doc {i} {'cat' if i % 3 == 0 else 'dog'}" for i in range(1000)])
+        _, full_documents = db.collections['c']
+        cat_ids = [doc_id for doc_id in range(1, 1001) if (doc_id - 1) % 3 == 0]
+
+        with patch.object(full_documents, 'get_documents', wraps=full_documents.get_documents) as get_documents:
+            results = db.iter_search('c', Term('cat'))
+            self.assertEqual(next(results), (1, 'doc 0 cat'))
+            # Only the first page of documents has been read
+            self.assertEqual(get_documents.call_count, 1)
+            self.assertEqual([doc_id for doc_id, _ in results], cat_ids[1:])
+
+        self.assertEqual(list(db.iter_search('c', Term('cat'), offset=5, limit=3)),
+                         [(doc_id, full_documents.get_document(doc_id)) for doc_id in cat_ids[5:8]])
+        self.assertEqual(list(db.iter_search('c', offset=998)), [(999, 'doc 998 dog'), (1000, 'doc 999 cat')])
+        self.assertEqual([doc_id for doc_id, _, _ in db.iter_search_top('c', Term('cat'), 10, offset=8, limit=5)],
+                         [doc_id for doc_id, _ in db.collections['c'][0].search_top(Term('cat'), 10)[8:]])
+        with self.assertRaises(ValueError):
+            db.iter_search('missing')
+
+        # Printed results keep the format of a printed list
+        output = StringIO()
+        with redirect_stdout(output):
+            db.search_word('c', 'CAT', offset=1, limit=2)
+        self.assertEqual(output.getvalue(), f"Search results: {['doc 3 cat', 'doc 6 cat']}\n")
+
+    def test_insert_many_parallel(self):
+        """Test bulk insertion with indexing on a process pool"""
+        db = DB()
+        with redirect_stdout(StringIO()):
+            db.create_collection('c')
+            db.insert_document('c', ['first'])
+            self.assertEqual(db.insert_many('c', [f'doc {i}' for i in range(20)], batch_size=3, workers=2), 20)
+        inverted_index, full_documents = db.collections['c']
+        self.assertEqual(inverted_index.search_word('doc'), list(range(2, 22)))
+        self.assertEqual(inverted_index.search_word('19'), [21])
+        self.assertEqual(full_documents.get_document(21), 'doc 19')
+
+class TestQueryCache(unittest.TestCase):
+    def test_cached_results_follow_inserts(self):
+        """Test that cached results are updated by inserts and stay equal to fresh searches"""
+        rng = random.Random(0)
+        words = ['cat', 'couch', 'soft', 'cozy', 'the', 'window', 'sun']
+        db = DB()
+        with redirect_stdout(StringIO()):
+            db.create_collection('c')
+        inverted_index, _ = db.collections['c']
+        query = And([Term('cat'), Not(Phrase(['soft', 'couch']))])
+        queries = [(('all',), inverted_index.search),
+                   (('word', 'cat'), lambda: inverted_index.search_word('cat')),
+                   (('range', 'cozy', 't'), lambda: inverted_index.search_range('cozy', 't')),
+                   (('distance', 'cat', 'sun', 2), lambda: inverted_index.search_distance('cat', 'sun', 2)),
+                   (('query', query), lambda: inverted_index.search_query(query))]
+
+        for _ in range(30):
+            with redirect_stdout(StringIO()):
+                db.insert_document('c', rng.choices(words, k=rng.randint(1, 8)))
+            for key, search in queries:
+                self.assertEqual(db._cached_search('c', key, search), search())
+
+        stats = db.cache_stats('c')
+        self.assertEqual(stats['misses'], 5)
+        self.assertEqual(stats['hits'], 5 * 29)
+        self.assertGreater(stats['updates'], 0)
+
+    def test_cached_results_follow_deletes(self):
+        """Test that deletes, updates and compactions keep cached results equal to fresh searches"""
+        rng = random.Random(1)
+        words = ['cat', 'couch', 'soft', 'cozy', 'the', 'window', 'sun']
+        documents = {}
+        db = DB()
+        with redirect_stdout(StringIO()):
+            db.create_collection('c')
+            for doc_id in range(1, 61):
+                documents[doc_id] = rng.choices(words, k=rng.randint(1, 8))
+                db.insert_document('c', documents[doc_id])
+        inverted_index, full_documents = db.collections['c']
+        query = Or([And([Term('cat'), Not(Term('sun'))]), Phrase(['soft', 'couch'])])
+        queries = [(('all',), inverted_index.search), (('word', 'cat'), lambda: inverted_index.search_word('cat')),
+                   (('query', query), lambda: inverted_index.search_query(query))]
+        compacted = False
+
+        for _ in range(40):
+            doc_id = rng.choice(sorted(documents))
+            output = StringIO()
+            with redirect_stdout(output):
+                if rng.random() < 0.5:
+                    db.delete_document('c', doc_id)
+                else:
+                    tokens = rng.choices(words, k=rng.randint(1, 8))
+                    db.update_document('c', doc_id, tokens)
+                    documents[inverted_index.next_doc_id - 1] = tokens
+            del documents[doc_id]
+            self.assertIn(f"Document {doc_id} ", output.getvalue())
+            compacted = compacted or not inverted_index.deleted
+            for key, search in queries:
+                self.assertEqual(db._cached_search('c', key, search), search())
+            expected = [doc_id for doc_id, tokens in sorted(documents.items())
+                        if query.matches(document_positions(tokens))]
+            self.assertEqual(inverted_index.search_query(query), expected)
+
+        # Enough documents were deleted to compact the collection automatically
+        self.assertTrue(compacted)
+        output = StringIO()
+        with redirect_stdout(output):
+            db.delete_document('c', 1000)
+            db.compact('c')
+        self.assertIn("Document 1000 not found", output.getvalue())
+        self.assertEqual(full_documents.get_all_documents(),
+                         {doc_id: ' '.join(tokens) for doc_id, tokens in documents.items()})
+        self.assertEqual(db.metrics.counter('oaa_documents_deleted_total', collection='c'), 40)
+
+    def test_lru_eviction(self):
+        """Test eviction by number of entries and by bytes"""
+        cache = QueryCache(max_entries=2, max_bytes=40)
+        cache.put(('word', 'a'), [1])
+        cache.put(('word', 'b'), [2])
+        cache.get(('word', 'a'))
+        cache.put(('word', 'c'), [3])
+        self.assertIsNone(cache.get(('word', 'b')))
+        self.assertEqual(cache.get(('word', 'a')), [1])
+
+        cache.put(('word', 'd'), list(range(10)))
+        self.assertEqual(list(cache.entries), [('word', 'd')])
+        self.assertEqual(cache.stats()['evictions'], 3)
+        # Appending the new document makes the entry exceed the byte limit
+        cache.update(10, ['D', 'x'])
+        self.assertEqual(cache.stats()['entries'], 0)
+        self.assertEqual(cache.stats()['evictions'], 4)
+
+class TestShardedDB(unittest.TestCase):
+    def check_sharded_collection(self, db):
+
+        """Inserts the same documents into a plain and a sharded collection and compares searches"""
+
+        rng = random.Random(0)
+        words = ['cat', 'couch', 'soft', 'cozy', 'the', 'window', 'sun']
+        documents = [rng.choices(words, k=rng.randint(1, 10)) for _ in range(40)]
+        with redirect_stdout(StringIO()):
+            db.create_collection('plain')
+            db.create_collection('sharded', 3)
+            for tokens in documents[:10]:
+                db.insert_document('plain', tokens)
+                db.insert_document('sharded', tokens)
+            db.insert_many('plain', documents[10:], batch_size=7)
+            db.insert_many('sharded', documents[10:], batch_size=7)
+
+        plain, plain_documents = db.collections['plain']
+        sharded, sharded_documents = db.collections['sharded']
+        self.assertEqual(sharded.search(), plain.search())
+        self.assertEqual(sharded.search_word('cat'), plain.search_word('cat'))
+        self.assertEqual(sharded.search_range('cozy', 't'), plain.search_range('cozy', 't'))
+        self.assertEqual(sharded.search_prefix('co'), plain.search_prefix('co'))
+        self.assertEqual(sharded.search_wildcard('*o?'), plain.search_wildcard('*o?'))
+        self.assertEqual(sharded.search_fuzzy('coy', 1), plain.search_fuzzy('coy', 1))
+        self.assertEqual(sharded.search_distance('cat', 'sun', 2), plain.search_distance('cat', 'sun', 2))
+        query = Or([And([Term('cat'), Not(Term('sun'))]), Phrase(['soft', 'couch'])])
+        self.assertEqual(sharded.search_query(query), plain.search_query(query))
+        query = Or([Term('cat'), Term('sun'), Term('the')])
+        self.assertEqual(sharded.search_top(query, 5), plain.search_top(query, 5))
+        self.assertEqual(sharded_documents.get_documents([5, 1, 33]), plain_documents.get_documents([5, 1, 33]))
+        self.assertEqual(sharded_documents.get_all_documents(), plain_documents.get_all_documents())
+
+        with redirect_stdout(StringIO()):
+            for doc_id in (3, 17, 18, 40):
+                db.delete_document('plain', doc_id)
+                db.delete_document('sharded', doc_id)
+        self.assertEqual(sharded.search(), plain.search())
+        self.assertEqual(sharded.search_word('cat'), plain.search_word('cat'))
+        self.assertEqual(sharded.search_query(query), plain.search_query(query))
+        self.assertEqual(sharded.search_top(query, 5), plain.search_top(query, 5))
+        self.assertEqual(sharded.compact(), plain.compact())
+        self.assertEqual(sharded.search_word('cat'), plain.search_word('cat'))
+
+        output = StringIO()
+        with redirect_stdout(output):
+            plain.print_index()
+        expected = sorted(output.getvalue().splitlines())
+        output = StringIO()
+        with redirect_stdout(output):
+            sharded.print_index()
+        self.assertEqual(output.getvalue().splitlines(), expected)
+
+    def test_shards_in_process(self):
+        """Test a sharded collection whose shards live in this process"""
+        self.check_sharded_collection(DB(shard_processes=False))
+
+    def test_shards_in_worker_processes(self):
+        """Test a sharded collection whose shards live in worker processes"""
+        db = DB()
+        self.addCleanup(db.close)
+        self.check_sharded_collection(db)
+
+    def test_shards_with_analyzer(self):
+        """Test that worker processes analyze documents like the DB analyzes queries"""
+        db = DB(analyzer=Analyzer(ENGLISH_STOPWORDS, s_stemmer))
+        self.addCleanup(db.close)
+        self.check_sharded_collection(db)
+        with redirect_stdout(StringIO()):
+            db.insert_document('sharded', ['The', 'Suns'])
+        self.assertEqual([doc_id for doc_id, _ in db.iter_search('sharded', Phrase(['a', 'sun']))][-1], 41)
+        self.assertEqual(list(db.iter_search('sharded', Term('the'))), [])
+
+class TestPersistentDB(unittest.TestCase):
+    def setUp(self):
+
+        """Set up a DB that stores its collections in a temporary directory"""
+
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.data_dir.cleanup)
+        self.db = self.open_db()
+
+    def open_db(self, **segment_options):
+        with redirect_stdout(StringIO()):
+            return DB(self.data_dir.name, **segment_options)
+
+    def insert(self, db, *documents):
+        with redirect_stdout(StringIO()):
+            for document in documents:
+                db.insert_document('c', document.split())
+
+    def test_reopen(self):
+        """Test that collections survive closing and reopening the DB"""
+        with redirect_stdout(StringIO()):
+            self.db.create_collection('c')
+        self.insert(self.db, 'the cat sat', 'the soft couch')
+        self.db.flush()
+        self.insert(self.db, 'a cozy cat')
+        self.db.close()
+
+        db = self.open_db()
+        self.addCleanup(db.close)
+        inverted_index, full_documents = db.collections['c']
+        self.assertEqual(len(inverted_index.segments), 2)
+        self.assertEqual(inverted_index.search_word('CAT'), [1, 3])
+        self.assertEqual(sorted(inverted_index.search_range('cat', 'cozy')), [1, 2, 3])
+        self.assertEqual(inverted_index.search_distance('the', 'couch', 2), [2])
+        self.assertEqual(inverted_index.search_query(And([Term('cat'), Not(Phrase(['the', 'cat']))])), [3])
+        # Scores of segments use the statistics of the whole collection
+        plain = InvertedIndex()
+        plain.insert_many([document.split() for document in ('the cat sat', 'the soft couch', 'a cozy cat')])
+        query = Or([Term('cat'), Term('soft')])
+        self.assertEqual(inverted_index.search_top(query, 2), plain.search_top(query, 2))
+        self.assertEqual(sorted(inverted_index.search()), [1, 2, 3])
+        self.assertEqual(full_documents.get_document(2), 'the soft couch')
+        self.assertEqual(list(inverted_index.postings('the')[1]), [0])
+
+        # New documents continue the ID sequence of the stored ones
+        self.insert(db, 'another cat')
+        self.assertEqual(inverted_index.search_word('cat'), [1, 3, 4])
+
+    def test_reopen_sharded(self):
+        """Test that sharded collections keep their shards across restarts"""
+        with redirect_stdout(StringIO()):
+            self.db.create_collection('c', 2)
+        self.insert(self.db, 'the cat sat', 'the soft couch', 'a cozy cat')
+        self.db.close()
+
+        db = self.open_db()
+        self.addCleanup(db.close)
+        inverted_index, full_documents = db.collections['c']
+        self.assertEqual(len(inverted_index.shards), 2)
+        self.assertEqual(inverted_index.search_word('cat'), [1, 3])
+        self.assertEqual(full_documents.get_document(2), 'the soft couch')
+        self.assertEqual(inverted_index.next_doc_id, 4)
+
+    def test_recover_after_crash(self):
+        """Test that documents that were only in the write-ahead log survive a crash"""
+        self.db.close()
+        db = self.open_db(max_buffer_words=4, background_merges=False, durability='sync')
+        with redirect_stdout(StringIO()):
+            db.create_collection('c')
+            db.create_collection('s', 2)
+        self.insert(db, 'the cat sat', 'the soft couch', 'a cozy cat')
+        with redirect_stdout(StringIO()):
+            db.insert_many('s', ['the cat sat', 'a cozy cat', 'cat', 'couch'], batch_size=3)
+        # The first two documents reached a segment before the crash, the third only the log
+        self.assertEqual(len(db.collections['c'][0].segments), 1)
+        # Crash: the DB is abandoned without closing it
+
+        db = self.open_db(background_merges=False)
+        self.addCleanup(db.close)
+        self.assertEqual(db.wal.size, 0)
+        inverted_index, full_documents = db.collections['c']
+        self.assertEqual(inverted_index.search_word('cat'), [1, 3])
+        self.assertEqual(full_documents.get_document(3), 'a cozy cat')
+        self.assertEqual(inverted_index.next_doc_id, 4)
+        sharded, sharded_documents = db.collections['s']
+        self.assertEqual(sharded.search_word('cat'), [1, 2, 3])
+        self.assertEqual(sharded_documents.get_document(4), 'couch')
+
+        # A second crash right after recovery replays nothing
+        self.assertEqual(self.open_db(background_merges=False).recover(), 0)
+
+    def test_invalid_documents_after_crash(self):
+        """Test that empty documents are rejected before they are logged, and that invalid
+        records left in the log by older versions are skipped instead of failing the reopen"""
+        self.db.close()
+        db = self.open_db(background_merges=False, durability='sync')
+        with redirect_stdout(StringIO()):
+            db.create_collection('c')
+            for invalid in ([], 'text', ('not', 'a', 'list')):
+                with self.assertRaises(ValueError):
+                    db.insert_document('c', invalid)
+            # Empty documents are skipped by bulk inserts, but a batch that holds anything else is rejected
+            with self.assertRaises(ValueError):
+                db.insert_many('c', [['ok'], ('not', 'a', 'list')])
+        self.insert(db, 'hello')
+        with redirect_stdout(StringIO()):
+            with self.assertRaises(ValueError):
+                db.update_document('c', 1, [])
+        db.wal.append(('insert', 'c', 2, [[]]))
+        self.insert(db, 'world')
+        # Crash: the DB is abandoned without closing it
+
+        output = StringIO()
+        with redirect_stdout(output):
+            db = DB(self.data_dir.name, background_merges=False)
+        self.addCleanup(db.close)
+        self.assertIn("Skipped write-ahead log record 3 (insert in collection 'c')", output.getvalue())
+        inverted_index, full_documents = db.collections['c']
+        self.assertEqual(full_documents.get_documents([1, 2]), ['hello', 'world'])
+        self.assertEqual(inverted_index.next_doc_id, 3)
+        self.assertEqual(db.wal.size, 0)
+
+    def test_torn_log_record(self):
+        """Test that recovery stops at a record cut short by a crash"""
+        with redirect_stdout(StringIO()):
+            self.db.create_collection('c')
+        self.insert(self.db, 'the cat sat', 'a cozy cat')
+        self.db.wal.sync()
+        size = self.db.wal.size
+        with open(self.db.wal.path, 'r+b') as file:
+            file.truncate(size - 3)
+
+        db = self.open_db()
+        self.addCleanup(db.close)
+        inverted_index, _ = db.collections['c']
+        self.assertEqual(inverted_index.search_word('cat'), [1])
+        self.assertEqual(inverted_index.next_doc_id, 2)
+
+    def test_automatic_checkpoint(self):
+        """Test that the log is emptied once it grows beyond checkpoint_bytes"""
+        self.db.close()
+        db = self.open_db(checkpoint_bytes=500)
+        self.addCleanup(db.close)
+        with redirect_stdout(StringIO()):
+            db.create_collection('c')
+        self.insert(db, *[f'doc {i}' for i in range(20)])
+        inverted_index, _ = db.collections['c']
+        self.assertLess(db.wal.size, 500)
+        self.assertGreater(len(inverted_index.segments), 0)
+        self.assertEqual(inverted_index.search_word('doc'), list(range(1, 21)))
+
+    def test_flush_threshold_and_merge(self):
+        """Test automatic flushes of the buffer and merging of small segments"""
+        self.db.close()
+        db = self.open_db(max_buffer_words=2, merge_factor=3, background_merges=False)
+        self.addCleanup(db.close)
+        with redirect_stdout(StringIO()):
+            db.create_collection('c')
+        documents = [f'doc {i} cat' if i % 2 else f'doc {i}' for i in range(9)]
+        self.insert(db, *documents)
+
+        inverted_index, full_documents = db.collections['c']
+        self.assertEqual(len(inverted_index.segments), 9)
+        while inverted_index.merge():
+            pass
+        # Nine single-document segments become three and then one
+        self.assertEqual(len(inverted_index.segments), 1)
+        self.assertEqual(inverted_index.search_word('cat'), [2, 4, 6, 8])
+        self.assertEqual(inverted_index.search_word('doc'), list(range(1, 10)))
+        self.assertEqual(inverted_index.search_wildcard('c*t'), [2, 4, 6, 8])
+        self.assertEqual(inverted_index.search_fuzzy('dog', 1), list(range(1, 10)))
+        self.assertEqual(full_documents.get_document(9), 'doc 8')
+        self.assertEqual(read_manifest(inverted_index.directory), [inverted_index.segments[0].segment.name])
+
+    def test_delete_and_compact(self):
+        """Test that deletes survive restarts and crashes and that merges and compactions drop deleted documents"""
+        self.db.close()
+        db = self.open_db(max_buffer_words=6, merge_factor=3, background_merges=False, durability='sync')
+        with redirect_stdout(StringIO()):
+            db.create_collection('c')
+        self.insert(db, *[f'doc {i} cat' if i % 2 else f'doc {i}' for i in range(13)])
+        inverted_index, full_documents = db.collections['c']
+        # Four segments of three documents and document 13 in the buffer
+        self.assertEqual(len(inverted_index.segments), 4)
+        with redirect_stdout(StringIO()):
+            for doc_id in (2, 5, 13):
+                db.delete_document('c', doc_id)
+            db.update_document('c', 4, 'doc 3 dog'.split())
+        expected_cat = [6, 8, 10, 12]
+        self.assertEqual(inverted_index.search_word('cat'), expected_cat)
+        self.assertEqual(inverted_index.search_word('dog'), [14])
+        self.assertNotIn(2, inverted_index.search())
+        self.assertEqual([doc_id for doc_id, _ in inverted_index.search_top(Term('cat'), 10)], expected_cat)
+        self.assertNotIn(2, inverted_index.postings('doc'))
+        # Crash: the tombstones of the segments are only in the log
+        self.assertTrue(inverted_index.segments[0].dirty)
+
+        db = self.open_db(max_buffer_words=6, merge_factor=3, background_merges=False)
+        inverted_index, full_documents = db.collections['c']
+        self.assertEqual(inverted_index.search_word('cat'), expected_cat)
+        self.assertEqual(inverted_index.search_word('doc'), [1, 3, 6, 7, 8, 9, 10, 11, 12, 14])
+        self.assertTrue(os.path.exists(os.path.join(inverted_index.directory,
+                                                    inverted_index.segments[0].segment.name + '.del')))
+        self.assertEqual(inverted_index.next_doc_id, 15)
+
+        # Merges leave the deleted documents out
+        with redirect_stdout(StringIO()):
+            db.delete_document('c', 1)
+        self.assertIsNotNone(inverted_index.find_compaction())
+        while inverted_index.merge():
+            pass
+        self.assertEqual([len(segment.segment.documents) for segment in inverted_index.segments], [5, 3, 1])
+        self.assertIsNone(inverted_index.find_compaction())
+        self.assertEqual(inverted_index.search_word('doc'), [3, 6, 7, 8, 9, 10, 11, 12, 14])
+        self.assertIsNone(full_documents.get_document(5))
+        # Deleting a third of a segment makes the merge thread rewrite it
+        with redirect_stdout(StringIO()):
+            db.delete_document('c', 11)
+        self.assertEqual(inverted_index.find_compaction(), [inverted_index.segments[1]])
+        self.assertTrue(inverted_index.merge())
+        self.assertEqual([len(segment.segment.documents) for segment in inverted_index.segments], [5, 2, 1])
+        with redirect_stdout(StringIO()):
+            db.delete_document('c', 14)
+            db.delete_document('c', 3)
+            db.compact('c')
+        # The segment of document 14 is gone
+        self.assertEqual([len(segment.segment.documents) for segment in inverted_index.segments], [4, 2])
+        self.assertEqual(inverted_index.search_word('doc'), [6, 7, 8, 9, 10, 12])
+        self.assertNotIn('dog', inverted_index.sorted_terms())
+        db.close()
+
+        db = self.open_db()
+        self.addCleanup(db.close)
+        inverted_index, full_documents = db.collections['c']
+        self.assertEqual(inverted_index.search(), [6, 7, 8, 9, 10, 12])
+        self.assertEqual(full_documents.get_all_documents()[6], 'doc 5 cat')
+        self.assertFalse([name for name in os.listdir(inverted_index.directory) if name.endswith('.del')])
+
+    def test_background_merge(self):
+        """Test that the merge thread compacts segments while documents are inserted"""
+        self.db.close()
+        db = self.open_db(max_buffer_words=1, merge_factor=2)
+        self.addCleanup(db.close)
+        with redirect_stdout(StringIO()):
+            db.create_collection('c')
+        self.insert(db, *[f'w{i}' for i in range(16)])
+        inverted_index, _ = db.collections['c']
+        for _ in range(100):
+            if inverted_index.find_merge() is None:
+                break
+            time.sleep(0.01)
+        self.assertIsNone(inverted_index.find_merge())
+        self.assertLess(len(inverted_index.segments), 8)
+        self.assertEqual(inverted_index.search_range('w0', 'w9'), list(range(1, 17)))
+
+class TestConcurrency(unittest.TestCase):
+    def setUp(self):
+
+        """Switch threads very often, so that readers interrupt writers in the middle of inserts"""
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-5)
+        self.addCleanup(sys.setswitchinterval, interval)
+
+    def stress(self, db, documents_per_writer=150):
+
+        """Runs two writers (single and batched inserts) against three readers and checks every snapshot"""
+
+        errors = []
+        writing = []
+
+        def write(writer):
+            try:
+                for start in range(0, documents_per_writer, 5):
+                    batch = [f"all w{writer} n{i} {'even' if i % 2 == 0 else 'odd'}" for i in range(start, start + 5)]
+                    if writer == 0:
+                        for document in batch:
+                            db.insert_document('c', document.split())
+                    else:
+                        db.insert_many('c', batch)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                writing.remove(writer)
+
+        def read():
+            try:
+                seen = 0
+                while writing:
+                    results = list(db.iter_search('c', Term('all')))
+                    # Every search sees a prefix of the inserted documents, which only grows
+                    self.assertEqual([doc_id for doc_id, _ in results], list(range(1, len(results) + 1)))
+                    self.assertGreaterEqual(len(results), seen)
+                    seen = len(results)
+                    all_ids = [doc_id for doc_id, _ in db.iter_search('c')]
+                    self.assertEqual(all_ids, list(range(1, len(all_ids) + 1)))
+                    for _, document in db.iter_search('c', Term('even')):
+                        self.assertTrue(document.startswith('all ') and document.endswith(' even'))
+                    for doc_id, document, _ in db.iter_search_top('c', Term('odd'), 5):
+                        self.assertTrue(document.endswith(' odd'))
+            except Exception as e:
+                errors.append(e)
+
+        with redirect_stdout(StringIO()):
+            db.create_collection('c')
+            writing.extend([0, 1])
+            threads = ([threading.Thread(target=write, args=(writer,)) for writer in (0, 1)] +
+                       [threading.Thread(target=read) for _ in range(3)])
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            results = list(db.iter_search('c', Term('all')))
+
+        self.assertEqual(errors, [])
+        self.assertEqual([doc_id for doc_id, _ in results], list(range(1, 2 * documents_per_writer + 1)))
+        for writer in (0, 1):
+            # The inserts of each writer keep their order
+            numbers = [int(document.split()[2][1:]) for _, document in results if document.split()[1] == f"w{writer}"]
+            self.assertEqual(numbers, list(range(documents_per_writer)))
+
+    def test_concurrent_inserts_and_searches(self):
+        """Test snapshot consistency of searches in an in-memory collection during inserts"""
+        self.stress(DB())
+
+    def test_concurrent_inserts_flushes_and_merges(self):
+        """Test searches of a persistent collection while inserts flush the buffer, merges retire segments
+        and checkpoints run"""
+        data_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(data_dir.cleanup)
+        db = DB(data_dir.name, max_buffer_words=40, merge_factor=2, checkpoint_bytes=4096)
+        self.addCleanup(db.close)
+        self.stress(db)
+        inverted_index, _ = db.collections['c']
+        self.assertEqual(inverted_index.retired, [])
+
+    def test_range_and_prefix_searches_during_inserts(self):
+        """Test range and prefix searches against a scan of the inserted words while new words are added"""
+        for seed in range(5):
+            words = [f"{letter}{n:03d}" for letter in 'abcd' for n in range(1000)]
+            random.Random(seed).shuffle(words)
+            index = InvertedIndex()
+            inserted = []
+            errors = []
+
+            def write():
+                for word in words:
+                    index.insert([word])
+                    inserted.append(word)
+
+            def read(search, matches):
+                try:
+                    while len(inserted) < len(words):
+                        before = list(inserted)
+                        result = search()
+                        self.assertEqual(result, sorted(set(result)))
+                        # Every word inserted before the search is found, and nothing else matches
+                        self.assertLessEqual({word for word in before if matches(word)}, set(result))
+                        self.assertTrue(all(matches(word) for word in result))
+                except Exception as e:
+                    errors.append(e)
+
+            searches = [(lambda: index.terms_in_range('b', 'c050'), lambda word: 'b' <= word <= 'c050'),
+                        (lambda: index.terms_with_prefix('c0'), lambda word: word.startswith('c0'))]
+            threads = ([threading.Thread(target=write)] +
+                       [threading.Thread(target=read, args=search) for search in searches * 2])
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(errors, [])
+            self.assertEqual(index.terms_with_prefix('d2'), sorted(word for word in words if word.startswith('d2')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,14 @@
+import os
+import tempfile
 import unittest
+from contextlib import redirect_stdout
+from io import StringIO
 from unittest.mock import MagicMock
 from lexer import Token, Lexer
 from parser import Parser
 from invertedIndex import DB
+from query import And, Fuzzy, Near, Not, Or, Phrase, Term, Wildcard
+from main import BufferedOutput, CommandRunner, execute_file_commands, read_statements
 
 class TestParser(unittest.TestCase):
     def setUp(self):
@@ -30,6 +36,14 @@ class TestParser(unittest.TestCase):
         # Assert the correct collection name was returned
         self.assertEqual(collection_name, 'test_collection')
 
+    def test_parse_create_with_shards(self):
+        """Test parsing CREATE command with a number of shards"""
+        parser = self.create_parser_with_input('CREATE test_collection SHARDS 4;')
+
+        parser.auto_parse()
+
+        self.db.create_collection.assert_called_once_with('test_collection', 4)
+
     def test_parse_insert(self):
         """Test parsing INSERT command"""
         parser = self.create_parser_with_input('INSERT test_collection "hello world";')
@@ -41,6 +55,17 @@ class TestParser(unittest.TestCase):
         self.assertEqual(collection_name, 'test_collection')
         self.assertEqual(document, ['hello', 'world'])
 
+    def test_insert_punctuated_words(self):
+        """Test that quoted single words with * or ? are inserted as words, not read as wildcards"""
+        self.assertEqual(self.create_parser_with_input('INSERT c "what?";').parse_insert(), ('c', ['what']))
+        self.assertEqual(self.create_parser_with_input('INSERT c "star*";').parse_insert(), ('c', ['star']))
+
+        self.create_parser_with_input('UPDATE c 1 "star*";').auto_parse()
+        self.db.update_document.assert_called_once_with('c', 1, ['star'])
+
+        self.create_parser_with_input('BULK INSERT c FROM "docs?.txt";').auto_parse()
+        self.db.insert_file.assert_called_once_with('c', 'docs?.txt')
+
     def test_parse_print_index(self):
         """Test parsing PRINT_INDEX command"""
         parser = self.create_parser_with_input('PRINT_INDEX test_collection;')
@@ -103,6 +128,157 @@ class TestParser(unittest.TestCase):
         self.assertEqual(word2, 'second')
         self.assertEqual(dist, 3)
 
+    def test_parse_search_boolean(self):
+        """Test parsing SEARCH command with AND, OR, NOT, parentheses and a phrase"""
+        parser = self.create_parser_with_input('SEARCH c WHERE "cat" AND NOT ("dog" OR "soft couch");')
+
+        collection_name, query, word2, dist = parser.parse_search()
+
+        # AND binds tighter than OR, and a quoted string of several words is a phrase
+        self.assertEqual(collection_name, 'c')
+        self.assertEqual(query, And([Term('cat'), Not(Or([Term('dog'), Phrase(['soft', 'couch'])]))]))
+        self.assertIsNone(word2)
+        self.assertIsNone(dist)
+
+    def test_parse_search_precedence(self):
+        """Test that OR has lower precedence than AND"""
+        parser = self.create_parser_with_input('SEARCH c WHERE "a" OR "b" and "c";')
+
+        _, query, _, _ = parser.parse_search()
+
+        self.assertEqual(query, Or([Term('a'), And([Term('b'), Term('c')])]))
+
+    def test_parse_search_wildcard_and_fuzzy(self):
+        """Test parsing wildcard patterns and fuzzy words, with and without a number of edits"""
+        parser = self.create_parser_with_input('SEARCH c WHERE "Co*ch" OR "cat"~1 AND NOT "dog"~;')
+
+        _, query, _, _ = parser.parse_search()
+
+        self.assertEqual(query, Or([Wildcard('co*ch'), And([Fuzzy('cat', 1), Not(Fuzzy('dog', 2))])]))
+
+        parser = self.create_parser_with_input('SEARCH c WHERE "a*";')
+        parser.auto_parse()
+        self.db.search_query.assert_called_once_with('c', Wildcard('a*'))
+
+    def test_parse_search_near(self):
+        """Test parsing NEAR/N and ONEAR/N chains of two or more words"""
+        parser = self.create_parser_with_input('SEARCH c WHERE "a" near/3 "b" NEAR/3 "c" OR "d" ONEAR/0 "e";')
+
+        _, query, _, _ = parser.parse_search()
+
+        self.assertEqual(query, Or([Near(['a', 'b', 'c'], 3), Near(['d', 'e'], 0, ordered=True)]))
+
+        # A chain uses a single operator and window
+        for text in ('SEARCH c WHERE "a" NEAR/3 "b" NEAR/2 "c";', 'SEARCH c WHERE "a" NEAR/3 "b" ONEAR/3 "c";',
+                     'SEARCH c WHERE "a" NEAR/x "b";'):
+            with self.assertRaises(Exception):
+                self.create_parser_with_input(text).parse_search()
+
+    def test_auto_parse_search_boolean(self):
+        """Test auto_parse dispatching a boolean query to search_query"""
+        parser = self.create_parser_with_input('SEARCH c WHERE "a" AND "b";')
+
+        parser.auto_parse()
+
+        self.db.search_query.assert_called_once_with('c', And([Term('a'), Term('b')]))
+
+    def test_auto_parse_search_top(self):
+        """Test auto_parse dispatching a ranked search with TOP k"""
+        parser = self.create_parser_with_input('SEARCH c WHERE "a" OR "b" top 5;')
+
+        parser.auto_parse()
+
+        self.db.search_top.assert_called_once_with('c', Or([Term('a'), Term('b')]), 5)
+
+    def test_auto_parse_search_limit_offset(self):
+        """Test auto_parse passing LIMIT and OFFSET to the search methods"""
+        parser = self.create_parser_with_input('SEARCH c WHERE "a" LIMIT 10 OFFSET 20;')
+        parser.auto_parse()
+        self.db.search_word.assert_called_once_with('c', 'a', offset=20, limit=10)
+
+        parser = self.create_parser_with_input('SEARCH c offset 5;')
+        parser.auto_parse()
+        self.db.search.assert_called_once_with('c', offset=5)
+
+        parser = self.create_parser_with_input('SEARCH c WHERE "a" OR "b" TOP 10 LIMIT 3;')
+        parser.auto_parse()
+        self.db.search_top.assert_called_once_with('c', Or([Term('a'), Term('b')]), 10, limit=3)
+
+    def test_parse_bulk_insert(self):
+        """Test parsing BULK INSERT command"""
+        parser = self.create_parser_with_input('BULK INSERT test_collection FROM "data/docs 1.jsonl";')
+
+        # Execute parse_bulk_insert
+        collection_name, filename = parser.parse_bulk_insert()
+
+        # Assert the file name keeps its original spelling
+        self.assertEqual(collection_name, 'test_collection')
+        self.assertEqual(filename, 'data/docs 1.jsonl')
+
+    def test_auto_parse_bulk_insert(self):
+        """Test auto_parse with BULK INSERT command"""
+        parser = self.create_parser_with_input('bulk insert test_collection from "docs.txt";')
+
+        parser.auto_parse()
+
+        self.db.insert_file.assert_called_once_with('test_collection', 'docs.txt')
+
+    def test_auto_parse_delete_update_compact(self):
+        """Test auto_parse with DELETE, UPDATE and COMPACT commands"""
+        self.assertEqual(self.create_parser_with_input('DELETE c 3;').parse_delete(), ('c', 3))
+
+        self.create_parser_with_input('delete c 3;').auto_parse()
+        self.db.delete_document.assert_called_once_with('c', 3)
+
+        self.create_parser_with_input('UPDATE c 2 "a new text";').auto_parse()
+        self.db.update_document.assert_called_once_with('c', 2, ['a', 'new', 'text'])
+
+        self.create_parser_with_input('COMPACT c;').auto_parse()
+        self.db.compact.assert_called_once_with('c')
+
+        for command in ('DELETE c;', 'DELETE c "3";', 'UPDATE c 2;', 'COMPACT;'):
+            with self.assertRaises(Exception):
+                self.create_parser_with_input(command).auto_parse()
+
+    def test_keywords_as_collection_names(self):
+        """Test that collections named like keywords, e.g. top or limit, can be created, filled and searched"""
+        self.create_parser_with_input('CREATE top;').auto_parse()
+        self.db.create_collection.assert_called_once_with('top')
+
+        self.assertEqual(self.create_parser_with_input('INSERT limit "a";').parse_insert(), ('limit', ['a']))
+        self.assertEqual(self.create_parser_with_input('DELETE Offset 3;').parse_delete(), ('Offset', 3))
+        self.assertEqual(self.create_parser_with_input('BULK INSERT from FROM "docs.txt";').parse_bulk_insert(),
+                         ('from', 'docs.txt'))
+
+        self.create_parser_with_input('SEARCH and WHERE "a" TOP 5 LIMIT 2;').auto_parse()
+        self.db.search_top.assert_called_once_with('and', Term('a'), 5, limit=2)
+
+        self.create_parser_with_input('SEARCH top limit 1;').auto_parse()
+        self.db.search.assert_called_once_with('top', limit=1)
+
+        for command in ('CREATE near/2;', 'CREATE 42;', 'INSERT "a";'):
+            with self.assertRaises(Exception):
+                self.create_parser_with_input(command).auto_parse()
+
+    def test_lexer_token_stream(self):
+        """Test the token types and values produced by the lexer"""
+        lexer = Lexer('search Docs WHERE ("a" or "b c") <2> - 42 x.y createX "A?b*" "c"~1~;')
+        tokens = []
+        token = lexer.get_next_token()
+        while token.type != 'EOF':
+            tokens.append((token.type, token.value))
+            token = lexer.get_next_token()
+        self.assertEqual(tokens, [('SEARCH', 'search'), ('COLLECTION', 'Docs'), ('WHERE', 'WHERE'), ('LPAREN', '('),
+                                  ('WORD', ['a']), ('OR', 'or'), ('DOCUMENT', ['b', 'c']), ('RPAREN', ')'),
+                                  ('DIST', 2), ('MIN', '-'), ('NUMBER', '42'), ('JUNK', 'x.y'), ('CREATE', 'createX'),
+                                  ('PATTERN', 'a?b*'), ('WORD', ['c']), ('FUZZY', 1), ('FUZZY', 2), ('EOI', ';')])
+
+        for text in ('INSERT c "unclosed;', 'SEARCH c WHERE "a" <x> "b";', 'SEARCH c WHERE "a" <3'):
+            lexer = Lexer(text)
+            with self.assertRaises(Exception):
+                while lexer.get_next_token().type != 'EOF':
+                    pass
+
     def test_invalid_syntax(self):
         """Test parser error handling with invalid syntax"""
         parser = self.create_parser_with_input('CREATE;')  # Missing collection name
@@ -111,6 +287,14 @@ class TestParser(unittest.TestCase):
         with self.assertRaises(Exception):
             parser.parse_create()
 
+    def test_empty_quoted_query(self):
+        """Test that quotes without a word in a query are invalid syntax rather than an IndexError"""
+        for command in ('SEARCH c WHERE "   ";', 'SEARCH c WHERE "";', 'SEARCH c WHERE "a" - "!!";',
+                        'SEARCH c WHERE "a" NEAR/2 " " TOP 3;', 'SEARCH c WHERE NOT "" AND "a";'):
+            with self.assertRaisesRegex(Exception, '^Invalid syntax$'):
+                self.create_parser_with_input(command).auto_parse()
+        self.db.search_query.assert_not_called()
+
     def test_auto_parse_create(self):
         """Test auto_parse with CREATE command"""
         parser = self.create_parser_with_input('CREATE test_collection;')
@@ -121,5 +305,126 @@ class TestParser(unittest.TestCase):
         # Verify that create_collection was called on the DB
         self.db.create_collection.assert_called_once_with('test_collection')
 
+    def test_auto_parse_explain(self):
+        """Test that EXPLAIN passes the parsed query to the DB without searching"""
+        parser = self.create_parser_with_input('EXPLAIN SEARCH test_collection WHERE "a" AND "b" TOP 5;')
+
+        parser.auto_parse()
+
+        self.db.explain.assert_called_once_with('test_collection', And([Term('a'), Term('b')]), 5)
+        self.db.search_top.assert_not_called()
+        command, collection_name, _, ok = self.db.record_command.call_args.args
+        self.assertEqual((command, collection_name, ok), ('EXPLAIN', 'test_collection', True))
+
+    def test_explain_profile_and_metrics(self):
+        """Test EXPLAIN, PROFILE and METRICS against a real DB"""
+        db = DB()
+        output = StringIO()
+        with redirect_stdout(output):
+            for command in ['CREATE c;', 'INSERT c "the cat sat";', 'INSERT c "a cat and a dog";',
+                            'INSERT c "dog";', 'SEARCH c WHERE "cat";', 'SEARCH c WHERE;']:
+                try:
+                    Parser(Lexer(command), db).auto_parse()
+                except Exception:
+                    pass
+        output = StringIO()
+        with redirect_stdout(output):
+            Parser(Lexer('EXPLAIN SEARCH c WHERE "dog" AND "cat" AND NOT "sat";'), db).auto_parse()
+        self.assertEqual(output.getvalue().splitlines()[1:], [
+            'Plan:',
+            '  AND: start from the operand with the fewest documents, intersect the others by galloping search',
+            '    "dog": posting list of 2 documents', '    "cat": posting list of 2 documents',
+            '    minus:', '      "sat": posting list of 1 documents'])
+
+        output = StringIO()
+        with redirect_stdout(output):
+            Parser(Lexer('PROFILE SEARCH c WHERE "dog" AND "cat";'), db).auto_parse()
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[1], "Search results: ['a cat and a dog']")
+        self.assertEqual(lines[2], 'Profile:')
+        self.assertEqual([line.split()[0] for line in lines[3:8]], ['lex', 'analyze', 'search', 'print', 'fetch'])
+        self.assertIn("  result cache: miss", lines)
+        self.assertIn("  posting lists: 'dog': 2, 'cat': 2", lines)
+        self.assertIn("  documents scanned: 4, matched: 1", lines)
+
+        metrics = db.metrics
+        self.assertEqual(metrics.counter('oaa_commands_total', command='insert', collection='c', status='ok'), 3)
+        self.assertEqual(metrics.counter('oaa_commands_total', command='search', collection='c', status='error'), 1)
+        self.assertEqual(metrics.counter('oaa_documents_inserted_total', collection='c'), 3)
+        self.assertEqual(metrics.histogram('oaa_command_duration_seconds', command='insert', collection='c').count, 3)
+        output = StringIO()
+        with redirect_stdout(output):
+            Parser(Lexer('METRICS;'), db).auto_parse()
+        self.assertIn('oaa_cache_lookups_total{collection="c",result="miss"} 2', output.getvalue().splitlines())
+        exported = metrics.prometheus().splitlines()
+        self.assertIn('# TYPE oaa_command_duration_seconds histogram', exported)
+        self.assertIn('oaa_command_duration_seconds_bucket{collection="c",command="insert",le="+Inf"} 3', exported)
+        self.assertIn('oaa_command_duration_seconds_count{collection="c",command="insert"} 3', exported)
+
+class TestCommandLine(unittest.TestCase):
+    def test_read_statements(self):
+        """Test that statements are split at semicolons outside quotes, across and within lines"""
+        lines = ['CREATE c;\n', 'INSERT c\n', '  "one; two\n', 'three"; SEARCH c;\n',
+                 '\n', 'file commands.txt\n', '-q\n', 'SEARCH c WHERE']
+        self.assertEqual(list(read_statements(lines)), [
+            'CREATE c;', 'INSERT c\n  "one; two\nthree";', 'SEARCH c;', 'file commands.txt', '-q', 'SEARCH c WHERE'])
+
+    def test_statements_run_as_they_arrive(self):
+        """Test that a statement runs before the lines after it are read"""
+        db = DB()
+        output = StringIO()
+        with redirect_stdout(output):
+            runner = CommandRunner(db)
+            statements = read_statements(iter(['CREATE c; INSERT c\n', '"a;b";\n']))
+            runner.run(next(statements))
+            self.assertIn('c', db.collections)
+            runner.run(next(statements))
+        self.assertEqual(db.collections['c'][1].get_all_documents(), {1: 'a b'})
+
+    def test_quiet_mode(self):
+        """Test that quiet mode prints only search results and errors, also those the DB prints, and counts them"""
+        db = DB()
+        output = StringIO()
+        with redirect_stdout(output):
+            runner = CommandRunner(db, quiet=True)
+            for statement in read_statements(['CREATE c;\n', 'INSERT c "hello";\n', 'INSERT c "world";\n',
+                                              'SEARCH c WHERE "hello";\n', 'INSERT c;\n', 'CREATE c;\n',
+                                              'INSERT d "x";\n', 'DELETE c 9;\n', 'DELETE c 1;\n']):
+                runner.run(statement)
+            runner.print_summary()
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[:-1], ["Searching in collection c for documents with word 'hello'",
+                                      "Search results: ['hello']", "Error: Invalid syntax",
+                                      "Error: Collection 'c' already exists.", "Error: Collection 'd' not found.",
+                                      "Error: Document 9 not found in collection 'c'."])
+        self.assertTrue(lines[-1].startswith('Ran 9 commands (INSERT: 4, CREATE: 2, DELETE: 2, SEARCH: 1) in '))
+        self.assertTrue(lines[-1].endswith(', 4 errors.'))
+
+    def test_buffered_output(self):
+        """Test that output is written in chunks of the buffer size and on flush"""
+        stream = StringIO()
+        output = BufferedOutput(stream, buffer_size=10)
+        output.write('12345')
+        self.assertEqual(stream.getvalue(), '')
+        output.write('67890')
+        self.assertEqual(stream.getvalue(), '1234567890')
+        output.write('x')
+        output.flush()
+        self.assertEqual(stream.getvalue(), '1234567890x')
+
+    def test_execute_file_commands(self):
+        """Test that a command file is run statement by statement with an echo"""
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'commands.txt')
+            with open(filename, 'w') as file:
+                file.write('CREATE c;\nINSERT c\n"a b";\nSEARCH c;\n')
+            output = StringIO()
+            with redirect_stdout(output):
+                execute_file_commands(filename, DB())
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], 'Command: CREATE c;')
+        self.assertIn('Command: INSERT c\n"a b";', output.getvalue())
+        self.assertEqual(lines[-1], "All documents in collection 'c': ['a b']")
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,136 @@
+import asyncio
+import json
+import unittest
+from invertedIndex import DB
+from server import CommandServer, ReadWriteLock
+
+class TestServer(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+
+        """Start a server with a line and an HTTP listener on free ports"""
+
+        self.server = CommandServer(DB(), threads=4)
+        self.listeners = await self.server.start('127.0.0.1', 0, 0)
+        self.ports = [listener.sockets[0].getsockname()[1] for listener in self.listeners]
+
+    async def asyncTearDown(self):
+        for listener in self.listeners:
+            listener.close()
+            await listener.wait_closed()
+        self.server.close()
+
+    async def read_answer(self, reader):
+        status, length = (await reader.readline()).split()
+        return status.decode(), (await reader.readexactly(int(length))).decode()
+
+    async def test_pipelined_line_protocol(self):
+        """Test that pipelined commands are answered in order, each with its own output"""
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.ports[0])
+        commands = ['CREATE c;', 'INSERT c "the cat sat";', 'INSERT c "a cozy cat";',
+                    'SEARCH c WHERE "cat" LIMIT 1 OFFSET 1;', 'SEARCH c WHERE;', 'SEARCH missing;']
+        writer.write(''.join(command + '\n' for command in commands).encode())
+        answers = [await self.read_answer(reader) for _ in commands]
+        writer.close()
+
+        self.assertEqual([status for status, _ in answers], ['OK'] * 4 + ['ERR', 'ERR'])
+        self.assertIn("Collection 'c' created.", answers[0][1])
+        self.assertIn("with ID 2", answers[2][1])
+        self.assertTrue(answers[3][1].endswith("Search results: ['a cozy cat']\n"))
+        self.assertEqual(answers[4][1], "Error: Invalid syntax\n")
+        self.assertIn("Collection 'missing' not found.", answers[5][1])
+
+    async def test_missing_collection_is_an_error(self):
+        """Test that commands the DB does not carry out, such as searches of a missing collection, fail"""
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.ports[0])
+        commands = ['SEARCH missing WHERE "cat";', 'SEARCH missing WHERE "cat" TOP 3;', 'PRINT_INDEX missing;',
+                    'EXPLAIN SEARCH missing;', 'INSERT missing "cat";', 'CREATE c;', 'SEARCH c;']
+        writer.write(''.join(command + '\n' for command in commands).encode())
+        answers = [await self.read_answer(reader) for _ in commands]
+        writer.close()
+
+        self.assertEqual([status for status, _ in answers], ['ERR'] * 5 + ['OK'] * 2)
+        for _, output in answers[:5]:
+            self.assertTrue(output.endswith("Collection 'missing' not found.\n"))
+
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.ports[1])
+        body = json.dumps({'command': 'SEARCH missing;'})
+        writer.write(f"POST / HTTP/1.1\r\nContent-Type: application/json\r\nConnection: close\r\n"
+                     f"Content-Length: {len(body)}\r\n\r\n{body}".encode())
+        response = (await reader.read()).decode()
+        writer.close()
+        head, _, body = response.partition('\r\n\r\n')
+        self.assertTrue(head.startswith('HTTP/1.1 400 Bad Request'))
+        self.assertEqual(json.loads(body), {'ok': False, 'output': "Searching all documents in collection: missing\n"
+                                                                  "Collection 'missing' not found.\n"})
+
+    async def test_writes_are_ordered_within_a_connection(self):
+        """Test that pipelined commands of a connection run in order while other connections run concurrently"""
+        connections = [await asyncio.open_connection('127.0.0.1', self.ports[0]) for _ in range(8)]
+        for i, (reader, writer) in enumerate(connections):
+            writer.write(b'CREATE c%d;\n' % i + b''.join(b'INSERT c%d "doc %d";\n' % (i, j) for j in range(20))
+                         + b'SEARCH c%d WHERE "doc" LIMIT 1 OFFSET 19;\n' % i)
+        for i, (reader, writer) in enumerate(connections):
+            answers = [await self.read_answer(reader) for _ in range(22)]
+            writer.close()
+            self.assertEqual([status for status, _ in answers], ['OK'] * 22)
+            self.assertIn(f"Collection 'c{i}' created.", answers[0][1])
+            self.assertEqual([answer.split()[-1] for _, answer in answers[1:21]], [f"{j}." for j in range(1, 21)])
+            self.assertEqual(answers[21][1], f"Searching in collection c{i} for documents with word 'doc'\n"
+                                             f"Search results: ['doc 19']\n")
+
+    async def test_http(self):
+        """Test JSON and plain commands over one kept-alive HTTP connection"""
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.ports[1])
+        bodies = [(json.dumps({'command': 'CREATE c;'}), 'application/json'), ('INSERT c "cat";', 'text/plain'),
+                  ('SEARCH c;', 'text/plain')]
+        for body, content_type in bodies:
+            writer.write(f"POST / HTTP/1.1\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(body)}\r\n\r\n{body}".encode())
+        writer.write(b"GET / HTTP/1.1\r\n\r\n")
+        answers = []
+        for _ in range(4):
+            status = (await reader.readline()).decode()
+            headers = {}
+            while (line := (await reader.readline()).decode().strip()):
+                name, _, value = line.partition(':')
+                headers[name.lower()] = value.strip()
+            answers.append((status.split()[1], json.loads(await reader.readexactly(int(headers['content-length'])))))
+        self.assertEqual(await reader.read(), b'')
+        writer.close()
+
+        self.assertEqual([status for status, _ in answers], ['200', '200', '200', '400'])
+        self.assertTrue(answers[2][1]['output'].endswith("All documents in collection 'c': ['cat']\n"))
+        self.assertFalse(answers[3][1]['ok'])
+
+    async def test_http_metrics(self):
+        """Test that GET /metrics exports the metrics of the DB in the Prometheus text format"""
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.ports[0])
+        writer.write(b'CREATE c;\nINSERT c "cat";\n')
+        for _ in range(2):
+            await self.read_answer(reader)
+        writer.close()
+
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.ports[1])
+        writer.write(b"GET /metrics HTTP/1.1\r\nConnection: close\r\n\r\n")
+        response = (await reader.read()).decode()
+        writer.close()
+        head, _, body = response.partition('\r\n\r\n')
+        self.assertTrue(head.startswith('HTTP/1.1 200 OK'))
+        self.assertIn('Content-Type: text/plain; version=0.0.4', head)
+        self.assertIn('oaa_commands_total{collection="c",command="insert",status="ok"} 1', body.splitlines())
+        self.assertIn('oaa_documents_inserted_total{collection="c"} 1', body.splitlines())
+
+    async def test_read_write_lock_order(self):
+        """Test that readers share the lock and requests are granted in arrival order"""
+        lock = ReadWriteLock()
+        first, second, write, third = (lock.acquire(False), lock.acquire(False), lock.acquire(True),
+                                       lock.acquire(False))
+        self.assertEqual([future.done() for future in (first, second, write, third)], [True, True, False, False])
+        lock.release(False)
+        lock.release(False)
+        self.assertEqual([write.done(), third.done()], [True, False])
+        lock.release(True)
+        self.assertTrue(third.done())
+
+if __name__ == '__main__':
+    unittest.main()
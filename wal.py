@@ -0,0 +1,214 @@
+"""
+Write-ahead log of the operations of a DB with a data directory.
+
+Every CREATE, INSERT and DELETE is appended to the log before it is applied, as a record of
+    payload length (4 bytes) | CRC-32 of the payload (4 bytes) | pickled operation
+and is written through to the operating system right away, so a crash of the process
+loses nothing. When the log is forced to the disk with fsync depends on the durability
+level:
+
+    'sync'   every record is fsynced before the operation returns
+    'group'  group commit: records are fsynced in groups, by a background thread at most
+             `group_commit_interval` seconds after the first record of a group arrives,
+             or as soon as `group_commit_records` records are waiting. A power loss may
+             lose the last group; one fsync covers many operations.
+    'async'  records are never fsynced; a power loss may lose everything since the last
+             checkpoint
+
+A checkpoint writes the collections to disk and empties the log, so recovery only
+replays the operations logged since the last checkpoint. A record cut short by a crash
+fails its length or CRC check; reading stops there and the torn tail is cut off.
+"""
+
+import os
+import pickle
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+
+DURABILITY_LEVELS = ('sync', 'group', 'async')
+
+# Record header: payload length and CRC-32 of the payload
+HEADER = struct.Struct('<II')
+
+
+def sync_directory(path):
+
+    """Makes created, renamed and deleted entries of a directory durable (POSIX only)"""
+
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class SharedLock:
+
+    """
+    Lock held either by any number of threads together or by one thread alone.
+    Operations hold it shared from logging a record until they have applied it, and a
+    checkpoint holds it alone, so it never empties the log of an operation that has not
+    reached the collections yet. A waiting exclusive request keeps new shared holders out.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.shared = 0
+        self.exclusive = False
+        self.exclusive_waiting = 0
+
+    @contextmanager
+    def hold_shared(self):
+        with self.condition:
+            while self.exclusive or self.exclusive_waiting:
+                self.condition.wait()
+            self.shared += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.shared -= 1
+                if not self.shared:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def hold_exclusive(self):
+        with self.condition:
+            self.exclusive_waiting += 1
+            while self.exclusive or self.shared:
+                self.condition.wait()
+            self.exclusive_waiting -= 1
+            self.exclusive = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.exclusive = False
+                self.condition.notify_all()
+
+
+class WriteAheadLog:
+
+    """Append-only log of operations, given as picklable tuples"""
+
+    def __init__(self, path, durability='group', group_commit_records=1000, group_commit_interval=0.01):
+
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f"Unknown durability level '{durability}', expected one of {DURABILITY_LEVELS}.")
+        self.path = path
+        self.durability = durability
+        self.group_commit_records = group_commit_records
+        self.group_commit_interval = group_commit_interval
+
+        self.file = open(path, 'ab')
+        self.size = self.file.tell()
+        # Records written since the last fsync
+        self.pending = 0
+        self.syncs = 0
+
+        # Guards the file and the counters; the sync thread waits on `sync_needed` for a group to start
+        self.lock = threading.Lock()
+        self.sync_needed = threading.Condition(self.lock)
+        self.closed = False
+        self.sync_thread = None
+        if durability == 'group':
+            self.sync_thread = threading.Thread(target=self._sync_loop, daemon=True)
+            self.sync_thread.start()
+
+    def records(self):
+
+        """Yields the logged operations in order, up to the first torn or corrupt record,
+        which is cut off together with everything after it"""
+
+        valid_size = 0
+        with open(self.path, 'rb') as file:
+            while True:
+                header = file.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                length, crc = HEADER.unpack(header)
+                payload = file.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                valid_size += HEADER.size + length
+                yield pickle.loads(payload)
+
+        with self.lock:
+            if valid_size < self.size:
+                self.file.truncate(valid_size)
+                self.size = valid_size
+                self._sync()
+
+    def append(self, record):
+
+        """Logs an operation; returns once it is as durable as the durability level promises"""
+
+        payload = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            if self.closed:
+                raise ValueError("The write-ahead log is closed.")
+            self.file.write(HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            self.file.flush()
+            self.size += HEADER.size + len(payload)
+            self.pending += 1
+            if self.durability == 'sync' or (self.durability == 'group' and self.pending >= self.group_commit_records):
+                self._sync()
+            elif self.durability == 'group' and self.pending == 1:
+                self.sync_needed.notify()
+
+    def _sync(self):
+        os.fsync(self.file.fileno())
+        self.pending = 0
+        self.syncs += 1
+
+    def _sync_loop(self):
+
+        """Group commit: fsyncs the records that arrived during `group_commit_interval` together"""
+
+        with self.lock:
+            while not self.closed:
+                if not self.pending:
+                    self.sync_needed.wait()
+                    continue
+                self.sync_needed.wait(self.group_commit_interval)
+                if self.pending and not self.closed:
+                    # Operations keep appending while the group is fsynced; they join the next group
+                    self.pending = 0
+                    self.lock.release()
+                    try:
+                        os.fsync(self.file.fileno())
+                    finally:
+                        self.lock.acquire()
+                    self.syncs += 1
+
+    def sync(self):
+
+        """Forces all logged records to the disk"""
+
+        with self.lock:
+            if self.pending:
+                self._sync()
+
+    def truncate(self):
+
+        """Empties the log after a checkpoint"""
+
+        with self.lock:
+            self.file.truncate(0)
+            self.size = 0
+            self._sync()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            if self.pending and self.durability != 'async':
+                self._sync()
+            self.closed = True
+            self.sync_needed.notify()
+        if self.sync_thread is not None:
+            self.sync_thread.join()
+        self.file.close()